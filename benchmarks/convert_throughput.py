@@ -0,0 +1,104 @@
+'''
+Throughput and peak memory of CSV conversion as the size of the file grows.
+For each row count, a synthetic CSV file (header row, type row, then data rows with
+string, number, date, and boolean columns, in the shape of the Washington EV dataset) is
+written to a temporary directory, and a fresh Python process runs one of two pipelines on it:
+  legacy: the original convert.py -- read_csv, df.values.tolist(), a Python strip of every
+    cell, and a second DataFrame built from the lists
+  chunked: convert.convert_csv, which reads the type row first and then converts the file in
+    typed chunks into a ColumnarTable
+The rows per second and the peak RSS of each run, less the RSS of the process before the
+pipeline ran, are printed as a table.
+Usage:
+  python benchmarks/convert_throughput.py [--rows 100000,1000000]
+'''
+import argparse
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MAKES = ['TESLA', 'NISSAN', 'CHEVROLET', 'KIA', 'FORD', 'BMW', 'TOYOTA', 'VOLKSWAGEN']
+COUNTIES = ['King', 'Snohomish', 'Pierce', 'Clark', 'Thurston', 'Kitsap', 'Spokane']
+
+
+def write_csv_file(path, num_rows):
+  '''
+  Write a CSV file with a type row and num_rows data rows to path
+  '''
+  generator = random.Random(0)
+  with open(path, 'w') as csv_file:
+    csv_file.write('VIN,County,Model Year,Make,Electric Range,Base MSRP,Registered,Eligible\n')
+    csv_file.write('string,string,number,string,number,number,date,boolean\n')
+    for i in range(num_rows):
+      csv_file.write(','.join([
+        f'5YJ3E1EA{i:09d}', f' {generator.choice(COUNTIES)} ', str(generator.randint(2011, 2024)),
+        generator.choice(MAKES), str(generator.randint(0, 330)), f'{generator.uniform(0, 90000):.2f}',
+        f'2023-{generator.randint(1, 12):02d}-{generator.randint(1, 28):02d}', generator.choice(['True', 'False'])
+      ]))
+      csv_file.write('\n')
+
+
+def legacy_convert_csv(csv_file):
+  '''
+  The original conversion in convert.py, less the final DataFrameTable
+  '''
+  import pandas as pd
+  clean_row = lambda row: [s.strip() if type(s) == str else s for s in row]
+  df = pd.read_csv(csv_file)
+  all_rows = df.values.tolist()
+  rows = [clean_row(r) for r in all_rows[1:]]
+  types = clean_row(all_rows[0])
+  schema = [{"name": df.columns[i], "type": types[i]} for i in range(len(types))]
+  return (schema, pd.DataFrame(rows, columns = df.columns))
+
+
+def _peak_rss_mb():
+  # Peak RSS of this process in MB (ru_maxrss is in KB on Linux)
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_pipeline(mode, path):
+  '''
+  Run the conversion pipeline mode on the file at path, and return (seconds, growth in peak RSS in MB)
+  '''
+  from convert import convert_csv
+  start_rss = _peak_rss_mb()
+  start = time.perf_counter()
+  if mode == 'legacy':
+    legacy_convert_csv(path)
+  else:
+    convert_csv(path)
+  return (time.perf_counter() - start, _peak_rss_mb() - start_rss)
+
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Throughput and peak RSS of the legacy and chunked CSV conversions')
+  parser.add_argument('--rows', default = '100000,1000000', help = 'comma-separated row counts')
+  parser.add_argument('--child', nargs = 2, metavar = ('MODE', 'PATH'), help = argparse.SUPPRESS)
+  args = parser.parse_args()
+  if args.child is not None:
+    print(*run_pipeline(*args.child))
+    return
+  print(f'{"rows":>10} {"file (MB)":>10} {"legacy rows/s":>14} {"legacy (MB)":>12} {"chunked rows/s":>15} {"chunked (MB)":>13}')
+  with tempfile.TemporaryDirectory() as directory:
+    for num_rows in [int(rows) for rows in args.rows.split(',')]:
+      path = os.path.join(directory, f'table_{num_rows}.csv')
+      write_csv_file(path, num_rows)
+      results = {}
+      for mode in ['legacy', 'chunked']:
+        output = subprocess.run([sys.executable, __file__, '--child', mode, path], capture_output = True, text = True, check = True)
+        (seconds, memory) = output.stdout.strip().splitlines()[-1].split()
+        results[mode] = (num_rows / float(seconds), float(memory))
+      size = os.path.getsize(path) / (1024 * 1024)
+      print(f'{num_rows:>10} {size:>10.1f} {results["legacy"][0]:>14,.0f} {results["legacy"][1]:>12.1f} {results["chunked"][0]:>15,.0f} {results["chunked"][1]:>13.1f}')
+      os.remove(path)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,58 @@
+'''
+Time to first byte, total time, and peak memory of streaming exports as the table grows.
+For each row count, a synthetic ColumnarTable (see filter_throughput.make_table) is built,
+and every row matching an IN_LIST filter is exported with table_export.export_stream in
+each format.  Memory is measured with tracemalloc over the export alone (not the table),
+so it should stay flat as the number of rows grows.
+Usage:
+  python benchmarks/export_stream.py [--rows 1000000,5000000] [--formats ndjson,csv,arrow]
+'''
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from filter_throughput import make_table, FILTERS
+from table_export import export_stream
+import table_export
+
+
+def run_export(table, export_format):
+  '''
+  Export the rows of table which pass FILTERS["IN_LIST"] in export_format, and return
+  (seconds to the first chunk, total seconds, bytes produced, peak traced memory in MB)
+  '''
+  tracemalloc.start()
+  start = time.perf_counter()
+  first = None
+  size = 0
+  for chunk in export_stream(table, FILTERS["IN_LIST"], export_format):
+    if first is None:
+      first = time.perf_counter() - start
+    size += len(chunk)
+  total = time.perf_counter() - start
+  (_, peak) = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return (first, total, size, peak / (1024 * 1024))
+
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Time to first byte and peak memory of streaming exports')
+  parser.add_argument('--rows', default = '1000000,5000000', help = 'comma-separated row counts')
+  parser.add_argument('--formats', default = 'ndjson,csv,arrow', help = 'comma-separated export formats')
+  args = parser.parse_args()
+  formats = [export_format for export_format in args.formats.split(',') if export_format != 'arrow' or table_export.pyarrow is not None]
+  print(f'{"rows":>10} {"format":>7} {"first byte (ms)":>16} {"total (s)":>10} {"output (MB)":>12} {"peak (MB)":>10}')
+  for num_rows in [int(rows) for rows in args.rows.split(',')]:
+    table = make_table(num_rows)
+    for export_format in formats:
+      (first, total, size, peak) = run_export(table, export_format)
+      print(f'{num_rows:>10} {export_format:>7} {first * 1000:>16.1f} {total:>10.2f} {size / (1024 * 1024):>12.1f} {peak:>10.1f}')
+
+
+if __name__ == '__main__':
+  main()
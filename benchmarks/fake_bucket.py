@@ -0,0 +1,61 @@
+'''
+An in-process stand-in for SDMLStorageBucket for the benchmarks: a MemoryStorageBucket
+which waits latency seconds on every request, as a request to Cloud Storage would, and
+which makes its batch reads concurrently with max_workers threads, as SDMLStorageBucket does.
+With latency 0 it measures the wiki's own work; with a realistic latency (say 0.03s), it
+shows how much of a cold start goes to waiting for the bucket.
+'''
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from memory_bucket import MemoryStorageBucket
+from gcs_interface import DEFAULT_IO_WORKERS
+
+
+class FakeStorageBucket(MemoryStorageBucket):
+  '''
+  A MemoryStorageBucket with a simulated request latency
+  Arguments:
+    bucket_name: the name of the bucket
+    blobs: an optional dictionary {blob_name: table dictionary} of the initial contents
+    latency: the seconds each request to the bucket takes
+    max_workers: the number of concurrent requests made by get_tables_as_dictionaries
+  '''
+  def __init__(self, bucket_name = 'benchmark', blobs = None, latency = 0.0, max_workers = DEFAULT_IO_WORKERS):
+    self.latency = latency
+    self.max_workers = max_workers
+    self.requests = 0
+    super(FakeStorageBucket, self).__init__(bucket_name, blobs)
+
+  def _request(self):
+    # One request to the bucket
+    self.requests += 1
+    if self.latency > 0:
+      time.sleep(self.latency)
+
+  def get_table_generations(self, prefix = None, page_size = None):
+    self._request()
+    return super(FakeStorageBucket, self).get_table_generations(prefix, page_size)
+
+  def get_table_as_dictionary(self, table_name):
+    self._request()
+    return super(FakeStorageBucket, self).get_table_as_dictionary(table_name)
+
+  def get_tables_as_dictionaries(self, table_names, max_workers = None):
+    table_names = list(table_names)
+    if len(table_names) == 0:
+      return []
+    with ThreadPoolExecutor(max_workers = min(max_workers or self.max_workers, len(table_names))) as executor:
+      return list(executor.map(lambda name: super(FakeStorageBucket, self).get_tables_as_dictionaries([name])[0], table_names))
+
+  def download_ranges(self, blob_name, ranges, generation):
+    self._request()
+    return super(FakeStorageBucket, self).download_ranges(blob_name, ranges, generation)
+
+  def put_blob(self, blob_name, contents):
+    self._request()
+    return super(FakeStorageBucket, self).put_blob(blob_name, contents)
@@ -0,0 +1,81 @@
+'''
+Rows per second of SDQL filter evaluation: the existing row-by-row path
+(SDQLFilter.filter, which RowTable.get_filtered_rows uses) against the vectorized
+evaluator in vector_filter over a ColumnarTable.  The tables are synthetic, with a
+number column, a dictionary-encoded string column of 12 month names and a date column.
+The row-by-row path builds Python rows, so it is skipped above --row-limit rows.
+Usage:
+  python benchmarks/filter_throughput.py [--sizes 10000,1000000,10000000] [--row-limit 1000000]
+'''
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sdtp import SDQLFilter
+from columnar_cache import ColumnarTable, DICTIONARY_ENCODING
+from vector_filter import filter_indices
+
+MONTHS = sorted(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])
+SCHEMA = [{"name": "Disease", "type": "number"}, {"name": "Month", "type": "string"}, {"name": "Day", "type": "date"}]
+FILTERS = {
+  "IN_RANGE": {"operator": "IN_RANGE", "column": "Disease", "min_val": 1000, "max_val": 5000},
+  "IN_LIST": {"operator": "IN_LIST", "column": "Month", "values": ["Jun", "Jul", "Aug"]},
+  "REGEX_MATCH": {"operator": "REGEX_MATCH", "column": "Month", "expression": "J.*"},
+  "ALL": {"operator": "ALL", "arguments": [
+    {"operator": "IN_RANGE", "column": "Day", "min_val": "2020-01-01", "max_val": "2020-06-30"},
+    {"operator": "NONE", "arguments": [{"operator": "IN_LIST", "column": "Month", "values": ["Jun", "Jul", "Aug"]}]}
+  ]}
+}
+
+
+def make_table(num_rows, seed = 0):
+  '''
+  Make a synthetic ColumnarTable with num_rows rows
+  '''
+  generator = np.random.default_rng(seed)
+  columns = [
+    generator.integers(0, 10000, num_rows, dtype = np.int64),
+    generator.integers(0, len(MONTHS), num_rows, dtype = np.int32),
+    np.datetime64('2020-01-01') + generator.integers(0, 366, num_rows).astype('timedelta64[D]')
+  ]
+  return ColumnarTable(SCHEMA, columns, ['int64', DICTIONARY_ENCODING, 'datetime64[D]'], [None, MONTHS, None])
+
+
+def _rate(num_rows, function, repeat = 3):
+  # The best rows/sec of repeat runs of function, and its result
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return (num_rows / best, result)
+
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Row-by-row versus vectorized SDQL filter throughput')
+  parser.add_argument('--sizes', default = '10000,1000000,10000000', help = 'comma-separated table sizes, in rows')
+  parser.add_argument('--row-limit', type = int, default = 1000000, help = 'largest table to run the row-by-row path on')
+  args = parser.parse_args()
+  print(f'{"rows":>10} {"filter":>12} {"row path (rows/s)":>18} {"vectorized (rows/s)":>20} {"speedup":>8}')
+  for num_rows in [int(size) for size in args.sizes.split(',')]:
+    table = make_table(num_rows)
+    rows = table.decode_rows() if num_rows <= args.row_limit else None
+    for (name, filter_spec) in FILTERS.items():
+      sdql_filter = SDQLFilter(filter_spec, SCHEMA)
+      (vector_rate, indices) = _rate(num_rows, lambda: filter_indices(sdql_filter, table))
+      if rows is None:
+        print(f'{num_rows:>10} {name:>12} {"skipped":>18} {vector_rate:>20,.0f} {"":>8}')
+        continue
+      (row_rate, result) = _rate(num_rows, lambda: sdql_filter.filter(rows), repeat = 1)
+      assert len(result) == len(indices), f'{name}: results differ'
+      print(f'{num_rows:>10} {name:>12} {row_rate:>18,.0f} {vector_rate:>20,.0f} {vector_rate / row_rate:>7.0f}x')
+
+
+if __name__ == '__main__':
+  main()
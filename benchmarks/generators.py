@@ -0,0 +1,103 @@
+'''
+Synthetic SDML tables for the benchmarks.  A table has a configurable number of rows and
+columns, the column types cycle through a list of SDML types, and cardinality bounds the
+number of distinct values in each column, so that the selectivity of filters over the
+table is predictable.  Tables are generated from a seed, and the same arguments always
+give the same table.
+'''
+import csv
+import datetime
+import io
+import json
+import random
+
+DEFAULT_TYPES = ('number', 'string', 'date')
+BASE_DATE = datetime.date(2020, 1, 1)
+BASE_DATETIME = datetime.datetime(2020, 1, 1)
+
+
+def make_schema(num_columns, types = DEFAULT_TYPES):
+  '''
+  A schema of num_columns columns, whose types cycle through types.  Column i is named <type>_<i>
+  '''
+  return [{"name": f'{types[i % len(types)]}_{i}', "type": types[i % len(types)]} for i in range(num_columns)]
+
+
+def _value(sdml_type, draw):
+  # The JSON form of the value draw (an int in [0, cardinality)) in a column of sdml_type
+  if sdml_type == 'number':
+    return draw
+  if sdml_type == 'string':
+    return f'value_{draw:06d}'
+  if sdml_type == 'boolean':
+    return draw % 2 == 0
+  if sdml_type == 'date':
+    return (BASE_DATE + datetime.timedelta(days = draw % 3650)).isoformat()
+  if sdml_type == 'datetime':
+    return (BASE_DATETIME + datetime.timedelta(seconds = draw * 37)).isoformat()
+  if sdml_type == 'timeofday':
+    seconds = draw % 86400
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+  raise ValueError(f'No generator for type {sdml_type}')
+
+
+def make_rows(schema, num_rows, cardinality = 1000, seed = 0):
+  '''
+  num_rows rows for schema, in JSON form; each column has at most cardinality distinct values
+  '''
+  generator = random.Random(seed)
+  types = [column["type"] for column in schema]
+  return [[_value(sdml_type, generator.randrange(cardinality)) for sdml_type in types] for _ in range(num_rows)]
+
+
+def make_table(num_rows, num_columns = 3, types = DEFAULT_TYPES, cardinality = 1000, seed = 0):
+  '''
+  A synthetic RowTable, as an SDML dictionary {"type", "schema", "rows"}
+  '''
+  schema = make_schema(num_columns, types)
+  return {"type": "RowTable", "schema": schema, "rows": make_rows(schema, num_rows, cardinality, seed)}
+
+
+def to_sdml(table):
+  '''
+  The SDML file of table, as bytes
+  '''
+  return json.dumps(table).encode('utf-8')
+
+
+def to_csv(table):
+  '''
+  table as a CSV file for upload, as bytes: a row of column names, a row of types, then the rows
+  '''
+  output = io.StringIO()
+  writer = csv.writer(output)
+  writer.writerow([column["name"] for column in table["schema"]])
+  writer.writerow([column["type"] for column in table["schema"]])
+  writer.writerows(table["rows"])
+  return output.getvalue().encode('utf-8')
+
+
+def make_filters(schema, cardinality = 1000):
+  '''
+  An SDQL filter for each SDQL operator over schema, as a dictionary {operator: filter}.
+  The primitive filters each pass about a tenth of the rows of a table made with the same
+  cardinality; a filter is left out if the schema has no column it can use
+  '''
+  first = {}
+  for column in schema:
+    first.setdefault(column["type"], column["name"])
+  tenth = max(1, cardinality // 10)
+  filters = {}
+  if 'number' in first:
+    filters["IN_RANGE"] = {"operator": "IN_RANGE", "column": first['number'], "min_val": 0, "max_val": tenth - 1}
+  if 'string' in first:
+    filters["IN_LIST"] = {"operator": "IN_LIST", "column": first['string'], "values": [_value('string', i) for i in range(0, cardinality, 10)]}
+    # The values ending in 3 are a tenth of the values
+    filters["REGEX_MATCH"] = {"operator": "REGEX_MATCH", "column": first['string'], "expression": "value_.*3"}
+  primitives = list(filters.values())
+  if len(primitives) >= 2:
+    filters["ALL"] = {"operator": "ALL", "arguments": primitives[:2]}
+    filters["ANY"] = {"operator": "ANY", "arguments": primitives[:2]}
+  if len(primitives) >= 1:
+    filters["NONE"] = {"operator": "NONE", "arguments": primitives[:1]}
+  return filters
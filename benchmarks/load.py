@@ -0,0 +1,210 @@
+'''
+Throughput and memory of the wiki under gunicorn as the number of workers grows.
+For each worker count, gunicorn is started with gunicorn.conf.py and WEB_CONCURRENCY set
+to the count, and --clients client threads request --paths in turn for --duration seconds.
+For each run the script prints the requests per second, the median and 99th percentile
+latency, the number of failed requests, and the mean RSS and PSS of the workers.  PSS
+(proportional set size) divides each shared page among the processes sharing it, so
+with a preloaded app, PSS per worker is the memory a worker really adds, and stays
+well below its RSS.  Run it twice, with and without --no-preload, to compare.
+The server reads its tables from the bucket named by BUCKET_NAME, with the usual
+environment.  With --emulator, it instead runs against a local fake of Cloud Storage
+(the gcp-storage-emulator package), and no credentials are needed.  The fake bucket is
+seeded as uploads are stored: a synthetic table of --rows rows as a GCSTable, bench/load,
+whose rows are in a separate blob, and as a table in the row-group layout, bench/load_chunked.
+The clients run in this process, so on a small machine they, not the server, may be the
+bottleneck; watch the CPU use of the client.
+Usage:
+  python benchmarks/load.py --emulator [--workers 1,2,4,8] [--clients 32] [--duration 10] [--no-preload]
+'''
+import argparse
+import io
+import json
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMULATOR_BUCKET = 'load-test'
+EMULATOR_TABLE = 'bench/load'
+EMULATOR_CHUNKED_TABLE = 'bench/load_chunked'
+DEFAULT_PATHS = [
+  f'/view_table?table={EMULATOR_TABLE}',
+  f'/view_table?table={EMULATOR_TABLE}&offset=500&limit=50',
+  f'/get_range_spec?table_name={EMULATOR_TABLE}&column_name=value',
+  f'/view_table?table={EMULATOR_CHUNKED_TABLE}&offset=500&limit=50',
+  '/get_table_names'
+]
+
+
+def start_emulator(port, rows):
+  '''
+  Start a fake Cloud Storage server on port, holding a bucket with a table of rows rows stored
+  both as a GCSTable and in the row-group layout, as the wiki stores uploads, and return the server
+  '''
+  from gcp_storage_emulator.server import create_server
+  server = create_server('localhost', port, in_memory = True, default_bucket = EMULATOR_BUCKET)
+  server.start()
+  os.environ['STORAGE_EMULATOR_HOST'] = f'http://localhost:{port}'
+  sys.path.insert(0, ROOT)
+  from gcs_interface import SDMLStorageBucket
+  from row_groups import upload_row_groups, manifest_blob_name
+  schema = [{"name": "id", "type": "number"}, {"name": "label", "type": "string"}, {"name": "value", "type": "number"}]
+  table = {
+    "type": "RowTable",
+    "schema": schema,
+    "rows": [[i, random.choice(['north', 'south', 'east', 'west']), random.random() * 1000] for i in range(rows)]
+  }
+  bucket = SDMLStorageBucket(EMULATOR_BUCKET)
+  bucket.upload_tables([
+    {"prefix": "rowtables", "name": EMULATOR_TABLE, "table": table},
+    {"prefix": "gcstables", "name": EMULATOR_TABLE, "table": {
+      "type": "GCSTable", "schema": schema, "bucket": EMULATOR_BUCKET, "blob": f'rowtables/{EMULATOR_TABLE}.sdml'
+    }}
+  ])
+  chunked_spec = {"type": "ChunkedGCSTable", "schema": schema, "bucket": EMULATOR_BUCKET, "manifest": manifest_blob_name(EMULATOR_CHUNKED_TABLE)}
+  upload_row_groups(bucket, EMULATOR_CHUNKED_TABLE, schema, io.BytesIO(json.dumps(table).encode('utf-8')),
+                    uploads = [{"prefix": "gcstables", "name": EMULATOR_CHUNKED_TABLE, "table": chunked_spec}])
+  return server
+
+
+def _children(pid):
+  # The pids of the child processes of pid
+  children = []
+  for entry in os.listdir('/proc'):
+    if entry.isdigit():
+      try:
+        with open(f'/proc/{entry}/stat') as stat:
+          # The parent pid is the second field after the command, which is in parentheses
+          if int(stat.read().rsplit(')', 1)[1].split()[1]) == pid:
+            children.append(int(entry))
+      except (OSError, IndexError, ValueError):
+        pass
+  return children
+
+
+def _memory_mb(pid):
+  # The (RSS, PSS) of process pid, in MB
+  (rss, pss) = (0, 0)
+  with open(f'/proc/{pid}/status') as status:
+    for line in status:
+      if line.startswith('VmRSS:'):
+        rss = int(line.split()[1])
+  try:
+    with open(f'/proc/{pid}/smaps_rollup') as smaps:
+      for line in smaps:
+        if line.startswith('Pss:'):
+          pss = int(line.split()[1])
+  except OSError:
+    pss = rss
+  return (rss / 1024, pss / 1024)
+
+
+def start_server(workers, port, preload, env):
+  '''
+  Start gunicorn with workers workers on port, wait until it answers and all of its workers
+  are up, and return the process
+  '''
+  env = dict(env, WEB_CONCURRENCY = str(workers), PORT = str(port), GUNICORN_PRELOAD = '1' if preload else '0')
+  process = subprocess.Popen(
+    [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', '--access-logfile', '/dev/null', 'wsgi:app'],
+    cwd = ROOT, env = env, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL
+  )
+  deadline = time.monotonic() + 300
+  while time.monotonic() < deadline:
+    if process.poll() is not None:
+      raise RuntimeError(f'gunicorn exited with status {process.returncode}')
+    try:
+      if requests.get(f'http://localhost:{port}/get_table_names', timeout = 5).status_code == 200 and len(_children(process.pid)) >= workers:
+        return process
+    except requests.ConnectionError:
+      pass
+    time.sleep(0.5)
+  process.kill()
+  raise RuntimeError('gunicorn did not start')
+
+
+def run_load(port, paths, clients, duration):
+  '''
+  Request paths from clients threads for duration seconds.  Returns (latencies in seconds, errors)
+  '''
+  latencies = []
+  errors = [0]
+  lock = threading.Lock()
+  deadline = time.monotonic() + duration
+
+  def client(index):
+    session = requests.Session()
+    mine = []
+    failed = 0
+    request_number = index
+    while time.monotonic() < deadline:
+      path = paths[request_number % len(paths)]
+      request_number += 1
+      start = time.perf_counter()
+      try:
+        if session.get(f'http://localhost:{port}{path}', timeout = 30).status_code >= 400:
+          failed += 1
+      except requests.RequestException:
+        failed += 1
+      mine.append(time.perf_counter() - start)
+    with lock:
+      latencies.extend(mine)
+      errors[0] += failed
+
+  threads = [threading.Thread(target = client, args = (i,)) for i in range(clients)]
+  for thread in threads: thread.start()
+  for thread in threads: thread.join()
+  return (latencies, errors[0])
+
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Requests per second and memory per worker of the wiki under gunicorn')
+  parser.add_argument('--workers', default = '1,2,4', help = 'comma-separated worker counts')
+  parser.add_argument('--clients', type = int, default = 32, help = 'number of concurrent client threads')
+  parser.add_argument('--duration', type = float, default = 10, help = 'seconds of load for each worker count')
+  parser.add_argument('--port', type = int, default = 8765)
+  parser.add_argument('--paths', default = None, help = 'comma-separated paths to request (default: pages of the emulator table)')
+  parser.add_argument('--no-preload', action = 'store_true', help = 'load the app separately in each worker')
+  parser.add_argument('--emulator', action = 'store_true', help = 'serve a synthetic table from a local fake of Cloud Storage')
+  parser.add_argument('--rows', type = int, default = 200000, help = 'rows in the synthetic table (with --emulator)')
+  args = parser.parse_args()
+
+  env = dict(os.environ)
+  emulator = None
+  if args.emulator:
+    emulator = start_emulator(args.port + 1, args.rows)
+    env.update(STORAGE_EMULATOR_HOST = os.environ['STORAGE_EMULATOR_HOST'], BUCKET_NAME = EMULATOR_BUCKET, TABLE_PREFIX = 'gcstables/')
+    for (name, value) in [('APP_SECRET', 'load-test'), ('ROOT_URL', 'http://localhost'), ('CLIENT_ID', 'none'), ('CLIENT_SECRET', 'none')]:
+      env.setdefault(name, value)
+  paths = args.paths.split(',') if args.paths is not None else DEFAULT_PATHS
+
+  print(f'{"workers":>8} {"req/s":>9} {"p50 (ms)":>9} {"p99 (ms)":>9} {"errors":>7} {"RSS/worker (MB)":>16} {"PSS/worker (MB)":>16} {"master RSS (MB)":>16}')
+  try:
+    for workers in [int(count) for count in args.workers.split(',')]:
+      process = start_server(workers, args.port, not args.no_preload, env)
+      try:
+        (latencies, errors) = run_load(args.port, paths, args.clients, args.duration)
+        memory = [_memory_mb(pid) for pid in _children(process.pid)]
+        (master_rss, _) = _memory_mb(process.pid)
+      finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+      quantiles = statistics.quantiles(latencies, n = 100) if len(latencies) > 1 else [0] * 99
+      rss = statistics.mean(entry[0] for entry in memory)
+      pss = statistics.mean(entry[1] for entry in memory)
+      print(f'{workers:>8} {len(latencies) / args.duration:>9.1f} {quantiles[49] * 1000:>9.1f} {quantiles[98] * 1000:>9.1f} {errors:>7} {rss:>16.1f} {pss:>16.1f} {master_rss:>16.1f}')
+  finally:
+    if emulator is not None:
+      emulator.stop()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,277 @@
+'''
+The benchmark suite for the wiki's hot paths.  Runs offline: the tables are synthetic
+(see generators), and the bucket is an in-process FakeStorageBucket (see fake_bucket), so
+no network access or credentials are needed.  The scenarios are:
+  cold_start: registering --tables tables from the bucket, lazily and eagerly, with the
+    bucket answering at once and with --latency seconds per request
+  filter: /filter_table for a filter of each SDQL operator, over a RowTable and over the
+    same table stored as row groups (see row_groups), with the filter and response caches off
+  page_render: /view_table for the first, a middle, and the last page of the RowTable
+  upload: /upload of the table as SDML and as CSV, stored as row groups (CHUNK_MIN_ROWS is 0),
+    since the fake bucket can't serve sdtp's own GCSTable
+Each scenario reports its latencies (median_ms, p95_ms) or throughputs (rows_per_s, mb_per_s).
+The results are printed, and written as JSON with --output.  With --baseline, each result
+is reported as a ratio to the stored baseline, and a latency more than --threshold above the
+baseline, or a throughput more than --threshold below it, is marked as a regression.  Timings
+depend on the machine, so regressions only make the exit status 1 with --fail-on-regression,
+and then only if the baseline was recorded on the same machine (host, platform, CPUs and
+Python); otherwise the ratios are only a rough guide.  --save-baseline writes the results as a
+new baseline, so the usual check is to save a baseline before a change and compare after it.
+Usage:
+  python benchmarks/suite.py [--quick] [--scenarios cold_start,filter,page_render,upload]
+                             [--output results.json] [--save-baseline baseline.json]
+                             [--baseline benchmarks/baseline.json] [--threshold 0.25] [--fail-on-regression]
+'''
+import argparse
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generators import make_table, make_filters, to_sdml, to_csv
+from fake_bucket import FakeStorageBucket
+
+SCENARIOS = ['cold_start', 'filter', 'page_render', 'upload']
+# The sizes of the full run, and of a --quick run
+SIZES = {
+  "full": {"rows": 100000, "columns": 6, "cardinality": 1000, "tables": 200, "table_rows": 1000, "repeat": 20},
+  "quick": {"rows": 10000, "columns": 6, "cardinality": 1000, "tables": 50, "table_rows": 500, "repeat": 5}
+}
+TABLE = 'bench/rows'
+CHUNKED_TABLE = 'bench/chunked'
+# The fields of the results' meta which identify the machine they were run on
+MACHINE_KEYS = ['host', 'platform', 'cpus', 'python']
+BUCKET_NAME = 'benchmark'
+
+
+def measure(function, repeat, warmup = 1):
+  '''
+  Call function warmup times, then repeat times, and return the latencies of the timed calls
+  as {"median_ms", "p95_ms"}
+  '''
+  for _ in range(warmup):
+    function()
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    function()
+    times.append((time.perf_counter() - start) * 1000)
+  times.sort()
+  return {"median_ms": statistics.median(times), "p95_ms": times[min(len(times) - 1, int(round(0.95 * (len(times) - 1))))]}
+
+
+def run_cold_start(sizes, latency):
+  '''
+  The time to register sizes["tables"] tables from the bucket, lazily and eagerly
+  '''
+  from sdtp import TableServer
+  from catalog_sync import CatalogSync
+  blobs = {
+    f'gcstables/bench/table_{i:05d}.sdml': make_table(sizes["table_rows"], sizes["columns"], cardinality = sizes["cardinality"], seed = i)
+    for i in range(sizes["tables"])
+  }
+  results = {}
+  for bucket_latency in sorted({0.0, latency}):
+    bucket = FakeStorageBucket(BUCKET_NAME, blobs, bucket_latency)
+    for lazy in [True, False]:
+      def cold_start():
+        sync = CatalogSync(bucket, TableServer(), 'gcstables/', lazy = lazy, interval = 0)
+        timings = sync.sync()
+        if timings["failed"] > 0:
+          raise RuntimeError(f'{timings["failed"]} tables failed to load')
+      key = f'cold_start/{"lazy" if lazy else "eager"}/latency_{int(bucket_latency * 1000)}ms'
+      results[key] = measure(cold_start, max(3, sizes["repeat"] // 4))
+  return results
+
+
+def make_app(sizes):
+  '''
+  Import the wiki with a FakeStorageBucket holding the benchmark tables, with the filter and
+  response caches off, and return (main module, test client, table)
+  '''
+  from row_groups import upload_row_groups
+  table = make_table(sizes["rows"], sizes["columns"], cardinality = sizes["cardinality"])
+  bucket = FakeStorageBucket(BUCKET_NAME, {f'gcstables/{TABLE}.sdml': table})
+  upload_row_groups(bucket, CHUNKED_TABLE, table["schema"], io.BytesIO(to_sdml(table)), uploads = [{
+    "prefix": "gcstables", "name": CHUNKED_TABLE,
+    "table": {"schema": table["schema"], "type": "ChunkedGCSTable", "bucket": BUCKET_NAME, "manifest": f'rowgroups/{CHUNKED_TABLE}.json'}
+  }])
+  environment = {
+    "APP_SECRET": "benchmark", "ROOT_URL": "http://localhost", "CLIENT_ID": "none", "CLIENT_SECRET": "none",
+    "BUCKET_NAME": BUCKET_NAME, "TABLE_PREFIX": "gcstables/", "CATALOG_SYNC_INTERVAL": "0",
+    "FILTER_CACHE_BYTES": "0", "RESPONSE_CACHE_BYTES": "0", "CHUNK_MIN_ROWS": "0"
+  }
+  os.environ.update(environment)
+  import gcs_interface
+  gcs_interface.SDMLStorageBucket = lambda bucket_name: bucket
+  import main
+  logging.getLogger().setLevel(logging.WARNING)
+  main.create_app(start_worker = False)
+  return (main, main.app.test_client(), table)
+
+
+def _get(client, url):
+  response = client.get(url)
+  if response.status_code != 200:
+    raise RuntimeError(f'{url} returned {response.status_code}')
+
+
+def run_filter(app, sizes):
+  '''
+  The latency of /filter_table for each SDQL operator, over the RowTable and the row-group table
+  '''
+  (_, client, table) = app
+  results = {}
+  for (operator, filter_spec) in make_filters(table["schema"], sizes["cardinality"]).items():
+    for (layout, table_name) in [('rows', TABLE), ('chunked', CHUNKED_TABLE)]:
+      url = f'/filter_table?table={table_name}&filter={json.dumps(filter_spec)}'
+      results[f'filter/{layout}/{operator}'] = measure(lambda: _get(client, url), sizes["repeat"])
+  return results
+
+
+def run_page_render(app, sizes):
+  '''
+  The latency of /view_table for the first, a middle, and the last page of the RowTable
+  '''
+  (_, client, _) = app
+  offsets = {"first": 0, "middle": sizes["rows"] // 2, "last": sizes["rows"] - 20}
+  return {
+    f'page_render/{name}': measure(lambda: _get(client, f'/view_table?table={TABLE}&offset={offset}&limit=20'), sizes["repeat"])
+    for (name, offset) in offsets.items()
+  }
+
+
+def run_upload(app, sizes):
+  '''
+  The throughput of /upload, for the table as SDML and as CSV
+  '''
+  (main, client, table) = app
+  with client.session_transaction() as session:
+    session['email'] = 'benchmark@berkeley.edu'
+    session['user'] = 'benchmark'
+  results = {}
+  for (extension, data) in [('sdml', to_sdml(table)), ('csv', to_csv(table))]:
+    def upload():
+      response = client.post('/upload', data = {'file': (io.BytesIO(data), f'table_{extension}.{extension}')}, content_type = 'multipart/form-data')
+      # A successful upload redirects to the new table's page; a failed one, back to the form
+      if response.status_code != 302 or '/view_table' not in response.location:
+        raise RuntimeError(f'Upload of the {extension} file failed')
+    latency = measure(upload, max(3, sizes["repeat"] // 4))
+    seconds = latency["median_ms"] / 1000
+    results[f'upload/{extension}'] = dict(latency, rows_per_s = sizes["rows"] / seconds, mb_per_s = len(data) / 1024 ** 2 / seconds)
+  main.stats_executor.shutdown(wait = True)
+  return results
+
+
+def _git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+  except OSError:
+    return None
+
+
+def same_machine(meta, baseline_meta):
+  '''
+  Return True if the results described by meta were run on the machine baseline_meta describes
+  '''
+  return all(meta.get(key) == baseline_meta.get(key) for key in MACHINE_KEYS)
+
+
+def compare(results, baseline, threshold):
+  '''
+  Compare results with baseline.  Returns a list of (benchmark, metric, baseline value, value,
+  relative change, regressed), for the metrics in both; metrics ending in _ms are better
+  lower, and those ending in _per_s better higher
+  '''
+  comparison = []
+  for (benchmark, metrics) in sorted(results.items()):
+    for (metric, value) in sorted(metrics.items()):
+      base = baseline.get(benchmark, {}).get(metric)
+      if base is None or base == 0:
+        continue
+      change = (value - base) / base
+      if metric.endswith('_ms'):
+        regressed = change > threshold
+      elif metric.endswith('_per_s'):
+        regressed = change < -threshold
+      else:
+        continue
+      comparison.append((benchmark, metric, base, value, change, regressed))
+  return comparison
+
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Benchmarks of the wiki server\'s hot paths')
+  parser.add_argument('--scenarios', default = ','.join(SCENARIOS), help = f'comma-separated scenarios, from {SCENARIOS}')
+  parser.add_argument('--quick', action = 'store_true', help = 'run with small tables and few repeats')
+  parser.add_argument('--latency', type = float, default = 0.03, help = 'seconds per bucket request in the cold start scenario')
+  parser.add_argument('--output', help = 'write the results to this JSON file')
+  parser.add_argument('--baseline', help = 'compare the results with this JSON file of results')
+  parser.add_argument('--threshold', type = float, default = 0.25, help = 'the relative change which counts as a regression')
+  parser.add_argument('--save-baseline', help = 'write the results to this JSON file, as a baseline')
+  parser.add_argument('--fail-on-regression', action = 'store_true', help = 'exit with status 1 if there is a regression against a baseline from this machine')
+  args = parser.parse_args()
+  scenarios = args.scenarios.split(',')
+  unknown = set(scenarios) - set(SCENARIOS)
+  if len(unknown) > 0:
+    parser.error(f'Unknown scenarios {sorted(unknown)}')
+  sizes = SIZES["quick" if args.quick else "full"]
+
+  results = {}
+  if 'cold_start' in scenarios:
+    results.update(run_cold_start(sizes, args.latency))
+  app_scenarios = [scenario for scenario in scenarios if scenario != 'cold_start']
+  if len(app_scenarios) > 0:
+    app = make_app(sizes)
+    runners = {"filter": run_filter, "page_render": run_page_render, "upload": run_upload}
+    for scenario in app_scenarios:
+      results.update(runners[scenario](app, sizes))
+
+  for (benchmark, metrics) in sorted(results.items()):
+    print(f'{benchmark:<40} ' + '  '.join(f'{metric} {value:10.2f}' for (metric, value) in sorted(metrics.items())))
+  document = {
+    "meta": {
+      "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+      "commit": _git_commit(),
+      "host": platform.node(),
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "cpus": os.cpu_count(),
+      "sizes": sizes,
+      "latency": args.latency
+    },
+    "results": results
+  }
+  for path in [args.output, args.save_baseline]:
+    if path is not None:
+      with open(path, 'w') as output:
+        json.dump(document, output, indent = 2)
+
+  if args.baseline is not None:
+    with open(args.baseline) as baseline_file:
+      baseline = json.load(baseline_file)
+    if baseline["meta"]["sizes"] != sizes:
+      print(f'The baseline was run with sizes {baseline["meta"]["sizes"]}, not {sizes}; not comparing')
+      sys.exit(2)
+    comparison = compare(results, baseline["results"], args.threshold)
+    comparable = same_machine(document["meta"], baseline["meta"])
+    print(f'\nCompared with {args.baseline} (commit {baseline["meta"].get("commit")}), threshold {args.threshold:.0%}:')
+    if not comparable:
+      print(f'The baseline was recorded on another machine ({", ".join(str(baseline["meta"].get(key)) for key in MACHINE_KEYS)}), so the ratios are only a rough guide')
+    for (benchmark, metric, base, value, change, regressed) in comparison:
+      print(f'{"REGRESSION" if regressed else "":<11}{benchmark:<40} {metric:<10} {base:10.2f} -> {value:10.2f} (x{value / base:.2f})')
+    if args.fail_on_regression and comparable and any(entry[-1] for entry in comparison):
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
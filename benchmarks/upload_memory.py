@@ -0,0 +1,101 @@
+'''
+Peak memory of the upload pipeline as the size of the uploaded SDML file grows.
+For each file size, a synthetic RowTable SDML file is written to a temporary directory,
+and a fresh Python process runs one of two pipelines on it:
+  buffered: make_SDMLTable_from_upload followed by json.dumps (the old upload path)
+  streaming: read_SDML_header followed by a chunked upload of the stream
+Uploads go to a stand-in for the bucket which reads the stream one chunk at a time and
+discards it, so no network access or credentials are needed.  The peak RSS of each
+run, less the RSS of the process before the pipeline ran, is printed as a table.
+Usage:
+  python benchmarks/upload_memory.py [--sizes 16,64,256] (sizes in MB)
+'''
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class DiscardingBucket:
+  '''
+  Stands in for SDMLStorageBucket: reads uploaded streams in chunks and throws them away
+  '''
+  def upload_table(self, prefix, table_dictionary):
+    json.dumps(table_dictionary['table'])
+
+  def upload_table_stream(self, prefix, table_name, stream):
+    stream.seek(0)
+    while len(stream.read(CHUNK_SIZE)) > 0:
+      pass
+
+
+def write_sdml_file(path, megabytes):
+  '''
+  Write a RowTable SDML file of about megabytes MB to path
+  '''
+  row = '[12345, "some string value", 3.14159, "2024-01-01"]'
+  rows_needed = megabytes * 1024 * 1024 // (len(row) + 2)
+  schema = [
+    {"name": "id", "type": "number"}, {"name": "label", "type": "string"},
+    {"name": "value", "type": "number"}, {"name": "day", "type": "date"}
+  ]
+  with open(path, 'w') as sdml_file:
+    sdml_file.write(f'{{"type": "RowTable", "schema": {json.dumps(schema)}, "rows": [')
+    sdml_file.write(', '.join(row for _ in range(rows_needed)))
+    sdml_file.write(']}')
+
+
+def _peak_rss_mb():
+  # Peak RSS of this process in MB (ru_maxrss is in KB on Linux)
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_pipeline(mode, path):
+  '''
+  Run the upload pipeline mode on the file at path, and return the growth in peak RSS, in MB
+  '''
+  from werkzeug.datastructures import FileStorage
+  from uploader import make_SDMLTable_from_upload, read_SDML_header
+  bucket = DiscardingBucket()
+  valid_types = {'RowTable'}
+  start = _peak_rss_mb()
+  with open(path, 'rb') as stream:
+    uploaded_file = FileStorage(stream = stream, filename = 'benchmark.sdml')
+    if mode == 'buffered':
+      bucket.upload_table('rowtables', make_SDMLTable_from_upload(uploaded_file, valid_types))
+    else:
+      table_dictionary = read_SDML_header(uploaded_file, valid_types)
+      bucket.upload_table_stream('rowtables', table_dictionary['name'], uploaded_file.stream)
+  return _peak_rss_mb() - start
+
+
+def main():
+  parser = argparse.ArgumentParser(description = 'Peak RSS of the buffered and streaming upload pipelines')
+  parser.add_argument('--sizes', default = '16,64,256', help = 'comma-separated file sizes, in MB')
+  parser.add_argument('--child', nargs = 2, metavar = ('MODE', 'PATH'), help = argparse.SUPPRESS)
+  args = parser.parse_args()
+  if args.child is not None:
+    print(run_pipeline(*args.child))
+    return
+  print(f'{"size (MB)":>10} {"buffered (MB)":>14} {"streaming (MB)":>15}')
+  with tempfile.TemporaryDirectory() as directory:
+    for size in [int(size) for size in args.sizes.split(',')]:
+      path = os.path.join(directory, f'table_{size}.sdml')
+      write_sdml_file(path, size)
+      results = {}
+      for mode in ['buffered', 'streaming']:
+        output = subprocess.run([sys.executable, __file__, '--child', mode, path], capture_output = True, text = True, check = True)
+        results[mode] = float(output.stdout.strip().splitlines()[-1])
+      print(f'{size:>10} {results["buffered"]:>14.1f} {results["streaming"]:>15.1f}')
+      os.remove(path)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,3 +1,27 @@
+'''
+The functional filter language, a compact way of writing SDQL filters, such as
+  ALL([IN_LIST('state', ['CA', 'NV']), IN_RANGE('year', 2000, 2010)])
+A filter is a call of one of the SDQL operators:
+  IN_LIST(column, values), IN_RANGE(column, min_val, max_val), REGEX_MATCH(column, expression),
+  ALL(filters), ANY(filters), NONE(filters)
+where the arguments may be given by position or by name (IN_RANGE('year', min_val = 2000, max_val = 2010)),
+values are strings (single- or double-quoted), numbers, true/false (or True/False), or lists,
+and the filters of ALL, ANY and NONE are a list or the arguments themselves (ALL(f, g)).
+parse_filter compiles a filter to its SDQL dictionary with a tokenizer and a recursive-descent
+parser, never evaluating the text as Python; a syntax error raises a FilterSyntaxError which
+gives the position of the error, as does a filter nested more than MAX_FILTER_DEPTH deep.
+Compiled filters are cached, so a filter which is requested again (as when paging through
+its results) isn't parsed again.
+'''
+import functools
+import re
+
+from sdtp import InvalidDataException
+
+# The number of compiled filters kept by parse_filter
+FILTER_CACHE_SIZE = 1024
+# The deepest nesting of filters and lists parse_filter accepts, well within Python's recursion limit
+MAX_FILTER_DEPTH = 100
 
 
 def IN_LIST(column, value_list):
@@ -7,7 +31,7 @@ def IN_RANGE(column, min_val, max_val):
   return {"operator": "IN_RANGE", "column": column, "min_val": min_val, "max_val": max_val}
 
 def REGEX_MATCH(column, expression):
-  return {"operator": "ANY", "column": column, "expression": expression}
+  return {"operator": "REGEX_MATCH", "column": column, "expression": expression}
 
 def ANY(filter_list):
   return {"operator": 'ANY', "arguments": filter_list}
@@ -18,13 +42,241 @@ def ALL(filter_list):
 def NONE(filter_list):
   return {"operator": 'NONE', "arguments": filter_list}
 
-# f = eval("IN_LIST('a', [1, '2', 3, ('1', 'x')])")
-# g = eval("ALL([IN_LIST('a', ['b', 'v']), IN_RANGE('b', 1, 2)])")
+# The builder and the parameter names of each operator
+OPERATORS = {
+  "IN_LIST": (IN_LIST, ('column', 'values')),
+  "IN_RANGE": (IN_RANGE, ('column', 'min_val', 'max_val')),
+  "REGEX_MATCH": (REGEX_MATCH, ('column', 'expression')),
+  "ANY": (ANY, ('arguments',)),
+  "ALL": (ALL, ('arguments',)),
+  "NONE": (NONE, ('arguments',))
+}
+COMPOUND_OPERATORS = {'ANY', 'ALL', 'NONE'}
+CONSTANTS = {"true": True, "True": True, "false": False, "False": False}
+
+
+class FilterSyntaxError(InvalidDataException):
+  '''
+  A syntax error in a filter.  position is the offset in the text of the error
+  '''
+  def __init__(self, message, text, position):
+    super(FilterSyntaxError, self).__init__(f'{message} at position {position}: {text[:position]} ^ {text[position:]}')
+    self.position = position
+
+
+TOKEN_PATTERN = re.compile(r'''
+  (?P<space>\s+)
+  | (?P<number>-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+  | (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<name>[A-Za-z_][A-Za-z_0-9]*)
+  | (?P<punctuation>[()\[\],=])
+''', re.VERBOSE | re.DOTALL)
+# The escapes of Python string literals which are replaced in strings; as in Python, a
+# backslash before any other character is kept, so regular expressions such as '\d+\.csv' are unchanged
+ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "a": "\a", "b": "\b", "f": "\f", "v": "\v", "\\": "\\", "'": "'", '"': '"', "\n": ""}
+
+
+def tokenize(text):
+  '''
+  The tokens of text, as a list of (kind, value, position); kind is "number", "string", "name",
+  or the punctuation character, and the list ends with an ("end", None, len(text)) token
+  '''
+  tokens = []
+  position = 0
+  while position < len(text):
+    match = TOKEN_PATTERN.match(text, position)
+    if match is None:
+      if text[position] in '\'"':
+        raise FilterSyntaxError('Unterminated string', text, position)
+      raise FilterSyntaxError(f'Unexpected character {text[position]!r}', text, position)
+    kind = match.lastgroup
+    value = match.group()
+    if kind == 'number':
+      tokens.append(('number', float(value) if any(c in value for c in '.eE') else int(value), position))
+    elif kind == 'string':
+      tokens.append(('string', re.sub(r'\\(.)', lambda escape: ESCAPES.get(escape.group(1), escape.group()), value[1:-1], flags = re.DOTALL), position))
+    elif kind == 'name':
+      tokens.append(('name', value, position))
+    elif kind == 'punctuation':
+      tokens.append((value, value, position))
+    position = match.end()
+  tokens.append(('end', None, len(text)))
+  return tokens
+
+
+class _Parser:
+  # A recursive-descent parser over the tokens of text
+  def __init__(self, text):
+    self.text = text
+    self.tokens = tokenize(text)
+    self.index = 0
+    # The number of filters and lists the parser is inside
+    self.depth = 0
+
+  def error(self, message, token = None):
+    token = token or self.tokens[self.index]
+    return FilterSyntaxError(message, self.text, token[2])
+
+  def peek(self):
+    return self.tokens[self.index]
+
+  def next(self):
+    token = self.tokens[self.index]
+    self.index += 1
+    return token
+
+  def expect(self, kind):
+    token = self.next()
+    if token[0] != kind:
+      raise self.error(f'Expected {kind!r}, found {self._describe(token)}', token)
+    return token
+
+  def _describe(self, token):
+    return 'the end of the filter' if token[0] == 'end' else repr(token[1])
+
+  def parse(self):
+    result = self.filter()
+    if self.peek()[0] != 'end':
+      raise self.error(f'Unexpected {self._describe(self.peek())} after the filter')
+    return result
+
+  def filter(self):
+    # filter := NAME '(' [argument (',' argument)*] ')'
+    token = self.next()
+    if token[0] != 'name' or token[1] not in OPERATORS:
+      raise self.error(f'Expected one of {", ".join(OPERATORS)}, found {self._describe(token)}', token)
+    operator = token[1]
+    (builder, parameters) = OPERATORS[operator]
+    self.expect('(')
+    positional = []
+    named = {}
+    while self.peek()[0] != ')':
+      argument_token = self.peek()
+      if argument_token[0] == 'name' and self.tokens[self.index + 1][0] == '=':
+        self.index += 2
+        if argument_token[1] not in parameters:
+          raise self.error(f'{operator} has no argument {argument_token[1]}; its arguments are {", ".join(parameters)}', argument_token)
+        if argument_token[1] in named:
+          raise self.error(f'Argument {argument_token[1]} given twice', argument_token)
+        named[argument_token[1]] = (self.value(), argument_token)
+      elif len(named) > 0:
+        raise self.error('Positional argument after a named argument', argument_token)
+      else:
+        positional.append((self.value(), argument_token))
+      if self.peek()[0] != ')':
+        self.expect(',')
+    close = self.expect(')')
+    if operator in COMPOUND_OPERATORS and len(named) == 0 and not (len(positional) == 1 and isinstance(positional[0][0], list)):
+      # ALL(f, g) is ALL([f, g])
+      positional = [([argument for (argument, _) in positional], close)]
+    if len(positional) > len(parameters):
+      raise self.error(f'{operator} takes {len(parameters)} arguments, but was given {len(positional)}', positional[len(parameters)][1])
+    arguments = dict(zip(parameters, positional))
+    for (name, argument) in named.items():
+      if name in arguments:
+        raise self.error(f'Argument {name} given twice', argument[1])
+      arguments[name] = argument
+    missing = [name for name in parameters if name not in arguments]
+    if len(missing) > 0:
+      raise self.error(f'{operator} is missing {", ".join(missing)}', close)
+    self._check(operator, arguments)
+    return builder(*[arguments[name][0] for name in parameters])
+
+  def _check(self, operator, arguments):
+    # Check the types of the arguments of operator
+    for (name, (value, token)) in arguments.items():
+      if name in ('column', 'expression') and not isinstance(value, str):
+        raise self.error(f'The {name} of {operator} must be a string', token)
+      if name == 'values' and not isinstance(value, list):
+        raise self.error(f'The values of {operator} must be a list', token)
+      if name in ('min_val', 'max_val') and isinstance(value, (list, dict)):
+        raise self.error(f'The {name} of {operator} must be a single value', token)
+      if name == 'arguments' and not (isinstance(value, list) and all(isinstance(argument, dict) for argument in value)):
+        raise self.error(f'The arguments of {operator} must be filters', token)
+
+  def value(self):
+    # value := filter | '[' [value (',' value)* [',']] ']' | STRING | NUMBER | true | false
+    # Every nested filter and list is parsed through here, so this bounds the depth of the recursion
+    if self.depth >= MAX_FILTER_DEPTH:
+      raise self.error('Filter nested too deeply')
+    self.depth += 1
+    try:
+      return self._value()
+    finally:
+      self.depth -= 1
+
+  def _value(self):
+    token = self.peek()
+    if token[0] in ('string', 'number'):
+      self.index += 1
+      return token[1]
+    if token[0] == 'name' and token[1] in CONSTANTS:
+      self.index += 1
+      return CONSTANTS[token[1]]
+    if token[0] == 'name':
+      return self.filter()
+    if token[0] == '[':
+      self.index += 1
+      values = []
+      while self.peek()[0] != ']':
+        values.append(self.value())
+        if self.peek()[0] != ']':
+          self.expect(',')
+      self.index += 1
+      return values
+    raise self.error(f'Expected a value, found {self._describe(token)}', token)
+
+
+def check_filter_depth(filter_spec):
+  '''
+  Raise an InvalidDataException if filter_spec, an SDQL filter given as JSON, is nested more
+  than MAX_FILTER_DEPTH deep; checked without recursion, before anything recurses over the filter
+  '''
+  stack = [(filter_spec, 0)]
+  while len(stack) > 0:
+    (value, depth) = stack.pop()
+    if depth > MAX_FILTER_DEPTH:
+      raise InvalidDataException('Filter nested too deeply')
+    if isinstance(value, dict):
+      stack.extend((item, depth + 1) for item in value.values())
+    elif isinstance(value, list):
+      stack.extend((item, depth + 1) for item in value)
+
+
+@functools.lru_cache(maxsize = FILTER_CACHE_SIZE)
+def _compile(filter_string):
+  return _Parser(filter_string).parse()
+
+
+def _copy(value):
+  # A copy of a compiled filter, so callers can't change the cached one
+  if isinstance(value, dict):
+    return {key: _copy(item) for (key, item) in value.items()}
+  if isinstance(value, list):
+    return [_copy(item) for item in value]
+  return value
+
+
+def parse_filter(filter_string):
+  '''
+  Compile filter_string, in the functional filter language, to an SDQL filter.
+  Raises a FilterSyntaxError if filter_string isn't a filter.  The result is
+  syntactically an SDQL filter; whether it's valid for a table is checked by sdtp.
+  Arguments:
+    filter_string: the text of the filter
+  Returns:
+    The SDQL filter, as a dictionary
+  '''
+  return _copy(_compile(filter_string.strip()))
+
 
 def create_filter(filter_string):
-  if filter_string is None or len(filter_string) == 0:
+  '''
+  Compile filter_string as parse_filter does, but return None if it's empty or not a filter
+  '''
+  if filter_string is None or len(filter_string.strip()) == 0:
     return None
   try:
-    return eval(filter_string)
-  except Exception:
-    return None
\ No newline at end of file
+    return parse_filter(filter_string)
+  except FilterSyntaxError:
+    return None
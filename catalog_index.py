@@ -0,0 +1,137 @@
+'''
+An index of the tables being served, for listing and searching the catalog without
+scanning every table name.  Table names are <owner>/<table> (uploads are named by the
+uploading user), and are kept in a sorted list, so the tables of an owner, or under any
+other name prefix, are a contiguous range found by binary search.  For search, the
+names and the column names of each table are split into lowercase words, with an inverted
+index from each word to the tables using it; the words are also kept sorted, so a search
+term matches every word it is a prefix of ("temp" finds "temperature").  A table matches a
+query if it matches all of its terms.  The index is updated a table at a time, as tables
+are added, replaced, and removed, and only needs the schema of a table, so indexing a
+lazily-loaded table doesn't load it.
+'''
+import bisect
+import re
+import threading
+
+WORD_PATTERN = re.compile(r'[a-z0-9]+')
+# The number of tables in a page of the catalog
+CATALOG_PAGE_SIZE = 100
+
+
+def words(text):
+  '''
+  The lowercase words of text: the runs of letters and digits
+  '''
+  return WORD_PATTERN.findall(text.lower())
+
+
+def _prefix_range(sorted_list, prefix):
+  # The (start, end) of the entries of sorted_list which start with prefix
+  start = bisect.bisect_left(sorted_list, prefix)
+  # Every string with the prefix sorts before prefix followed by the greatest character
+  end = bisect.bisect_left(sorted_list, prefix + '\U0010ffff', start)
+  return (start, end)
+
+
+class CatalogIndex:
+  '''
+  A sorted, searchable index of table names and their column names.  Thread-safe.
+  '''
+  def __init__(self):
+    # The sorted table names, and the entry {"name", "owner", "columns"} of each table
+    self.names = []
+    self.entries = {}
+    # The sorted words, the set of tables using each word, and the words of each table
+    self.words = []
+    self.postings = {}
+    self.table_words = {}
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.names)
+
+  def __contains__(self, table_name):
+    return table_name in self.entries
+
+  def add(self, table_name, schema):
+    '''
+    Add table_name, with schema (a list of columns {"name", "type"}), to the index, replacing
+    any entry it already has
+    '''
+    entry = {
+      "name": table_name,
+      "owner": table_name.split('/', 1)[0] if '/' in table_name else None,
+      "columns": [{"name": column["name"], "type": column["type"]} for column in schema]
+    }
+    table_words = set(words(table_name)).union(*[words(column["name"]) for column in schema])
+    with self.lock:
+      if table_name in self.entries:
+        self._remove(table_name)
+      else:
+        # Tables are usually added in name order, as the bucket lists them, so this is an append
+        bisect.insort(self.names, table_name)
+      self.entries[table_name] = entry
+      self.table_words[table_name] = table_words
+      for word in table_words:
+        if word not in self.postings:
+          self.postings[word] = set()
+          bisect.insort(self.words, word)
+        self.postings[word].add(table_name)
+
+  def remove(self, table_name):
+    '''
+    Remove table_name from the index, if it's there
+    '''
+    with self.lock:
+      if table_name in self.entries:
+        self._remove(table_name)
+        del self.entries[table_name]
+        del self.names[bisect.bisect_left(self.names, table_name)]
+
+  def _remove(self, table_name):
+    # Remove the words of table_name from the inverted index; called with the lock held
+    for word in self.table_words.pop(table_name):
+      tables = self.postings[word]
+      tables.discard(table_name)
+      if len(tables) == 0:
+        del self.postings[word]
+        del self.words[bisect.bisect_left(self.words, word)]
+
+  def _matching(self, term):
+    # The tables with a word which starts with term
+    (start, end) = _prefix_range(self.words, term)
+    if end - start == 1:
+      return self.postings[self.words[start]]
+    return set().union(*[self.postings[word] for word in self.words[start:end]])
+
+  def search(self, query = None, prefix = None, offset = 0, limit = CATALOG_PAGE_SIZE):
+    '''
+    Find the tables whose names start with prefix and which match every word of query.
+    Arguments:
+      query: the search terms, or None (or empty) to match every table
+      prefix: a table name prefix, such as an owner followed by '/', or None for every table
+      offset: the index, in the matching tables, of the first one to return
+      limit: the maximum number of tables to return
+    Returns:
+      (names, total): the names of the matching tables offset..offset + limit - 1, in name order,
+      and the number of matching tables
+    '''
+    terms = words(query) if query else []
+    with self.lock:
+      (start, end) = _prefix_range(self.names, prefix) if prefix else (0, len(self.names))
+      if len(terms) == 0:
+        return (self.names[start + offset:min(end, start + offset + limit)], end - start)
+      # Intersect the smallest sets first
+      matches = sorted((self._matching(term) for term in terms), key = len)
+      found = set(matches[0]).intersection(*matches[1:])
+    if prefix:
+      found = [name for name in found if name.startswith(prefix)]
+    names = sorted(found)
+    return (names[offset:offset + limit], len(names))
+
+  def entry(self, table_name):
+    '''
+    The entry {"name", "owner", "columns"} of table_name, or None if it isn't indexed
+    '''
+    return self.entries.get(table_name)
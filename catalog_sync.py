@@ -0,0 +1,149 @@
+'''
+Incremental synchronization of the table catalog with the bucket.  Rather than listing the
+bucket once at startup, a CatalogSync lists the table blobs (with a server-side prefix, a
+page at a time) and compares each blob's generation with the generation it registered:
+  a blob that hasn't been seen is downloaded and its table added
+  a blob whose generation has changed is downloaded and its table replaced
+  a table whose blob has gone is removed
+Only the tables that changed are downloaded.  The first sync registers every table, and
+returns the same timings as table_loader.load_tables_from_bucket.  After that, start()
+runs a sync every interval seconds on a daemon thread, so request threads never wait on
+the bucket; a table is replaced in the table server with a single assignment, so
+requests see either the old table or the new one.
+'''
+import logging
+import threading
+import time
+
+from sdtp import InvalidDataException
+from table_loader import DEFAULT_LOAD_WORKERS, table_key, register_table
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SYNC_INTERVAL = 60
+
+
+class CatalogSync:
+  '''
+  Keeps the tables registered with table_server in step with the table blobs in bucket.
+  Arguments:
+    bucket: an SDMLStorageBucket (or a stand-in, such as memory_bucket.MemoryStorageBucket)
+    table_server: the sdtp TableServer to register the tables with
+    prefix: only sync blobs whose names start with prefix; if None, sync all tables
+    lazy: if True, tables are built on first access rather than when they are synced
+    max_workers: the maximum number of concurrent downloads
+    interval: the number of seconds between syncs on the background thread
+    on_change: an optional function on_change(table_name, generation), called for each table which is
+      added or replaced (with the generation of its blob) or removed (with generation None)
+  '''
+  def __init__(self, bucket, table_server, prefix = None, lazy = True, max_workers = DEFAULT_LOAD_WORKERS,
+               interval = DEFAULT_SYNC_INTERVAL, on_change = None):
+    self.bucket = bucket
+    self.table_server = table_server
+    self.prefix = prefix
+    self.lazy = lazy
+    self.max_workers = max(1, max_workers)
+    self.interval = interval
+    self.on_change = on_change
+    # {blob_name: generation} of the blobs registered, and of the blobs which failed to load;
+    # a failed blob is only retried when it is rewritten
+    self.generations = {}
+    self.failed = {}
+    self.sync_lock = threading.Lock()
+    self.stop_event = threading.Event()
+    self.thread = None
+    self.last_sync = None
+
+  def sync(self):
+    '''
+    List the bucket, and add, replace, and remove tables to match it.  Syncs don't overlap:
+    a sync waits for any sync in progress to finish.
+    Returns:
+      A dictionary of the timings, in seconds, for each phase ("list", "download", "register", "total"),
+      with the counts of tables "added", "replaced", "removed", and "failed", and "tables", the number registered
+    '''
+    with self.sync_lock:
+      start = time.perf_counter()
+      listing = self.bucket.get_table_generations(self.prefix)
+      listed = time.perf_counter()
+
+      changed = [
+        blob_name for (blob_name, generation) in listing.items()
+        if self.generations.get(blob_name) != generation and self.failed.get(blob_name) != generation
+      ]
+      removed = [blob_name for blob_name in self.generations if blob_name not in listing]
+      downloads = self.bucket.get_tables_as_dictionaries(changed, self.max_workers)
+      downloaded = time.perf_counter()
+
+      counts = {"added": 0, "replaced": 0, "removed": 0, "failed": 0}
+      for (blob_name, table_spec, error) in downloads:
+        name = table_key(blob_name, self.prefix)
+        replacing = blob_name in self.generations
+        if error is None:
+          try:
+            register_table(self.table_server, name, table_spec, self.lazy, self.bucket, blob_name)
+            self.generations[blob_name] = listing[blob_name]
+            self.failed.pop(blob_name, None)
+            counts["replaced" if replacing else "added"] += 1
+            self._changed(name, listing[blob_name])
+            continue
+          except InvalidDataException as e:
+            error = e
+        # A table which no longer loads keeps its last good version
+        self.failed[blob_name] = listing[blob_name]
+        counts["failed"] += 1
+        logger.warning(f'Table {blob_name} not loaded: {error}')
+
+      for blob_name in removed:
+        name = table_key(blob_name, self.prefix)
+        self.table_server.servers.pop(name, None)
+        del self.generations[blob_name]
+        counts["removed"] += 1
+        self._changed(name, None)
+      self.failed = {blob_name: generation for (blob_name, generation) in self.failed.items() if blob_name in listing}
+      registered = time.perf_counter()
+
+    timings = {
+      "list": listed - start,
+      "download": downloaded - listed,
+      "register": registered - downloaded,
+      "total": registered - start,
+      "tables": len(self.generations),
+      **counts
+    }
+    self.last_sync = timings
+    if len(changed) + len(removed) > 0:
+      logger.info(f'Catalog sync: {counts["added"]} added, {counts["replaced"]} replaced, {counts["removed"]} removed, {counts["failed"]} failed ({"lazy" if self.lazy else "eager"}) in {timings["total"]:.3f}s: list {timings["list"]:.3f}s, download {timings["download"]:.3f}s, register {timings["register"]:.3f}s')
+    return timings
+
+  def _changed(self, name, generation):
+    # Tell on_change that table name was added, replaced, or removed
+    if self.on_change is not None:
+      self.on_change(name, generation)
+
+  def start(self):
+    '''
+    Start syncing every interval seconds on a daemon thread.  Errors in a sync are logged, and the next sync goes ahead
+    '''
+    if self.thread is not None:
+      return
+    self.stop_event.clear()
+    self.thread = threading.Thread(target = self._run, name = 'catalog-sync', daemon = True)
+    self.thread.start()
+
+  def stop(self):
+    '''
+    Stop the background thread, waiting for a sync in progress to finish
+    '''
+    self.stop_event.set()
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+
+  def _run(self):
+    # The loop of the background thread
+    while not self.stop_event.wait(self.interval):
+      try:
+        self.sync()
+      except Exception as e:
+        logger.exception(f'Catalog sync failed: {e}')
@@ -0,0 +1,467 @@
+'''
+A local, on-disk columnar cache of the RowTable blobs behind GCSTables.  The first time
+a blob is used, it is downloaded, decoded, and written to the cache directory as one
+NumPy array per column:
+  number: int64 if every value is an integer, float64 otherwise
+  boolean: bool
+  date: datetime64[D]
+  datetime: datetime64[us] (timezone-aware datetimes are dictionary-encoded)
+  string, timeofday: dictionary-encoded, as int32 codes into a sorted dictionary of the distinct values
+The arrays are memory-mapped when they are read, so every worker process on a host
+shares a single copy of the data through the page cache.  The secondary indexes named
+in a GCSTable's "indexes" field (see table_index) are built when the table is loaded.  Cache entries are keyed
+on the blob's generation, so a blob which has been replaced in the bucket is never
+served from a stale copy.  A loaded table checks the blob's generation every
+revalidate_interval seconds (COLUMNAR_REVALIDATE_INTERVAL in main), and if the bucket can't
+be reached, goes on serving the generation it has.  A blob whose columns can't be encoded
+without changing their values (such as a column of strings, booleans, dates or integers with
+missing values) is served as a RowTable instead.
+'''
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from sdtp import SDMLTable, SDMLTableFactory, RowTable, InvalidDataException
+from sdtp import jsonifiable_column, convert_list_to_type
+from sdtp.sdtp_table import ReloadableTable
+from vector_filter import filter_indices
+from table_index import build_index, check_index_spec
+from metrics import STAGE_SECONDS
+from row_groups import typed_rows, json_rows
+
+logger = logging.getLogger(__name__)
+
+# How often, in seconds, a loaded table checks the bucket for a new generation of its blob
+DEFAULT_REVALIDATE_INTERVAL = 30
+# The number of rows decoded at a time when iterating over a ColumnarTable
+ROW_BLOCK_SIZE = 4096
+
+DICTIONARY_ENCODING = 'dictionary'
+
+
+def _missing(value):
+  # True if value is a missing value, as row_groups.typed_rows reads them: None, or NaN in a number column
+  return value is None or (isinstance(value, float) and value != value)
+
+
+def _encode_column(sdml_type, values):
+  # Encode a list of values of type sdml_type as (encoding, array, dictionary), where
+  # dictionary is None unless the encoding is DICTIONARY_ENCODING.  Raises a ValueError for a
+  # column NumPy can't hold without changing its values: a boolean, date or datetime column
+  # with missing values (stored as False or NaT), or an integer column with missing values
+  # (stored as float64)
+  if sdml_type == 'number':
+    present = [value for value in values if not _missing(value)]
+    if all(type(value) == int for value in present):
+      if len(present) < len(values):
+        raise ValueError('An integer column has missing values')
+      try:
+        return ('int64', np.array(values, dtype = np.int64), None)
+      except OverflowError:
+        pass
+    return ('float64', np.array(values, dtype = np.float64), None)
+  if sdml_type in ('boolean', 'date', 'datetime') and any(value is None for value in values):
+    raise ValueError(f'A {sdml_type} column has missing values')
+  if sdml_type == 'boolean':
+    return ('bool', np.array(values, dtype = np.bool_), None)
+  if sdml_type == 'date':
+    return ('datetime64[D]', np.array(values, dtype = 'datetime64[D]'), None)
+  if sdml_type == 'datetime' and all(value.tzinfo is None for value in values):
+    return ('datetime64[us]', np.array(values, dtype = 'datetime64[us]'), None)
+  dictionary = sorted(set(values))
+  codes = {value: code for (code, value) in enumerate(dictionary)}
+  return (DICTIONARY_ENCODING, np.array([codes[value] for value in values], dtype = np.int32), dictionary)
+
+
+class ColumnarTable(SDMLTable):
+  '''
+  An SDMLTable whose columns are NumPy arrays, normally memory-mapped from a ColumnarCache
+  directory.  Rows are only decoded into Python values when they are returned.
+  Arguments:
+    schema: the schema, as usual
+    columns: a list of NumPy arrays, one per column of the schema, all of the same length
+    encodings: the encoding of each column (see _encode_column)
+    dictionaries: for each column, the sorted list of distinct values if the column is
+      dictionary-encoded, and None otherwise
+  '''
+  def __init__(self, schema, columns, encodings, dictionaries):
+    super(ColumnarTable, self).__init__(schema)
+    self.columns = columns
+    self.encodings = encodings
+    self.dictionaries = dictionaries
+    self.num_rows = len(columns[0]) if len(columns) > 0 else 0
+    # secondary indexes, by column index
+    self.indexes = {}
+
+  def build_indexes(self, index_spec):
+    '''
+    Build the indexes in index_spec, a dictionary {column_name: kind} (see table_index)
+    '''
+    check_index_spec(index_spec, self.schema)
+    for (column_name, kind) in index_spec.items():
+      index = self.column_index(column_name)
+      self.indexes[index] = build_index(kind, self.columns[index])
+
+  def subset(self, selection):
+    '''
+    Return a ColumnarTable (without indexes) of the rows in selection, a slice or an array of row indices
+    '''
+    return ColumnarTable(self.schema, [column[selection] for column in self.columns], self.encodings, self.dictionaries)
+
+  def column_index(self, column_name):
+    '''
+    Return the index of column_name, raising an InvalidDataException if there is no such column
+    '''
+    try:
+      return self.column_names().index(column_name)
+    except ValueError as original_error:
+      raise InvalidDataException(f'{column_name} is not a column of this table') from original_error
+
+  def decode_column(self, index, selection = slice(None)):
+    '''
+    Return the values of column index for the rows in selection (a slice or an array of
+    row indices) as a list of Python values of the column's SDML type
+    '''
+    values = self.columns[index][selection]
+    if self.encodings[index] == DICTIONARY_ENCODING:
+      dictionary = self.dictionaries[index]
+      return [dictionary[code] for code in values.tolist()]
+    return values.tolist()
+
+  def decode_rows(self, selection = slice(None), column_indices = None):
+    '''
+    Return the rows in selection (a slice or an array of row indices) as a list of lists,
+    restricted to column_indices if it is not None
+    '''
+    if column_indices is None:
+      column_indices = range(len(self.schema))
+    decoded = [self.decode_column(index, selection) for index in column_indices]
+    return [list(row) for row in zip(*decoded)]
+
+  def rows(self):
+    '''
+    A read-only sequence view of the rows of this table, which decodes rows as they are used
+    '''
+    return ColumnarRows(self)
+
+  def get_column(self, column_name, jsonify = False):
+    index = self.column_index(column_name)
+    result = self.decode_column(index)
+    return jsonifiable_column(result, self.schema[index]["type"]) if jsonify else result
+
+  def all_values(self, column_name, jsonify = False):
+    index = self.column_index(column_name)
+    distinct = np.unique(self.columns[index])
+    if self.encodings[index] == DICTIONARY_ENCODING:
+      dictionary = self.dictionaries[index]
+      result = [dictionary[code] for code in distinct.tolist()]
+    else:
+      result = distinct.tolist()
+    return jsonifiable_column(result, self.schema[index]["type"]) if jsonify else result
+
+  def range_spec(self, column_name, jsonify = False):
+    index = self.column_index(column_name)
+    column = self.columns[index]
+    if len(column) == 0:
+      return []
+    extremes = np.array([column.min(), column.max()], dtype = column.dtype)
+    if self.encodings[index] == DICTIONARY_ENCODING:
+      result = [self.dictionaries[index][code] for code in extremes.tolist()]
+    else:
+      result = extremes.tolist()
+    return jsonifiable_column(result, self.schema[index]["type"]) if jsonify else result
+
+  def get_filtered_rows_from_filter(self, filter = None, columns = [], jsonify = False):
+    if columns is None: columns = []
+    names = self.column_names()
+    column_indices = [i for i in range(len(names)) if names[i] in columns] if columns != [] else list(range(len(names)))
+    if filter is None:
+      selection = slice(None)
+    else:
+      selection = filter_indices(filter, self)
+      if selection is None:
+        # the filter can't be vectorized, so evaluate it row by row
+        indices = filter.filter_index(self.decode_rows())
+        selection = np.array(sorted(indices), dtype = np.int64)
+    result = self.decode_rows(selection, column_indices)
+    if not jsonify:
+      return result
+    all_types = self.column_types()
+    return json_rows(result, [all_types[i] for i in column_indices])
+
+  def to_dictionary(self):
+    return {
+      "type": "RowTable",
+      "schema": self.schema,
+      "rows": json_rows(self.decode_rows(), self.column_types())
+    }
+
+
+def columnar_table(table):
+  '''
+  Return the ColumnarTable that holds the data of table, or None if table isn't columnar
+  Arguments:
+    table: an SDMLTable
+  '''
+  if isinstance(table, ColumnarGCSTable):
+    inner_table = table.current_table()
+    return inner_table if isinstance(inner_table, ColumnarTable) else None
+  if isinstance(table, ColumnarTable):
+    return table
+  return None
+
+
+class ColumnarRows:
+  '''
+  A read-only sequence of the rows of a ColumnarTable.  Indexing and slicing decode only
+  the rows asked for, and iteration decodes ROW_BLOCK_SIZE rows at a time, so that a
+  scan which stops early never decodes the whole table.
+  '''
+  def __init__(self, table):
+    self.table = table
+
+  def __len__(self):
+    return self.table.num_rows
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      return self.table.decode_rows(key)
+    if key < 0: key += self.table.num_rows
+    if key < 0 or key >= self.table.num_rows:
+      raise IndexError('row index out of range')
+    return self.table.decode_rows(slice(key, key + 1))[0]
+
+  def __iter__(self):
+    for start in range(0, self.table.num_rows, ROW_BLOCK_SIZE):
+      yield from self.table.decode_rows(slice(start, start + ROW_BLOCK_SIZE))
+
+
+class ColumnarCache:
+  '''
+  The on-disk cache.  Each blob is stored in the directory
+  <cache_dir>/<hash of bucket and blob name>/<generation>, with a manifest.json holding the
+  schema and the column encodings, one <i>.npy file per column, and a <i>.json file
+  with the dictionary of each dictionary-encoded column.  Entries are written to a
+  temporary directory and renamed into place, so concurrent workers never see a partial entry.
+  Arguments:
+    cache_dir: the directory holding the cache
+    client: a google.cloud.storage Client used to read the blobs
+  '''
+  def __init__(self, cache_dir, client):
+    self.cache_dir = cache_dir
+    self.client = client
+    os.makedirs(cache_dir, exist_ok = True)
+
+  def _blob_dir(self, bucket_name, blob_name):
+    digest = hashlib.sha1(f'{bucket_name}/{blob_name}'.encode()).hexdigest()
+    return os.path.join(self.cache_dir, digest)
+
+  def current_generation(self, bucket_name, blob_name):
+    '''
+    Return the generation of the blob in the bucket, raising an InvalidDataException if the blob doesn't exist
+    '''
+    try:
+      blob = self.client.bucket(bucket_name).get_blob(blob_name)
+    except Exception as e:
+      raise InvalidDataException(f'Exception {repr(e)} reading blob {blob_name} from {bucket_name}')
+    if blob is None:
+      raise InvalidDataException(f'Blob {blob_name} not found in {bucket_name}')
+    return blob.generation
+
+  def cached_generation(self, bucket_name, blob_name):
+    '''
+    Return the generation of the blob held in the cache, or None if there is none
+    '''
+    blob_dir = self._blob_dir(bucket_name, blob_name)
+    try:
+      names = os.listdir(blob_dir)
+    except OSError:
+      return None
+    generations = [int(name) for name in names if name.isdigit() and os.path.exists(os.path.join(blob_dir, name, 'manifest.json'))]
+    return max(generations) if len(generations) > 0 else None
+
+  def get_table(self, bucket_name, blob_name, generation = None):
+    '''
+    Return the ColumnarTable for generation generation of the blob (the current generation if None),
+    building the cache entry if it isn't present.  If the columns of the blob can't be encoded,
+    the table is a RowTable of the blob's rows, and there is no cache entry.
+    Returns:
+      (table, generation)
+    '''
+    if generation is None:
+      generation = self.current_generation(bucket_name, blob_name)
+    blob_dir = self._blob_dir(bucket_name, blob_name)
+    entry_dir = os.path.join(blob_dir, str(generation))
+    if not os.path.exists(os.path.join(entry_dir, 'manifest.json')):
+      row_table = self._build_entry(bucket_name, blob_name, generation, blob_dir, entry_dir)
+      if row_table is not None:
+        return (row_table, generation)
+    return (self._open_entry(entry_dir), generation)
+
+  def _build_entry(self, bucket_name, blob_name, generation, blob_dir, entry_dir):
+    # Download generation generation of the blob, encode it, and move it into place at entry_dir.
+    # Returns None, or a RowTable of the rows if they can't be encoded
+    try:
+      blob = self.client.bucket(bucket_name).blob(blob_name)
+      table_spec = json.loads(blob.download_as_bytes(if_generation_match = generation))
+      schema = table_spec["schema"]
+      types = [column["type"] for column in schema]
+      rows = typed_rows(types, table_spec["rows"])
+    except Exception as e:
+      raise InvalidDataException(f'Exception {repr(e)} reading generation {generation} of {blob_name} from {bucket_name}')
+    del table_spec
+    os.makedirs(blob_dir, exist_ok = True)
+    build_dir = tempfile.mkdtemp(dir = blob_dir, prefix = '.build-')
+    encodings = []
+    try:
+      for (index, sdml_type) in enumerate(types):
+        (encoding, array, dictionary) = _encode_column(sdml_type, [row[index] for row in rows])
+        np.save(os.path.join(build_dir, f'{index}.npy'), array)
+        if dictionary is not None:
+          with open(os.path.join(build_dir, f'{index}.json'), 'w') as dictionary_file:
+            json.dump(jsonifiable_column(dictionary, sdml_type), dictionary_file)
+        encodings.append(encoding)
+    except (TypeError, ValueError, AttributeError) as e:
+      # e.g., a string or boolean column with missing values (see _encode_column)
+      shutil.rmtree(build_dir, ignore_errors = True)
+      logger.warning(f'Generation {generation} of {blob_name} can\'t be stored in columns ({repr(e)}); serving it as a RowTable')
+      # The rows are already typed, and RowTable would convert the missing values to strings
+      row_table = RowTable(schema, [])
+      row_table.rows = rows
+      return row_table
+    with open(os.path.join(build_dir, 'manifest.json'), 'w') as manifest_file:
+      json.dump({"schema": schema, "encodings": encodings, "rows": len(rows), "generation": generation}, manifest_file)
+    try:
+      os.rename(build_dir, entry_dir)
+    except OSError:
+      # another worker got there first; its entry is identical
+      shutil.rmtree(build_dir, ignore_errors = True)
+    # drop the entries for older generations
+    for name in os.listdir(blob_dir):
+      if name != str(generation) and not name.startswith('.build-'):
+        shutil.rmtree(os.path.join(blob_dir, name), ignore_errors = True)
+    return None
+
+  def _open_entry(self, entry_dir):
+    # Memory-map the columns in entry_dir as a ColumnarTable
+    with open(os.path.join(entry_dir, 'manifest.json')) as manifest_file:
+      manifest = json.load(manifest_file)
+    schema = manifest["schema"]
+    columns = []
+    dictionaries = []
+    for (index, encoding) in enumerate(manifest["encodings"]):
+      columns.append(np.load(os.path.join(entry_dir, f'{index}.npy'), mmap_mode = 'r'))
+      if encoding == DICTIONARY_ENCODING:
+        with open(os.path.join(entry_dir, f'{index}.json')) as dictionary_file:
+          dictionaries.append(convert_list_to_type(schema[index]["type"], json.load(dictionary_file)))
+      else:
+        dictionaries.append(None)
+    return ColumnarTable(schema, columns, manifest["encodings"], dictionaries)
+
+
+class ColumnarGCSTable(ReloadableTable):
+  '''
+  A GCSTable served from a ColumnarCache.  Like a GCSTable, it holds the schema and the location
+  of a RowTable blob; the inner table is the memory-mapped ColumnarTable for the blob.
+  Every revalidate_interval seconds, the table checks whether the blob has a new
+  generation, and if it has, switches to the cache entry for the new generation.  If the
+  check fails, the table goes on serving the generation it has loaded (or the one in the
+  cache, if it hasn't loaded one), and checks again after another revalidate_interval.
+  If the blob's columns can't be encoded, the inner table is a RowTable, without indexes.
+  Arguments:
+    schema: the schema, as usual
+    bucket: the name of the GCS bucket
+    blob: name of the blob with the RowTable
+    cache: the ColumnarCache
+    revalidate_interval: seconds between checks for a new generation of the blob
+    indexes: the indexes to build when the table is loaded, a dictionary {column_name: kind} (see table_index)
+  '''
+  def __init__(self, schema, bucket, blob, cache, revalidate_interval = DEFAULT_REVALIDATE_INTERVAL, indexes = None):
+    super(ColumnarGCSTable, self).__init__(schema, None)
+    self.bucket_name = bucket
+    self.blob_name = blob
+    self.cache = cache
+    self.revalidate_interval = revalidate_interval
+    self.index_spec = indexes if indexes is not None else {}
+    self.generation = None
+    self.validated_at = 0
+    self.load_lock = threading.Lock()
+
+  def load(self):
+    '''
+    Load (or reload) the inner table from the cache entry for the current generation of the blob
+    '''
+    with self.load_lock:
+      try:
+        generation = self.cache.current_generation(self.bucket_name, self.blob_name)
+      except InvalidDataException as e:
+        generation = self.generation if self.inner_table is not None else self.cache.cached_generation(self.bucket_name, self.blob_name)
+        if generation is None:
+          raise
+        logger.warning(f'Serving cached generation {generation} of {self.blob_name}: {e}')
+      if self.inner_table is None or generation != self.generation:
+        with STAGE_SECONDS.time(stage = 'materialize'):
+          (inner_table, generation) = self.cache.get_table(self.bucket_name, self.blob_name, generation)
+          if isinstance(inner_table, ColumnarTable):
+            inner_table.build_indexes(self.index_spec)
+        (self.inner_table, self.generation) = (inner_table, generation)
+      self.validated_at = time.monotonic()
+
+  def current_table(self):
+    '''
+    Return the inner ColumnarTable, loading it if it hasn't been loaded or hasn't been
+    validated against the bucket for revalidate_interval seconds
+    '''
+    if self.inner_table is None or time.monotonic() - self.validated_at > self.revalidate_interval:
+      self.load()
+    return self.inner_table
+
+  def all_values(self, column_name, jsonify = False):
+    return self.current_table().all_values(column_name, jsonify)
+
+  def get_column(self, column_name, jsonify = False):
+    return self.current_table().get_column(column_name, jsonify)
+
+  def range_spec(self, column_name, jsonify = False):
+    return self.current_table().range_spec(column_name, jsonify)
+
+  def get_filtered_rows_from_filter(self, filter = None, columns = [], jsonify = False):
+    return self.current_table().get_filtered_rows_from_filter(filter, columns, jsonify)
+
+  def to_dictionary(self):
+    result = {
+      "schema": self.schema,
+      "type": 'GCSTable',
+      "bucket": self.bucket_name,
+      "blob": self.blob_name
+    }
+    if len(self.index_spec) > 0:
+      result["indexes"] = self.index_spec
+    return result
+
+
+class ColumnarGCSTableFactory(SDMLTableFactory):
+  '''
+  A factory which builds GCSTables as ColumnarGCSTables.  Registering it with the table server
+  replaces the standard GCSTableFactory.
+  Arguments:
+    cache: the ColumnarCache the tables are served from
+    revalidate_interval: seconds between checks for a new generation of a table's blob
+  '''
+  def __init__(self, cache, revalidate_interval = DEFAULT_REVALIDATE_INTERVAL):
+    super(ColumnarGCSTableFactory, self).__init__('GCSTable')
+    self.cache = cache
+    self.revalidate_interval = revalidate_interval
+
+  def build_table(self, table_spec):
+    super(ColumnarGCSTableFactory, self).build_table(table_spec)
+    indexes = table_spec.get('indexes', {})
+    check_index_spec(indexes, table_spec['schema'])
+    return ColumnarGCSTable(table_spec['schema'], table_spec['bucket'], table_spec['blob'], self.cache, self.revalidate_interval, indexes)
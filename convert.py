@@ -1,24 +1,185 @@
+'''
+Conversion of CSV and Excel (.xlsx) files to SDML tables.  The first row of the file holds the
+column names and the second row the SDML type of each column; the remaining rows are data.
+The type row is read first, and the data is then read in chunks of chunk_rows rows, with
+each column converted to a typed NumPy array as it is read (strings are stripped as whole
+columns, not cell by cell).  The result is a ColumnarTable (see columnar_cache), which
+write_sdml streams out as an SDML RowTable file.  Empty number, date and datetime cells are
+missing values, written as null; an empty boolean cell is False.
+'''
+import json
+
+import numpy as np
+import openpyxl
 import pandas as pd
-from sdtp import DataFrameTable, SDTP_SCHEMA_TYPES
 
-def _clean_row(row):
-  return [s.strip() if type(s) == str else s for s in row]
+from sdtp import SDML_SCHEMA_TYPES, InvalidDataException, convert_list_to_type
+from columnar_cache import ColumnarTable, DICTIONARY_ENCODING
+from row_groups import json_rows
+
+DEFAULT_CHUNK_ROWS = 100000
+# The values of a boolean column which are True, and those which are False; see sdtp_utils.convert_to_type
+TRUE_VALUES = ['True', 'true', 't', '1', '1.0']
+FALSE_VALUES = ['False', 'false', 'f', '0', '0.0', '']
+
+
+def _strip(series):
+  # The values of series as stripped strings, with missing values as ''
+  return series.fillna('').astype(str).str.strip()
+
+
+def _check_types(names, types):
+  # Make the schema from the header and type rows, raising an InvalidDataException if a type is invalid
+  if len(types) < len(names):
+    raise InvalidDataException('The file must have a header row and a type row, with a type for every column')
+  types = [str(sdml_type).strip() for sdml_type in types]
+  bad_types = [sdml_type for sdml_type in types if sdml_type not in SDML_SCHEMA_TYPES]
+  if len(bad_types) > 0:
+    raise InvalidDataException(f'Invalid types {bad_types} in the type row.  Valid types are {SDML_SCHEMA_TYPES}')
+  return [{"name": str(names[i]).strip(), "type": types[i]} for i in range(len(names))]
+
+
+def _convert_chunk(series, sdml_type):
+  # Convert a chunk of a column to an array of the column's encoding.  Strings and times of
+  # day are returned as arrays of Python values, and dictionary-encoded when the chunks are joined
+  try:
+    if sdml_type == 'number':
+      if series.dtype == object or pd.api.types.is_string_dtype(series.dtype):
+        series = pd.to_numeric(_strip(series).replace('', np.nan))
+      return series.to_numpy(dtype = np.float64, na_value = np.nan)
+    if sdml_type == 'boolean':
+      if pd.api.types.is_bool_dtype(series.dtype):
+        return series.to_numpy(dtype = np.bool_)
+      values = _strip(series)
+      bad_values = values[~values.isin(TRUE_VALUES + FALSE_VALUES)]
+      if len(bad_values) > 0:
+        raise InvalidDataException(f'{bad_values.iloc[0]} is not a boolean')
+      return values.isin(TRUE_VALUES).to_numpy()
+    if sdml_type == 'date':
+      return pd.to_datetime(_strip(series), format = 'ISO8601').to_numpy(dtype = 'datetime64[D]')
+    if sdml_type == 'datetime':
+      return pd.to_datetime(_strip(series), format = 'ISO8601').to_numpy(dtype = 'datetime64[us]')
+    if sdml_type == 'timeofday':
+      return np.array(convert_list_to_type(sdml_type, _strip(series).tolist()), dtype = object)
+    return _strip(series).to_numpy(dtype = object)
+  except (ValueError, TypeError, InvalidDataException) as e:
+    raise InvalidDataException(f'Error {e} converting column {series.name} to {sdml_type}')
+
+
+def _join_column(chunks, sdml_type):
+  # Join the converted chunks of a column into (encoding, array, dictionary)
+  column = np.concatenate(chunks) if len(chunks) > 0 else np.empty(0)
+  if sdml_type in {'string', 'timeofday'}:
+    (codes, dictionary) = pd.factorize(column, sort = True)
+    return (DICTIONARY_ENCODING, codes.astype(np.int32), list(dictionary))
+  if sdml_type == 'number':
+    integral = column[np.isfinite(column)]
+    if len(integral) == len(column) and np.array_equal(integral, np.round(integral)) and (len(column) == 0 or np.abs(column).max() < 2 ** 53):
+      return ('int64', column.astype(np.int64), None)
+    return ('float64', column.astype(np.float64), None)
+  encodings = {'boolean': 'bool', 'date': 'datetime64[D]', 'datetime': 'datetime64[us]'}
+  return (encodings[sdml_type], column.astype(encodings[sdml_type]), None)
+
+
+def _build_table(schema, chunks):
+  # Convert an iterator of DataFrame chunks with the columns of schema into a ColumnarTable
+  types = [column["type"] for column in schema]
+  converted = [[] for _ in schema]
+  for chunk in chunks:
+    for (index, sdml_type) in enumerate(types):
+      converted[index].append(_convert_chunk(chunk.iloc[:, index], sdml_type))
+  columns = []
+  encodings = []
+  dictionaries = []
+  for (index, sdml_type) in enumerate(types):
+    (encoding, column, dictionary) = _join_column(converted[index], sdml_type)
+    converted[index] = None
+    columns.append(column)
+    encodings.append(encoding)
+    dictionaries.append(dictionary)
+  return ColumnarTable(schema, columns, encodings, dictionaries)
+
+
+def convert_csv(csv_file, chunk_rows = DEFAULT_CHUNK_ROWS):
+  '''
+  Convert a CSV file to a ColumnarTable.  The header row has the column names, and the
+  second row the SDML types.  Raises an InvalidDataException if the types are invalid
+  or a value doesn't convert to its column's type.
+  Arguments:
+    csv_file: a path or a seekable file-like object
+    chunk_rows: the number of rows to read at a time
+  '''
+  try:
+    header = pd.read_csv(csv_file, nrows = 1, dtype = str, keep_default_na = False)
+  except (ValueError, pd.errors.ParserError) as e:
+    raise InvalidDataException(f'Error {e} reading the header of the CSV file')
+  schema = _check_types(list(header.columns), header.iloc[0].tolist() if len(header) > 0 else [])
+  if hasattr(csv_file, 'seek'):
+    csv_file.seek(0)
+  # dtype and na_values are keyed by the column names as they appear in the file
+  names = list(header.columns)
+  dtypes = {names[i]: (np.float64 if column["type"] == 'number' else str) for (i, column) in enumerate(schema)}
+  missing = {names[i]: [''] for (i, column) in enumerate(schema) if column["type"] == 'number'}
+  try:
+    chunks = pd.read_csv(csv_file, skiprows = [1], header = 0, dtype = dtypes, keep_default_na = False,
+                         na_values = missing, chunksize = chunk_rows)
+    return _build_table(schema, chunks)
+  except (ValueError, pd.errors.ParserError) as e:
+    raise InvalidDataException(f'Error {e} reading the CSV file')
+
+
+def _excel_chunks(rows, names, chunk_rows):
+  # Group the rows from an openpyxl worksheet into DataFrames of chunk_rows rows
+  chunk = []
+  for row in rows:
+    chunk.append(row)
+    if len(chunk) == chunk_rows:
+      yield pd.DataFrame(chunk, columns = names, dtype = object)
+      chunk = []
+  if len(chunk) > 0:
+    yield pd.DataFrame(chunk, columns = names, dtype = object)
 
-def _convert_dataframe(df):
-  all_rows = df.values.tolist()
-  rows = [_clean_row(r) for r in all_rows[1:]]
-  types = _clean_row(all_rows[0])
-  schema = [{"name": df.columns[i], "type": types[i]} for i in range(len(types))]
-  df2 = pd.DataFrame(rows, columns=df.columns)
-  return DataFrameTable(schema, df2)
 
-def convert_excel(excel_file):
-  df = pd.read_excel(excel_file)
-  return _convert_dataframe(df)
+def convert_excel(excel_file, chunk_rows = DEFAULT_CHUNK_ROWS):
+  '''
+  Convert the first worksheet of an Excel (.xlsx) file to a ColumnarTable.  The worksheet is
+  read in read-only (streaming) mode.  The header row has the column names, and the second
+  row the SDML types.  Raises an InvalidDataException if the types are invalid or a value
+  doesn't convert to its column's type.
+  Arguments:
+    excel_file: a path or a seekable file-like object
+    chunk_rows: the number of rows to read at a time
+  '''
+  try:
+    workbook = openpyxl.load_workbook(excel_file, read_only = True, data_only = True)
+  except Exception as e:
+    raise InvalidDataException(f'Error {e} reading the Excel file')
+  try:
+    rows = workbook.worksheets[0].iter_rows(values_only = True)
+    names = next(rows, None)
+    types = next(rows, None)
+    if names is None or types is None:
+      raise InvalidDataException('An Excel file must have a header row and a type row')
+    schema = _check_types(list(names), list(types))
+    return _build_table(schema, _excel_chunks(rows, list(names), chunk_rows))
+  finally:
+    workbook.close()
 
-def convert_csv(csv_file):
-  df = pd.read_csv(csv_file)
-  return _convert_dataframe(df)
 
-t = convert_excel('excel/Washington_Electric_Vehicle_Population_Data.xlsx')
-pass
\ No newline at end of file
+def write_sdml(table, output, chunk_rows = DEFAULT_CHUNK_ROWS):
+  '''
+  Write a ColumnarTable to output as an SDML RowTable, chunk_rows rows at a time, so the
+  JSON form of the whole table is never held in memory.  Missing values are written as null.
+  Arguments:
+    table: a ColumnarTable
+    output: a text file-like object
+    chunk_rows: the number of rows to decode and write at a time
+  '''
+  types = table.column_types()
+  output.write(f'{{"type": "RowTable", "schema": {json.dumps(table.schema)}, "rows": [')
+  for start in range(0, table.num_rows, chunk_rows):
+    rows = json_rows(table.decode_rows(slice(start, start + chunk_rows)), types)
+    if start > 0:
+      output.write(', ')
+    output.write(', '.join(json.dumps(row) for row in rows))
+  output.write(']}')
@@ -1,39 +1,166 @@
 from google.cloud import storage
+from google.cloud.storage.retry import DEFAULT_RETRY as STORAGE_RETRY
+from google.api_core import exceptions as api_exceptions
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import AuthorizedSession
+import google.auth
+from concurrent.futures import ThreadPoolExecutor
+import requests
 import json
+import os
 from sdtp import InvalidDataException
+from metrics import STAGE_SECONDS, BUCKET_BYTES
 
+# Chunk size for streamed uploads.  Setting a chunk size makes the client use a
+# resumable upload, sending (and holding) one chunk at a time.  Must be a multiple of 256 KB
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# The prefix of the blobs holding the statistics of each table (see table_stats)
+STATS_PREFIX = 'tablestats'
+SAMPLES_PREFIX = 'tablesamples'
+# The number of blobs in each page of a bucket listing
+LIST_PAGE_SIZE = 1000
+# The maximum number of concurrent requests made by the batch methods; the HTTP connection
+# pool is sized to match, so each concurrent request reuses a connection
+DEFAULT_IO_WORKERS = 16
+# Blobs larger than this are downloaded as concurrent ranged requests of RANGE_CHUNK_SIZE bytes
+RANGED_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+RANGE_CHUNK_SIZE = 16 * 1024 * 1024
+# Transient errors (429, 5xx, connection errors) are retried with exponential backoff:
+# waits of 0.5s, 1s, 2s, ... up to 16s, giving up after 120s
+DEFAULT_RETRY = STORAGE_RETRY.with_delay(initial = 0.5, maximum = 16.0, multiplier = 2.0).with_timeout(120.0)
 
 class SDMLStorageBucket:
   '''
   An object which is the interface to the Google Cloud Storage Bucket holding SDML files 
-  as blobs.  The SDML files should all end with '.sdml' and be valid tables
+  as blobs.  The SDML files should all end with '.sdml' and be valid tables.
+  Every request is retried on transient errors with exponential backoff (retry), and the
+  batch methods get_tables_as_dictionaries and upload_tables make up to max_workers
+  requests at once over a shared pool of HTTP connections.  To run against a local fake
+  GCS server, set STORAGE_EMULATOR_HOST, or pass a client.
+  The bucket makes its own client, over an HTTP session it owns, so that it can size and
+  replace the session's connection pool (see reset_connections).  The size and generation
+  of each table blob are remembered from the listing (get_table_generations), so a table is
+  downloaded without first asking for its metadata.
+  Arguments:
+    bucket_name: the name of the bucket
+    client: a google.cloud.storage.Client; if None, a client with the default credentials is
+      made.  The connections of a client which is passed in are left to it
+    max_workers: the maximum number of concurrent requests made by the batch methods
+    retry: the google.api_core.retry.Retry policy for each request
+    ranged_download_threshold: blobs larger than this many bytes are downloaded as concurrent
+      ranged requests; None turns ranged downloads off
   '''
-  def __init__(self, bucket_name):
+  def __init__(self, bucket_name, client = None, max_workers = DEFAULT_IO_WORKERS, retry = DEFAULT_RETRY,
+               ranged_download_threshold = RANGED_DOWNLOAD_THRESHOLD):
     self.bucket_name = bucket_name
-    self.client = storage.Client()
+    self.max_workers = max(1, max_workers)
+    # The HTTP session of the client, if this bucket made the client
+    self.session = None
+    self.client = self._make_client() if client is None else client
     self.bucket = self.client.bucket(bucket_name)
+    self.retry = retry
+    self.ranged_download_threshold = ranged_download_threshold
+    # {blob_name: (generation, size)} of the blobs seen by get_table_generations
+    self.listed = {}
+    self.reset_connections()
+
+  def _make_client(self):
+    # A client with the default credentials (none for an emulator), making its requests over self.session
+    if os.environ.get('STORAGE_EMULATOR_HOST'):
+      credentials = AnonymousCredentials()
+    else:
+      (credentials, _) = google.auth.default(scopes = storage.Client.SCOPE)
+    self.session = AuthorizedSession(credentials)
+    return storage.Client(credentials = credentials, _http = self.session)
+
+  def reset_connections(self):
+    '''
+    Replace the pool of HTTP connections with a new, empty one.  Called in a process forked
+    after the bucket was used, since connections inherited from the parent can't be shared with it.
+    The pool is sized for max_workers concurrent requests; the default pool of 10
+    connections would otherwise open and discard a connection per extra request.
+    Does nothing if the client was passed in
+    '''
+    if self.session is None:
+      return
+    adapter = requests.adapters.HTTPAdapter(pool_connections = self.max_workers, pool_maxsize = self.max_workers)
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
 
   def get_all_table_names(self, prefix = None):
     '''
     Get the names of all tables stored in the bucket.  Returns a list of blob names
     '''
-    blobs = self.client.list_blobs(self.bucket)
-    names = [blob.name for blob in blobs]
-    names = [name for name in names if name.endswith('.sdml')]
-    if prefix is not None:
-      names = [name for name in names if name.startswith(prefix)]
-    return names
+    return list(self.get_table_generations(prefix).keys())
+
+  def get_table_generations(self, prefix = None, page_size = LIST_PAGE_SIZE):
+    '''
+    Get the names and generations of all tables stored in the bucket whose names start
+    with prefix.  The prefix is applied by the server, and the listing is read a page
+    at a time, with only the name, generation and size of each blob in the response.
+    A blob's generation changes whenever the blob is rewritten.  The generation and size
+    of each blob are remembered for its download.
+    Arguments:
+      prefix: only list blobs whose names start with prefix; if None, list all blobs
+      page_size: the number of blobs in each page of the listing
+    Returns:
+      A dictionary {blob_name: generation} of the .sdml blobs
+    '''
+    with STAGE_SECONDS.time(stage = 'bucket_list'):
+      blobs = self.client.list_blobs(self.bucket, prefix = prefix, page_size = page_size, fields = 'items(name,generation,size),nextPageToken')
+      generations = {}
+      listed = {}
+      for page in blobs.pages:
+        for blob in page:
+          if blob.name.endswith('.sdml'):
+            generations[blob.name] = blob.generation
+            listed[blob.name] = (blob.generation, blob.size)
+    # Blobs under prefix which weren't listed have been deleted
+    self.listed = {blob_name: entry for (blob_name, entry) in self.listed.items() if prefix is not None and not blob_name.startswith(prefix)}
+    self.listed.update(listed)
+    return generations
   
   def _get_json_blob(self, blob_name):
     # A utility to get blob blob_name, whioch is a json file
     # and return it as the Python object.  Worker for get_
     try:
-      blob = self.bucket.blob(blob_name)
-      json_form = blob.download_as_string()
+      json_form = self._download(blob_name)
       result  = json.loads(json_form)
       return result
     except Exception as e:
       raise InvalidDataException(f'Error {repr(e)} reading  {blob_name}')
+
+  def _download(self, blob_name):
+    # Download blob_name as bytes, recording the time and size of the download
+    with STAGE_SECONDS.time(stage = 'bucket_read'):
+      data = self._download_bytes(blob_name)
+    BUCKET_BYTES.observe(len(data), operation = 'read')
+    return data
+
+  def _download_bytes(self, blob_name):
+    # Download blob_name as bytes, in a single request unless the listing showed it to be larger
+    # than ranged_download_threshold, when it is fetched as concurrent ranged requests pinned
+    # to the listed generation.  If the blob has been rewritten since, it is fetched whole
+    (generation, size) = self.listed.get(blob_name, (None, None))
+    blob = self.bucket.blob(blob_name)
+    if self.ranged_download_threshold is None or size is None or size <= self.ranged_download_threshold:
+      return blob.download_as_bytes(retry = self.retry)
+    ranges = [(start, min(start + RANGE_CHUNK_SIZE, size) - 1) for start in range(0, size, RANGE_CHUNK_SIZE)]
+    try:
+      with ThreadPoolExecutor(max_workers = min(self.max_workers, len(ranges))) as executor:
+        parts = executor.map(lambda byte_range: blob.download_as_bytes(
+          start = byte_range[0], end = byte_range[1], if_generation_match = generation, retry = self.retry
+        ), ranges)
+        return b''.join(parts)
+    except api_exceptions.PreconditionFailed:
+      return blob.download_as_bytes(retry = self.retry)
+
+  def _get_json_blob_result(self, blob_name):
+    # Worker for get_tables_as_dictionaries: (blob_name, dictionary, error)
+    try:
+      return (blob_name, self._get_json_blob(blob_name), None)
+    except InvalidDataException as e:
+      return (blob_name, None, e)
   
   def get_table_as_dictionary(self, table_name):
     '''
@@ -45,21 +172,145 @@ class SDMLStorageBucket:
       The table as a JSON dictionary
     '''
     return self._get_json_blob(table_name)
+
+  def get_tables_as_dictionaries(self, table_names, max_workers = None):
+    '''
+    Get the tables table_names as dictionaries, making up to max_workers requests at once.
+    A table which can't be read doesn't stop the others.
+    Arguments:
+      table_names: the names of the tables (blobs) to get
+      max_workers: the maximum number of concurrent requests; if None, self.max_workers
+    Returns:
+      A list, in the order of table_names, of (table_name, dictionary, error), where
+      dictionary is None and error is an InvalidDataException if the table couldn't be read
+    '''
+    table_names = list(table_names)
+    if len(table_names) == 0:
+      return []
+    workers = min(max_workers or self.max_workers, len(table_names))
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+      return list(executor.map(self._get_json_blob_result, table_names))
   
   def upload_table(self, prefix, table_dictionary):
     '''
     Upload a table to the bucket, to blob name table_name.  table should be an SDMLTable with 
-    a .to_dictionary() method that produces a JSONifiable form
+    a .to_dictionary() method that produces a JSONifiable form.  Returns the generation of the new blob
     Arguments:
       table_name: name of the table
       table: the SDML Table; note this is an instance of SDMLTable, not a dictionary
     
     '''
     table_name = table_dictionary["name"]
+    return self._upload_json(f'{prefix}/{table_name}.sdml', table_dictionary['table'])
+
+  def _upload_json(self, blob_name, value):
+    # Upload value, a JSONifiable object, to blob_name, and return the generation of the new blob
+    blob = self.bucket.blob(blob_name)
+    json_form = json.dumps(value)
+    with STAGE_SECONDS.time(stage = 'bucket_write'):
+      blob.upload_from_string(json_form, content_type = 'application/json', retry = self.retry)
+    BUCKET_BYTES.observe(len(json_form), operation = 'write')
+    return blob.generation
+
+  def upload_table_stream(self, prefix, table_name, stream):
+    '''
+    Upload an SDML file to the bucket, to blob name {prefix}/{table_name}.sdml, from a file-like object.
+    The file is sent as a resumable upload in chunks of UPLOAD_CHUNK_SIZE bytes, so only
+    one chunk is held in memory at a time, regardless of the size of the file.  Returns the generation of the new blob
+    Arguments:
+      prefix: the prefix (directory) of the blob
+      table_name: name of the table
+      stream: a readable, seekable file-like object holding the SDML file
+    '''
+    return self._upload_stream(f'{prefix}/{table_name}.sdml', stream)
 
-    blob = self.bucket.blob(f'{prefix}/{table_name}.sdml')
-    json_form = json.dumps(table_dictionary['table'])
-    blob.upload_from_string(json_form, content_type = 'application/json')
+  def _upload_stream(self, blob_name, stream):
+    # Upload the file-like object stream to blob_name in chunks, and return the generation of the new blob
+    blob = self.bucket.blob(blob_name, chunk_size = UPLOAD_CHUNK_SIZE)
+    with STAGE_SECONDS.time(stage = 'bucket_write'):
+      blob.upload_from_file(stream, rewind = True, content_type = 'application/json', retry = self.retry)
+    BUCKET_BYTES.observe(stream.tell(), operation = 'write')
+    return blob.generation
+
+  def upload_tables(self, uploads, max_workers = None):
+    '''
+    Upload several tables at once, making up to max_workers requests concurrently, and wait
+    for all of them.  Each upload is a dictionary with the prefix and name of the blob (which
+    is {prefix}/{name}.sdml), or blob, the full name of the blob, and
+    either table, a dictionary uploaded as JSON (as upload_table), or stream, a file-like
+    object uploaded in chunks (as upload_table_stream).  If any upload fails, the first
+    error is raised once all of the uploads have finished.  Returns the generations of the
+    new blobs, in the order of uploads.
+    Arguments:
+      uploads: a list of dictionaries {"prefix", "name", "table"} or {"prefix", "name", "stream"},
+        with "blob" in place of "prefix" and "name" for blobs that aren't tables
+      max_workers: the maximum number of concurrent uploads; if None, self.max_workers
+    '''
+    def upload(spec):
+      blob_name = spec['blob'] if 'blob' in spec else f'{spec["prefix"]}/{spec["name"]}.sdml'
+      if 'stream' in spec:
+        return self._upload_stream(blob_name, spec['stream'])
+      return self._upload_json(blob_name, spec['table'])
+    if len(uploads) == 0:
+      return []
+    with ThreadPoolExecutor(max_workers = min(max_workers or self.max_workers, len(uploads))) as executor:
+      futures = [executor.submit(upload, spec) for spec in uploads]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    if len(errors) > 0:
+      raise errors[0]
+    return [future.result() for future in futures]
+
+  def download_ranges(self, blob_name, ranges, generation):
+    '''
+    Download the byte ranges of generation generation of blob_name, making up to max_workers
+    requests at once.  Used to read the row groups of a ChunkedGCSTable (see row_groups)
+    Arguments:
+      blob_name: the name of the blob
+      ranges: a list of (start, end) byte offsets; end is inclusive
+      generation: the generation of the blob to read
+    Returns:
+      A list of the bytes of each range, or None if the blob no longer has generation generation.
+      Raises an InvalidDataException if the blob can't be read
+    '''
+    blob = self.bucket.blob(blob_name)
+    def download(byte_range):
+      return blob.download_as_bytes(start = byte_range[0], end = byte_range[1], if_generation_match = generation, retry = self.retry)
+    try:
+      with STAGE_SECONDS.time(stage = 'bucket_read'):
+        with ThreadPoolExecutor(max_workers = max(1, min(self.max_workers, len(ranges)))) as executor:
+          parts = list(executor.map(download, ranges))
+      BUCKET_BYTES.observe(sum(len(part) for part in parts), operation = 'read')
+      return parts
+    except api_exceptions.PreconditionFailed:
+      return None
+    except Exception as e:
+      raise InvalidDataException(f'Error {repr(e)} reading  {blob_name}')
+
+  def get_table_stats(self, table_name):
+    '''
+    Get the statistics of table table_name (see table_stats), stored in tablestats/{table_name}.json.
+    Raises an InvalidDataException if there are none
+    '''
+    return self._get_json_blob(f'{STATS_PREFIX}/{table_name}.json')
+
+  def upload_table_stats(self, table_name, stats):
+    '''
+    Store the statistics of table table_name (see table_stats) in tablestats/{table_name}.json
+    '''
+    self._upload_json(f'{STATS_PREFIX}/{table_name}.json', stats)
+
+  def get_table_sample(self, table_name):
+    '''
+    Get the row sample of table table_name (see table_sample), stored in tablesamples/{table_name}.json.
+    Raises an InvalidDataException if there is none
+    '''
+    return self._get_json_blob(f'{SAMPLES_PREFIX}/{table_name}.json')
+
+  def upload_table_sample(self, table_name, sample):
+    '''
+    Store the row sample of table table_name (see table_sample) in tablesamples/{table_name}.json
+    '''
+    self._upload_json(f'{SAMPLES_PREFIX}/{table_name}.json', sample)
 
   def get_sdql_samples(self):
       '''
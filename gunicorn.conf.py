@@ -0,0 +1,61 @@
+'''
+The gunicorn configuration for serving the wiki in production:
+  gunicorn -c gunicorn.conf.py wsgi:app
+The app is preloaded: it is loaded once, in the master process, before the workers are
+forked, and the workers share what it holds copy-on-write rather than each loading their
+own copy.  Tables are loaded lazily unless TABLE_LOAD_MODE is set: the master
+reads only the schema and generation of each table, so it starts without downloading the
+rows, and each worker builds a table the first time it is requested.  Set
+TABLE_LOAD_MODE=eager to build every table, and read its data, in the master (see
+table_loader.materialize_table); the workers then share the rows rather than each holding
+its own copy, at the cost of downloading every table before the server starts.  A table in
+the row-group layout (see row_groups) has only its manifest read in the master either way;
+its row groups are read on demand, and cached, by each worker.  Once the app is loaded, its
+objects are frozen out of the garbage collector (gc.freeze), so collections in the workers
+don't write to, and so copy, the pages holding them.  With COLUMNAR_CACHE_DIR set, the
+column arrays are memory-mapped files, which the workers share through the page cache
+however the tables are loaded.
+The workers share a METRICS_DIR (a new temporary directory, unless it is set), so /metrics
+reports the metrics of all of them.
+Each of WEB_CONCURRENCY worker processes serves GUNICORN_THREADS requests at a time (gthread workers).
+Set GUNICORN_PRELOAD=0 to load the app separately in each worker.
+'''
+import gc
+import multiprocessing
+import os
+import tempfile
+
+bind = f'0.0.0.0:{os.environ.get("PORT", 8080)}'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+keepalive = 5
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+# Worker heartbeats are written to memory rather than to the container's filesystem
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+accesslog = '-'
+
+os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix = 'wiki-metrics-'))
+
+if preload_app:
+  # Tells wsgi that the workers are started by post_fork
+  os.environ['WIKI_PRELOAD'] = '1'
+
+
+def when_ready(server):
+  # Runs in the master after the app is loaded, before any worker is forked.  The metrics
+  # of loading the app are reported from the master's snapshot, and not again by each worker
+  if preload_app:
+    import metrics
+    metrics.write_snapshot(os.environ['METRICS_DIR'])
+    gc.freeze()
+
+
+def post_fork(server, worker):
+  # Threads and connections don't survive the fork, so each worker starts its own
+  if preload_app:
+    import main
+    import metrics
+    metrics.reset()
+    main.worker_started()
@@ -0,0 +1,220 @@
+'''
+HTTP-level caching of the table pages and SDTP responses.  Dashboards poll the same pages
+every few seconds, and a page only changes when its table does, so:
+  each table carries a content version (its blob generation, or a fresh token when it is
+    uploaded), and the catalog a version derived from all of them (see TableVersions)
+  the ETag of a GET is computed from the request alone (endpoint, sorted arguments, the
+    logged-in user, and the version of the table it names, or of the catalog), before
+    the view runs
+  a request whose If-None-Match holds the ETag is answered with a 304, without touching the table
+  otherwise, a response already rendered for the ETag is served from a ResponseCache, and a
+    newly rendered response is stored there
+Since the ETag names the table version, a replaced table gets new ETags, and entries for
+the old version simply age out of the cache.  Requests with pending flash messages are
+neither answered from nor stored in the cache; responses which flash a message, responses
+other than a 200, and views whose output is incomplete (see do_not_cache) are neither
+tagged nor stored.
+'''
+import hashlib
+import json
+import threading
+import uuid
+from collections import OrderedDict
+
+from flask import g, request, session, make_response, message_flashed
+
+DEFAULT_RESPONSE_CACHE_BYTES = 32 * 1024 * 1024
+DEFAULT_MAX_AGE = 0
+# The request arguments which name the table a response is drawn from
+TABLE_ARGUMENTS = ['table', 'table_name']
+
+
+class TableVersions:
+  '''
+  The content versions of the tables being served, and a version of the whole catalog,
+  which changes whenever any table is added, replaced, or removed.  Versions derived from
+  blob generations are the same in every worker and instance, so their ETags are too.
+  The catalog version is the exclusive or of the digests of the (table, version) pairs, so
+  it is updated in constant time as each table changes, whatever the size of the catalog.
+  '''
+  def __init__(self):
+    self.versions = {}
+    self.catalog_digest = 0
+    self.catalog_version = f'{self.catalog_digest:016x}'
+    self.lock = threading.Lock()
+
+  def _digest(self, table_name, version):
+    return int(hashlib.sha1(json.dumps([table_name, version]).encode()).hexdigest()[:16], 16)
+
+  def set(self, table_name, version):
+    '''
+    Set the version of table_name to version (a string or int); None means the table was removed
+    '''
+    with self.lock:
+      if table_name in self.versions:
+        self.catalog_digest ^= self._digest(table_name, self.versions.pop(table_name))
+      if version is not None:
+        self.versions[table_name] = str(version)
+        self.catalog_digest ^= self._digest(table_name, self.versions[table_name])
+      self.catalog_version = f'{self.catalog_digest:016x}'
+
+  def bump(self, table_name):
+    '''
+    Give table_name a new, unique version; used when a table is replaced on this server
+    '''
+    self.set(table_name, f'local-{uuid.uuid4().hex}')
+
+  def get(self, table_name):
+    '''
+    The version of table_name, or None if it has none
+    '''
+    return self.versions.get(table_name)
+
+
+class ResponseCache:
+  '''
+  An LRU cache of rendered response bodies keyed by ETag, bounded by max_bytes.  Thread-safe.
+  Arguments:
+    max_bytes: the maximum total size of the cached bodies
+  '''
+  def __init__(self, max_bytes = DEFAULT_RESPONSE_CACHE_BYTES):
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()
+    self.current_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.not_modified = 0
+    self.lock = threading.Lock()
+
+  def get(self, etag):
+    '''
+    Return (body, mimetype) cached for etag, or None
+    '''
+    with self.lock:
+      entry = self.entries.get(etag)
+      if entry is None:
+        self.misses += 1
+        return None
+      self.entries.move_to_end(etag)
+      self.hits += 1
+      return entry
+
+  def put(self, etag, body, mimetype):
+    '''
+    Cache body (bytes) with mimetype for etag, evicting the least recently used entries as needed
+    '''
+    if len(body) > self.max_bytes:
+      return
+    with self.lock:
+      if etag in self.entries:
+        return
+      while self.current_bytes + len(body) > self.max_bytes and len(self.entries) > 0:
+        (_, (old_body, _)) = self.entries.popitem(last = False)
+        self.current_bytes -= len(old_body)
+      self.entries[etag] = (body, mimetype)
+      self.current_bytes += len(body)
+
+  def stats(self):
+    '''
+    Return the cache counters as a dictionary
+    '''
+    with self.lock:
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "not_modified": self.not_modified,
+        "entries": len(self.entries),
+        "bytes": self.current_bytes,
+        "max_bytes": self.max_bytes
+      }
+
+
+def do_not_cache():
+  '''
+  Neither tag nor cache the response to the current request: its content will change without
+  the table it shows changing (as when the table's statistics are still being computed)
+  '''
+  g.http_cache_etag = None
+
+
+class HTTPCache:
+  '''
+  Conditional GET and response caching for a set of endpoints and blueprints of a Flask app.
+  Arguments:
+    versions: the TableVersions of the tables being served
+    response_cache: the ResponseCache for rendered responses
+    max_age: the max-age of the Cache-Control header; 0 means clients must revalidate (no-cache)
+  '''
+  def __init__(self, versions, response_cache, max_age = DEFAULT_MAX_AGE):
+    self.versions = versions
+    self.response_cache = response_cache
+    self.max_age = max_age
+    self.endpoints = set()
+    self.blueprints = set()
+
+  def init_app(self, app, endpoints = (), blueprints = ()):
+    '''
+    Cache the GET responses of the named endpoints and of every endpoint of the named blueprints of app
+    '''
+    self.endpoints |= set(endpoints)
+    self.blueprints |= set(blueprints)
+    app.before_request(self._before_request)
+    app.after_request(self._after_request)
+    message_flashed.connect(self._message_flashed, app)
+
+  def _message_flashed(self, sender, message, category):
+    # A page showing a flashed message is only right for this request, though the message is
+    # taken from the session while the page is rendered, before _after_request
+    do_not_cache()
+
+  def _cacheable(self):
+    # True if the current request's response can be named by an ETag
+    if request.method not in {'GET', 'HEAD'}:
+      return False
+    if request.endpoint not in self.endpoints and request.blueprint not in self.blueprints:
+      return False
+    return '_flashes' not in session
+
+  def etag(self):
+    '''
+    The ETag of the current request: a digest of the endpoint, the sorted arguments, the
+    logged-in user, and the version of the table the request names (or of the catalog)
+    '''
+    table_names = [request.args.get(argument) for argument in TABLE_ARGUMENTS if argument in request.args]
+    table_versions = [self.versions.get(table_name) for table_name in table_names]
+    if len(table_versions) == 0 or None in table_versions:
+      table_versions.append(self.versions.catalog_version)
+    parts = [request.endpoint, sorted(request.args.items(multi = True)), session.get('email'), table_versions]
+    return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+  def _cache_control(self):
+    visibility = 'private' if session.get('email') is not None else 'public'
+    return f'{visibility}, max-age={self.max_age}' if self.max_age > 0 else f'{visibility}, no-cache'
+
+  def _before_request(self):
+    if not self._cacheable():
+      return None
+    etag = self.etag()
+    g.http_cache_etag = etag
+    if etag in request.if_none_match:
+      with self.response_cache.lock:
+        self.response_cache.not_modified += 1
+      g.http_cache_hit = True
+      return make_response('', 304)
+    cached = self.response_cache.get(etag)
+    if cached is None:
+      return None
+    g.http_cache_hit = True
+    response = make_response(cached[0])
+    response.mimetype = cached[1]
+    return response
+
+  def _after_request(self, response):
+    etag = g.get('http_cache_etag')
+    if etag is None or response.status_code not in {200, 304}:
+      return response
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = self._cache_control()
+    if response.status_code == 200 and not g.get('http_cache_hit') and not response.direct_passthrough:
+      self.response_cache.put(etag, response.get_data(), response.mimetype)
+    return response
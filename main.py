@@ -32,12 +32,13 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
-from flask import  Flask, Blueprint, request, render_template, flash, redirect, url_for, session
+from flask import  Flask, Blueprint, request, render_template, flash, redirect, url_for, session, jsonify, Response, stream_with_context
 
 import os
+import logging
 from authlib.integrations.flask_client import OAuth
 import jwt
-from uploader import make_SDMLTable_from_upload
+from uploader import read_SDML_header, is_spreadsheet_upload, convert_spreadsheet_upload
 from json import loads, JSONDecodeError
 import requests
 
@@ -45,13 +46,22 @@ import requests
 from sdtp import sdtp_server_blueprint
 
 app = Flask(__name__)
+logging.basicConfig(level = logging.INFO)
 
 wiki_server = Blueprint('sdtp_wiki_server', __name__, template_folder='templates')
 
 additional_routes =[
   {"url": "/upload", "method": ["GET", "POST"], "description": "File uploader.  If a multipart file is not attached to the POST body, displays a file chooser"},
-  {"url": "/view_tables", "method": ["GET"], "description": "Shows all the tables in a list, with a link to the table viewer method"},
-  {"url": "/view_table?table <i>string, required</i>&filter<i>string, optional</i>", "method": ["GET", "POST"], "description": "Table Viewer.  Displays the first twenty rows of the table (filtered, if filter was applied).  filter, if present is a functional filter expression, e.g. IN_RANGE('<column_name>, <min_val>, <max_val>)"},
+  {"url": "/view_tables?q<i>string, optional</i>&prefix<i>string, optional</i>&offset<i>int, optional</i>&limit<i>int, optional</i>", "method": ["GET"], "description": "Shows a page of the tables, a hundred by default, with links to the table viewer; q searches the table and column names, and prefix (e.g. an owner followed by /) restricts the tables to names which start with it"},
+  {"url": "/catalog?q<i>string, optional</i>&prefix<i>string, optional</i>&offset<i>int, optional</i>&limit<i>int, optional</i>", "method": ["GET"], "description": "A page of the tables, as /view_tables, with the owner and columns of each table and the number of matching tables, as JSON"},
+  {"url": "/filter_cache_stats", "method": ["GET"], "description": "Hit, miss and eviction counters and the current size of the filtered-page cache, as JSON"},
+  {"url": "/response_cache_stats", "method": ["GET"], "description": "Hit, miss and 304 counters and the current size of the rendered-response cache, as JSON"},
+  {"url": "/metrics", "method": ["GET"], "description": "Request latencies, time spent validating, filtering, rendering, building tables and reading the bucket, rows scanned and returned, and bytes read and written, in the Prometheus text format"},
+  {"url": "/table_stats?table <i>string, required</i>", "method": ["GET"], "description": "Per-column statistics of the table (count, nulls, min, max, distinct values, most common values), as JSON"},
+  {"url": "/plan_filter?table <i>string, required</i>&filter<i>string, required</i>", "method": ["GET"], "description": "The plan of the filter (an SDQL filter as JSON) over the table, from its statistics: empty, all, or scan, with the (estimated) number of matching rows, as JSON"},
+  {"url": "/approximate_query?table <i>string, required</i>&query<i>count|histogram|percentiles, optional</i>&filter<i>string, optional</i>&column<i>string</i>&bins<i>int, optional</i>&percentiles<i>numbers, optional</i>", "method": ["GET"], "description": "The approximate count of the rows which pass the filter, or the histogram or percentiles (e.g. 50,90,99) of a column over them, from a random sample of the table, with 95% confidence intervals, as JSON"},
+  {"url": "/export_table?table <i>string, required</i>&filter<i>string, optional</i>&format<i>ndjson|csv|arrow, optional</i>", "method": ["GET"], "description": "Streams the rows of the table which pass the filter (an SDQL filter as JSON), as NDJSON (the default), CSV, or an Arrow IPC stream (if pyarrow is installed)"},
+  {"url": "/view_table?table <i>string, required</i>&filter<i>string, optional</i>&offset<i>int, optional</i>&limit<i>int, optional</i>&sample<i>1, optional</i>", "method": ["GET", "POST"], "description": "Table Viewer.  Displays a page of rows of the table (filtered, if filter was applied), twenty rows by default; offset and limit select the page, and sample=1 shows a sampled preview, rows from a random sample of the whole table.  filter, if present is a functional filter expression, e.g. IN_RANGE('<column_name>, <min_val>, <max_val>)"},
   {"url": "/view_base", "method": ["GET", "POST"], "description": "Check out the base template"}
 ]
 
@@ -70,7 +80,8 @@ def extended_render(template_name, context):
         context["email"] = session["email"]
         context["user"] = session["user"]
     
-    return render_template(template_name, **context)
+    with STAGE_SECONDS.time(stage = 'render'):
+        return render_template(template_name, **context)
 
 @wiki_server.route('/')
 def show_root():
@@ -81,7 +92,8 @@ def show_root():
   
   context = {
       "routes": sdtp_server_blueprint.ROUTES,
-      "table_names": list(sdtp_server_blueprint.table_server.servers.keys()),
+      "table_names": catalog_index.search(limit = CATALOG_PAGE_SIZE)[0],
+      "table_count": len(catalog_index),
       "additional_routes": additional_routes
   }
   return extended_render('greeting.html', context)
@@ -147,68 +159,238 @@ def authorize():
 def cwd():
     return os.getcwd()
 
-from build_filter import create_filter    
+from build_filter import parse_filter, check_filter_depth
 from sdtp import check_valid_spec_return_boolean, InvalidDataException
 
                            
 BUCKET_NAME = os.environ['BUCKET_NAME']
 
 from gcs_interface import SDMLStorageBucket
+from columnar_cache import ColumnarCache, ColumnarGCSTableFactory, DEFAULT_REVALIDATE_INTERVAL
+from table_loader import LOAD_MODES, DEFAULT_LOAD_WORKERS
+from catalog_sync import CatalogSync, DEFAULT_SYNC_INTERVAL
+from table_query import get_page, clamp_page
+from table_export import export_stream, EXPORT_FORMATS
+from result_cache import FilteredResultCache, DEFAULT_CACHE_BYTES, DEFAULT_CACHE_TTL
+from http_cache import TableVersions, ResponseCache, HTTPCache, do_not_cache, DEFAULT_RESPONSE_CACHE_BYTES, DEFAULT_MAX_AGE
+from table_stats import TableStatistics
+from catalog_index import CatalogIndex, CATALOG_PAGE_SIZE
+from table_sample import TableSamples, SAMPLE_SIZE, DEFAULT_SAMPLE_CACHE_ENTRIES, DEFAULT_BINS, approximate_count, approximate_histogram, approximate_percentiles, sample_page
+from query_planner import plan_filter
+from row_groups import ChunkedGCSTableFactory, upload_row_groups, manifest_blob_name, DEFAULT_ROW_GROUP_SIZE
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from metrics import STAGE_SECONDS, ProfilingMiddleware
 
 bucket = SDMLStorageBucket(BUCKET_NAME)
 
-table_sample_queries = bucket.get_sdql_samples()
+# The sample SDQL queries of each table, read from the bucket by create_app
+table_sample_queries = {}
 
-def _render_table(table_name, table, rows, filter_spec = None):
+# If CHUNK_MIN_ROWS is set, uploaded RowTables of at least that many rows are stored as row
+# groups of ROW_GROUP_SIZE rows with per-column zone maps (see row_groups), so filters only read
+# the row groups they can match.  Other tables are stored as one blob, which the columnar cache,
+# vectorized filters and indexes serve; chunking is off unless CHUNK_MIN_ROWS is set
+ROW_GROUP_SIZE = int(os.environ.get('ROW_GROUP_SIZE', DEFAULT_ROW_GROUP_SIZE))
+CHUNK_MIN_ROWS = int(os.environ['CHUNK_MIN_ROWS']) if 'CHUNK_MIN_ROWS' in os.environ else None
+sdtp_server_blueprint.table_server.add_table_factory(ChunkedGCSTableFactory(bucket))
+
+filter_cache = FilteredResultCache(
+    int(os.environ.get('FILTER_CACHE_BYTES', DEFAULT_CACHE_BYTES)),
+    float(os.environ.get('FILTER_CACHE_TTL', DEFAULT_CACHE_TTL))
+)
+
+# Every request is timed (see metrics), including those answered by the response cache, and
+# /metrics serves the timings; METRICS_DIR, if set, is shared by the worker processes
+METRICS_DIR = os.environ.get('METRICS_DIR', None)
+metrics.init_app(app)
+# With PROFILE_REQUESTS=1, a request with a profile argument returns its cProfile profile
+if os.environ.get('PROFILE_REQUESTS') == '1':
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app)
+
+# GET responses for the table pages and the SDTP routes carry ETags derived from the
+# table versions; If-None-Match is answered with a 304, and rendered responses are cached
+table_versions = TableVersions()
+response_cache = ResponseCache(int(os.environ.get('RESPONSE_CACHE_BYTES', DEFAULT_RESPONSE_CACHE_BYTES)))
+http_cache = HTTPCache(table_versions, response_cache, int(os.environ.get('HTTP_CACHE_MAX_AGE', DEFAULT_MAX_AGE)))
+http_cache.init_app(app, endpoints = ['view_table', 'filter_table', 'view_tables'], blueprints = [sdtp_server_blueprint.name])
+
+# The names and column names of the tables, sorted and indexed for search, so the catalog
+# can be listed a page at a time and searched without scanning every table
+catalog_index = CatalogIndex()
+
+# Per-column statistics of each table, stored beside the table in the bucket; the statistics
+# of an uploaded table are computed in the background, and those of other tables on first use
+stats_executor = ThreadPoolExecutor(max_workers = 1)
+table_stats = TableStatistics(bucket, table_versions, stats_executor)
+
+# A random sample of SAMPLE_SIZE rows of each table, kept like the statistics, which answers
+# approximate counts, histograms and percentiles, and gives the sampled previews.  Samples are
+# drawn in the background, like the statistics, and SAMPLE_CACHE_ENTRIES of them are kept in memory
+table_samples = TableSamples(
+    bucket, table_versions, int(os.environ.get('SAMPLE_SIZE', SAMPLE_SIZE)), stats_executor,
+    int(os.environ.get('SAMPLE_CACHE_ENTRIES', DEFAULT_SAMPLE_CACHE_ENTRIES))
+)
+
+def _table_changed(table_name, version):
+    # Called when table_name is added, replaced, or removed (version None)
+    filter_cache.invalidate(table_name)
+    table_stats.invalidate(table_name)
+    table_samples.invalidate(table_name)
+    table_versions.set(table_name, version)
+    table = sdtp_server_blueprint.table_server.servers.get(table_name) if version is not None else None
+    if table is not None:
+        catalog_index.add(table_name, table.schema)
+    else:
+        catalog_index.remove(table_name)
+
+def _plan(table_name, table, filter_spec):
+    # The plan of filter_spec over table_name, if the table's statistics are known, or None
+    stats = table_stats.peek(table_name)
+    return plan_filter(filter_spec, table.schema, stats) if stats is not None and filter_spec is not None else None
+
+def _page_url(table_name, filter_str, offset, limit, sampled = False):
+    # The URL of the page of table_name starting at offset.  Filtered pages
+    # are served by /filter_table, which takes the filter as an argument
+    arguments = {"sample": 1} if sampled else {}
+    if filter_str:
+        return url_for('filter_table', table=table_name, filter=filter_str, offset=offset, limit=limit, **arguments)
+    return url_for('view_table', table=table_name, offset=offset, limit=limit, **arguments)
+
+def _render_table(table_name, table, page, filter_spec = None):
+    offset = page["offset"]
+    limit = page["limit"]
+    sampled = page.get("sampled", False)
     context = {
         "filter": filter_spec if filter_spec is not None else '',
         "table": {
             "name": table_name,
             "columns": table.schema,
-            "rows": rows[:20] if len(rows) > 20 else rows
-        }
+            "rows": page["rows"]
+        },
+        "page": page,
+        "prev_url": _page_url(table_name, filter_spec, max(0, offset - limit), limit, sampled) if offset > 0 else None,
+        "next_url": _page_url(table_name, filter_spec, offset + limit, limit, sampled) if page["has_next"] else None,
+        "sampled": sampled,
+        "sample_url": _page_url(table_name, filter_spec, 0, limit, not sampled)
     }
     if table_name in table_sample_queries.keys():
         context['sample_tables'] = table_sample_queries[table_name]
+    # The summary is shown once the statistics are ready; the first view only schedules them
+    context['stats'] = table_stats.request(table_name, table)
+    if context['stats'] is None:
+        do_not_cache()
     return extended_render('table.html', context)
 
 
-@app.route('/filter_table', methods=['POST'])
+def _get_sample(table_name, table):
+    # The sample of table_name for a sampled preview, or None (with a message) if it can't be
+    # sampled or is still being drawn, in which case the page shows the table's own rows
+    try:
+        sample = table_samples.request(table_name, table)
+    except InvalidDataException as e:
+        flash(f'No sampled preview of {table_name}: {e}')
+        return None
+    if sample is None:
+        flash(f'The sampled preview of {table_name} is being drawn; these are the first rows of the table')
+        do_not_cache()
+    return sample
+
+
+def _get_filtered_page(table_name, table, filter_spec, offset, limit, epoch, sample = None):
+    # Get a page of the filtered table, from the sample if there is one, and
+    # otherwise from filter_cache if it's there.  epoch is filter_cache.epoch(table_name),
+    # read before table was, so a page of a table replaced since isn't cached
+    if sample is not None:
+        return sample_page(sample, filter_spec, offset, limit)
+    page = filter_cache.get(table_name, filter_spec, offset, limit)
+    if page is None:
+        page = get_page(table, filter_spec, offset, limit, _plan(table_name, table, filter_spec))
+        filter_cache.put(table_name, filter_spec, offset, limit, page, epoch)
+    return page
+
+
+def _read_filter(filter_str):
+    # A filter is either SDQL JSON or in the functional filter language (see build_filter),
+    # such as IN_RANGE('year', 2000, 2010)
+    if filter_str is None or filter_str.lstrip().startswith('{'):
+        try:
+            filter_spec = loads(filter_str)
+        except RecursionError:
+            raise InvalidDataException('Filter nested too deeply')
+        check_filter_depth(filter_spec)
+        return filter_spec
+    return parse_filter(filter_str)
+
+
+@app.route('/filter_table', methods=['GET', 'POST'])
 def filter_table():
-    table_name = request.form.get('table')
-    sdtp_filter_str = request.form.get('filter', None)
+    table_name = request.values.get('table')
+    sdtp_filter_str = request.values.get('filter', None)
+    (offset, limit) = clamp_page(request.values.get('offset'), request.values.get('limit'))
+    epoch = filter_cache.epoch(table_name)
     table = sdtp_server_blueprint.table_server.get_table(table_name)
+    sample = _get_sample(table_name, table) if request.values.get('sample') == '1' else None
     try:
-        sdtp_filter_spec = loads(sdtp_filter_str)
-        if check_valid_spec_return_boolean(sdtp_filter_spec):
-            rows = table.get_filtered_rows(sdtp_filter_spec)
+        with STAGE_SECONDS.time(stage = 'validate'):
+            sdtp_filter_spec = _read_filter(sdtp_filter_str)
+            valid = check_valid_spec_return_boolean(sdtp_filter_spec)
+        if valid:
+            page = _get_filtered_page(table_name, table, sdtp_filter_spec, offset, limit, epoch, sample)
         else:
             # bug!  Needs to check in context of table!
             # Does this go into sdtp or do we do it here...
             # try here then migrate...
             flash(f'{sdtp_filter_str} is not a valid filter specification')
-            rows = table.get_filtered_rows()
-    except JSONDecodeError as e:
+            page = get_page(table, None, offset, limit)
+    except (JSONDecodeError, TypeError) as e:
         flash(f'{sdtp_filter_str} is not a valid filter specification')
-        rows = table.get_filtered_rows()
+        page = get_page(table, None, offset, limit)
+    except InvalidDataException as e:
+        flash(f'{sdtp_filter_str} is not a valid filter for {table_name}: {e}')
+        page = get_page(table, None, offset, limit)
     
-    return _render_table(table_name, table, rows, sdtp_filter_str)
+    return _render_table(table_name, table, page, sdtp_filter_str)
 
 
 @app.route('/view_table')
 def view_table():
     table_name = request.args.get('table')
+    if request.args.get('filter'):
+        # /view_table?filter=IN_RANGE('year', 2000, 2010) is a filtered view
+        return filter_table()
+    (offset, limit) = clamp_page(request.args.get('offset'), request.args.get('limit'))
     table = sdtp_server_blueprint.table_server.get_table(table_name)
-    # sdtp_filter_spec = create_filter(filter)
-    # if not check_valid_spec_return_boolean(sdtp_filter_spec):
-    #     sdtp_filter_spec = None
-    #     filter = ''
-
-    rows = table.get_filtered_rows()
-    return _render_table(table_name, table, rows)
+    # With sample=1, the page is a sampled preview: rows from throughout the table, not just its first rows
+    sample = _get_sample(table_name, table) if request.args.get('sample') == '1' else None
+    page = sample_page(sample, None, offset, limit) if sample is not None else get_page(table, None, offset, limit)
+    return _render_table(table_name, table, page)
     
 
 
+@app.route('/export_table')
+def export_table():
+    # Stream the rows of the table which pass the filter, a chunk at a time, so neither the
+    # memory used nor the time to the first byte grows with the size of the result
+    table_name = request.args.get('table')
+    filter_str = request.args.get('filter', None)
+    export_format = request.args.get('format', 'ndjson')
+    if table_name not in sdtp_server_blueprint.table_server.servers:
+        return (f'No table {table_name}', 404)
+    table = sdtp_server_blueprint.table_server.get_table(table_name)
+    try:
+        filter_spec = _read_filter(filter_str) if filter_str else None
+        if filter_spec is not None and not check_valid_spec_return_boolean(filter_spec):
+            return (f'{filter_str} is not a valid filter specification', 400)
+        chunks = export_stream(table, filter_spec, export_format)
+    except (JSONDecodeError, TypeError):
+        return (f'{filter_str} is not a valid filter specification', 400)
+    except InvalidDataException as e:
+        return (f'Cannot export {table_name}: {e}', 400)
+    headers = {"Content-Disposition": f'attachment; filename="{table_name.split("/")[-1]}.{export_format}"'}
+    return Response(stream_with_context(chunks), mimetype = EXPORT_FORMATS[export_format], headers = headers)
+
+
 def _check_email():
     # A  utility to ensure that only registered users 
     # can upload files
@@ -235,41 +417,197 @@ def upload_file():
         if file.filename == '':
             # flash('No selected file')
             return redirect(request.url)
-        # make_SDMLTable_from_upload checks to maek sure it's an SDML file
+        # CSV and Excel files are converted to SDML; otherwise, read_SDML_header checks to make sure
+        # it's an SDML file, without reading the whole file into memory
         try:
-            table_types = set(sdtp_server_blueprint.table_server.factories.keys())
-            table_dictionary = make_SDMLTable_from_upload(request.files['file'], table_types)  
+            if is_spreadsheet_upload(file):
+                table_dictionary = convert_spreadsheet_upload(file)
+            else:
+                table_types = set(sdtp_server_blueprint.table_server.factories.keys())
+                table_dictionary = read_SDML_header(file, table_types)
+                table_dictionary["stream"] = file.stream
         except InvalidDataException as e:
             flash(str(e))
             return redirect(request.url)
         try:
             table_dictionary["name"] = f"{session['user']}/{table_dictionary['name']}"
-            gcs_table_spec = {
-                "schema":  table_dictionary['table']["schema"],
-                "type": "GCSTable",
-                "bucket": BUCKET_NAME,
-                "blob": f"rowtables/{table_dictionary['name']}.sdml",
-            }
+            # Tables with indexes keep the single-blob layout, since the indexes are built by the columnar cache
+            chunked = (
+                CHUNK_MIN_ROWS is not None and ROW_GROUP_SIZE > 0 and table_dictionary['num_rows'] >= CHUNK_MIN_ROWS and
+                table_dictionary['table']['type'] == 'RowTable' and 'indexes' not in table_dictionary['table']
+            )
+            if chunked:
+                gcs_table_spec = {
+                    "schema":  table_dictionary['table']["schema"],
+                    "type": "ChunkedGCSTable",
+                    "bucket": BUCKET_NAME,
+                    "manifest": manifest_blob_name(table_dictionary['name'])
+                }
+            else:
+                gcs_table_spec = {
+                    "schema":  table_dictionary['table']["schema"],
+                    "type": "GCSTable",
+                    "bucket": BUCKET_NAME,
+                    "blob": f"rowtables/{table_dictionary['name']}.sdml",
+                }
+            if 'indexes' in table_dictionary['table']:
+                gcs_table_spec['indexes'] = table_dictionary['table']['indexes']
             # sdtp_server_blueprint.table_server.add_sdtp_table_from_dictionary(table_dictionary["name"], table_dictionary["table"])
             sdtp_server_blueprint.table_server.add_sdtp_table_from_dictionary(table_dictionary["name"], gcs_table_spec)
         except InvalidDataException as e:
             return upload_error(f'Error {e} in creating the table for  {file.filename}')
-        bucket.upload_table('rowtables', table_dictionary)
-        bucket.upload_table('gcstables', {"name": table_dictionary['name'], "table": gcs_table_spec})
+        spec_upload = {"prefix": "gcstables", "name": table_dictionary['name'], "table": gcs_table_spec}
+        if chunked:
+            # The rows are split into row groups, which are uploaded before the manifest and the table specification
+            try:
+                generations = upload_row_groups(bucket, table_dictionary['name'], gcs_table_spec['schema'], table_dictionary['stream'], ROW_GROUP_SIZE, [spec_upload])
+            except InvalidDataException as e:
+                table_dictionary['stream'].close()
+                sdtp_server_blueprint.table_server.servers.pop(table_dictionary['name'], None)
+                return upload_error(f'Error {e} in storing the rows of {file.filename}')
+        else:
+            # The data and the table specification are uploaded concurrently
+            try:
+                generations = bucket.upload_tables([
+                    {"prefix": "rowtables", "name": table_dictionary['name'], "stream": table_dictionary['stream']},
+                    spec_upload
+                ])[1:]
+            except Exception as e:
+                table_dictionary['stream'].close()
+                sdtp_server_blueprint.table_server.servers.pop(table_dictionary['name'], None)
+                return upload_error(f'Error {e} in storing {file.filename}')
+        table_dictionary['stream'].close()
+        _table_changed(table_dictionary['name'], generations[0])
+        # The statistics and sample of the new table are computed in the background, once, however soon it is viewed
+        table_stats.request(table_dictionary['name'], sdtp_server_blueprint.table_server.get_table(table_dictionary['name']))
+        table_samples.request(table_dictionary['name'], sdtp_server_blueprint.table_server.get_table(table_dictionary['name']))
         return redirect(f"/view_table?table={table_dictionary['name']}")
         
     context = {}
     if _active_login():
         current_user = session['user']
-        current_user_tables = [key for key in sdtp_server_blueprint.table_server.servers.keys() if key.startswith(current_user)]
-        context['user_tables'] = current_user_tables
+        (context['user_tables'], context['user_table_count']) = catalog_index.search(prefix = f'{current_user}/')
     return extended_render('upload_form.html', context)
     
 
+def _catalog_entries(table_names):
+    # The catalog entries of table_names, leaving out any removed since they were found
+    entries = [catalog_index.entry(table_name) for table_name in table_names]
+    return [entry for entry in entries if entry is not None]
+
 @app.route("/view_tables")
 def view_tables():
-    table_names = sdtp_server_blueprint.table_server.servers.keys()
-    return extended_render('view_tables.html', {"tables":table_names})
+    # A page of the tables whose names start with prefix and which match the search q
+    query = request.args.get('q', '').strip()
+    prefix = request.args.get('prefix', '').strip()
+    (offset, limit) = clamp_page(request.args.get('offset'), request.args.get('limit', CATALOG_PAGE_SIZE))
+    (table_names, total) = catalog_index.search(query, prefix, offset, limit)
+    def page_url(page_offset):
+        return url_for('view_tables', q = query or None, prefix = prefix or None, offset = page_offset, limit = limit)
+    context = {
+        "tables": _catalog_entries(table_names),
+        "query": query,
+        "prefix": prefix,
+        "offset": offset,
+        "total": total,
+        "prev_url": page_url(max(0, offset - limit)) if offset > 0 else None,
+        "next_url": page_url(offset + limit) if offset + limit < total else None
+    }
+    return extended_render('view_tables.html', context)
+
+@app.route("/catalog")
+def catalog():
+    # The catalog as JSON: a page of the tables whose names start with prefix and which match
+    # the search q, with their owners and columns
+    (offset, limit) = clamp_page(request.args.get('offset'), request.args.get('limit', CATALOG_PAGE_SIZE))
+    (table_names, total) = catalog_index.search(request.args.get('q'), request.args.get('prefix'), offset, limit)
+    return jsonify({
+        "tables": _catalog_entries(table_names),
+        "total": total,
+        "offset": offset,
+        "limit": limit
+    })
+
+@app.route("/filter_cache_stats")
+def filter_cache_stats():
+    return jsonify(filter_cache.stats())
+
+def _statistics_pending(table_name):
+    # The response to a request which needs statistics that are still being computed
+    return (f'The statistics of {table_name} are being computed; try again shortly', 503, {"Retry-After": "1"})
+
+def _sample_pending(table_name):
+    # The response to a request which needs a sample that is still being drawn
+    return (f'The sample of {table_name} is being drawn; try again shortly', 503, {"Retry-After": "1"})
+
+@app.route("/plan_filter")
+def plan_filter_route():
+    # The plan of a filter over a table, from the table's statistics, without scanning it
+    table_name = request.args.get('table')
+    filter_str = request.args.get('filter', None)
+    if table_name not in sdtp_server_blueprint.table_server.servers:
+        return (f'No table {table_name}', 404)
+    table = sdtp_server_blueprint.table_server.get_table(table_name)
+    try:
+        stats = table_stats.request(table_name, table)
+        if stats is None:
+            return _statistics_pending(table_name)
+        plan = plan_filter(_read_filter(filter_str), table.schema, stats)
+    except (JSONDecodeError, TypeError):
+        return (f'{filter_str} is not a valid filter specification', 400)
+    except InvalidDataException as e:
+        return (f'{filter_str} is not a valid filter for {table_name}: {e}', 400)
+    return jsonify(plan)
+
+@app.route("/approximate_query")
+def approximate_query_route():
+    # An approximate count, histogram or percentiles of the rows which pass a filter, from the
+    # table's sample, with confidence intervals
+    table_name = request.args.get('table')
+    query = request.args.get('query', 'count')
+    filter_str = request.args.get('filter', None)
+    column_name = request.args.get('column')
+    if table_name not in sdtp_server_blueprint.table_server.servers:
+        return (f'No table {table_name}', 404)
+    if query not in ('count', 'histogram', 'percentiles'):
+        return (f'Unknown query {query}: the queries are count, histogram, and percentiles', 400)
+    table = sdtp_server_blueprint.table_server.get_table(table_name)
+    try:
+        filter_spec = _read_filter(filter_str) if filter_str else None
+        sample = table_samples.request(table_name, table)
+        if sample is None:
+            return _sample_pending(table_name)
+        if query == 'count':
+            result = approximate_count(sample, filter_spec)
+        elif query == 'histogram':
+            result = approximate_histogram(sample, column_name, filter_spec, int(request.args.get('bins', DEFAULT_BINS)))
+        else:
+            percentiles = [float(percentile) for percentile in request.args.get('percentiles', '50').split(',')]
+            result = approximate_percentiles(sample, column_name, percentiles, filter_spec)
+    except (JSONDecodeError, TypeError):
+        return (f'{filter_str} is not a valid filter specification', 400)
+    except ValueError:
+        return ('bins must be an integer, and percentiles a comma-separated list of numbers', 400)
+    except InvalidDataException as e:
+        return (f'Cannot answer {query} over {table_name}: {e}', 400)
+    return jsonify(result)
+
+@app.route("/table_stats")
+def table_stats_route():
+    table_name = request.args.get('table')
+    if table_name not in sdtp_server_blueprint.table_server.servers:
+        return (f'No table {table_name}', 404)
+    stats = table_stats.request(table_name, sdtp_server_blueprint.table_server.get_table(table_name))
+    return jsonify(stats) if stats is not None else _statistics_pending(table_name)
+
+@app.route("/metrics")
+def metrics_route():
+    # The metrics of this process, or of every worker process if METRICS_DIR is set, in the Prometheus text format
+    return Response(metrics.exposition(metrics.collect(METRICS_DIR)), mimetype = 'text/plain; version=0.0.4')
+
+@app.route("/response_cache_stats")
+def response_cache_stats():
+    return jsonify(response_cache.stats())
 
 @app.route("/view_base")
 def view_base():
@@ -277,8 +615,16 @@ def view_base():
 
 additional_routes =[
     {"url": "/upload", "method": ["GET", "POST"], "description": "File uploader.  If a multipart file is not attached to the POST body, displays a file chooser"},
-    {"url": "/view_tables", "method": ["GET"], "description": "Shows all the tables in a list, with a link to the table viewer method"},
-    {"url": "/view_table?table <i>string, required</i>&filter<i>string, optional</i>", "method": ["GET", "POST"], "description": "Table Viewer.  Displays the first twenty rows of the table (filtered, if filter was applied).  filter, if present is a functional filter expression, e.g. IN_RANGE('<column_name>, <min_val>, <max_val>)"},
+    {"url": "/view_tables?q<i>string, optional</i>&prefix<i>string, optional</i>&offset<i>int, optional</i>&limit<i>int, optional</i>", "method": ["GET"], "description": "Shows a page of the tables, a hundred by default, with links to the table viewer; q searches the table and column names, and prefix (e.g. an owner followed by /) restricts the tables to names which start with it"},
+    {"url": "/catalog?q<i>string, optional</i>&prefix<i>string, optional</i>&offset<i>int, optional</i>&limit<i>int, optional</i>", "method": ["GET"], "description": "A page of the tables, as /view_tables, with the owner and columns of each table and the number of matching tables, as JSON"},
+    {"url": "/filter_cache_stats", "method": ["GET"], "description": "Hit, miss and eviction counters and the current size of the filtered-page cache, as JSON"},
+    {"url": "/response_cache_stats", "method": ["GET"], "description": "Hit, miss and 304 counters and the current size of the rendered-response cache, as JSON"},
+    {"url": "/metrics", "method": ["GET"], "description": "Request latencies, time spent validating, filtering, rendering, building tables and reading the bucket, rows scanned and returned, and bytes read and written, in the Prometheus text format"},
+    {"url": "/table_stats?table <i>string, required</i>", "method": ["GET"], "description": "Per-column statistics of the table (count, nulls, min, max, distinct values, most common values), as JSON"},
+    {"url": "/plan_filter?table <i>string, required</i>&filter<i>string, required</i>", "method": ["GET"], "description": "The plan of the filter (an SDQL filter as JSON) over the table, from its statistics: empty, all, or scan, with the (estimated) number of matching rows, as JSON"},
+    {"url": "/approximate_query?table <i>string, required</i>&query<i>count|histogram|percentiles, optional</i>&filter<i>string, optional</i>&column<i>string</i>&bins<i>int, optional</i>&percentiles<i>numbers, optional</i>", "method": ["GET"], "description": "The approximate count of the rows which pass the filter, or the histogram or percentiles (e.g. 50,90,99) of a column over them, from a random sample of the table, with 95% confidence intervals, as JSON"},
+    {"url": "/export_table?table <i>string, required</i>&filter<i>string, optional</i>&format<i>ndjson|csv|arrow, optional</i>", "method": ["GET"], "description": "Streams the rows of the table which pass the filter (an SDQL filter as JSON), as NDJSON (the default), CSV, or an Arrow IPC stream (if pyarrow is installed)"},
+    {"url": "/view_table?table <i>string, required</i>&filter<i>string, optional</i>&offset<i>int, optional</i>&limit<i>int, optional</i>&sample<i>1, optional</i>", "method": ["GET", "POST"], "description": "Table Viewer.  Displays a page of rows of the table (filtered, if filter was applied), twenty rows by default; offset and limit select the page, and sample=1 shows a sampled preview, rows from a random sample of the whole table.  filter, if present is a functional filter expression, e.g. IN_RANGE('<column_name>, <min_val>, <max_val>)"},
     {"url": "/view_base", "method": ["GET", "POST"], "description": "Check out the base template"}
 ]
 
@@ -298,17 +644,67 @@ def show_routes():
 
     return extended_render('routes.html', {"pages": pages, "keys": keys})
 
+# If COLUMNAR_CACHE_DIR is set, GCSTables are served from a memory-mapped columnar
+# cache in that directory, shared by every worker on the host.  Each table checks the
+# generation of its blob at most every COLUMNAR_REVALIDATE_INTERVAL seconds
+if 'COLUMNAR_CACHE_DIR' in os.environ:
+    columnar_cache = ColumnarCache(os.environ['COLUMNAR_CACHE_DIR'], bucket.client)
+    revalidate_interval = float(os.environ.get('COLUMNAR_REVALIDATE_INTERVAL', DEFAULT_REVALIDATE_INTERVAL))
+    sdtp_server_blueprint.table_server.add_table_factory(ColumnarGCSTableFactory(columnar_cache, revalidate_interval))
+
 prefix = os.environ.get('TABLE_PREFIX', None)
-table_names = bucket.get_all_table_names(prefix)
-for table_name in table_names:
-    try:
-        table_dict = bucket.get_table_as_dictionary(table_name)
-        first_index = len(prefix) if prefix is not None else 0
-        key_name = table_name[first_index:-5]
-        sdtp_server_blueprint.table_server.add_sdtp_table_from_dictionary(key_name, table_dict)
-    except InvalidDataException as e:
-        pass # need to put logging in
+# TABLE_LOAD_MODE is lazy (build each table on first access) or eager (build at startup)
+load_mode = os.environ.get('TABLE_LOAD_MODE', 'lazy')
+if load_mode not in LOAD_MODES:
+    raise ValueError(f'TABLE_LOAD_MODE must be one of {LOAD_MODES}, not {load_mode}')
+# The first sync registers every table; after that, the catalog is re-synced with the bucket
+# every CATALOG_SYNC_INTERVAL seconds in the background (0 turns this off)
+catalog_sync = CatalogSync(
+    bucket, sdtp_server_blueprint.table_server, prefix,
+    lazy = load_mode == 'lazy',
+    max_workers = int(os.environ.get('TABLE_LOAD_WORKERS', DEFAULT_LOAD_WORKERS)),
+    interval = float(os.environ.get('CATALOG_SYNC_INTERVAL', DEFAULT_SYNC_INTERVAL)),
+    on_change = _table_changed
+)
+startup_timings = None
+
+def create_app(start_worker = True):
+    '''
+    The app factory.  Importing this module only defines the app; create_app reads the sample
+    queries and registers every table in the bucket (once, however often it is called), and then,
+    if start_worker is True, starts the background work of this process (see worker_started).
+    Under gunicorn with preload_app (see gunicorn.conf.py), create_app runs once in the master
+    process with start_worker False, so the tables are registered (and, with TABLE_LOAD_MODE
+    eager, built) before the workers are forked and shared by them copy-on-write, and each worker calls worker_started after it is forked.
+    Arguments:
+        start_worker: if True, call worker_started
+    Returns:
+        The Flask app
+    '''
+    global startup_timings
+    if startup_timings is None:
+        table_sample_queries.update(bucket.get_sdql_samples())
+        startup_timings = catalog_sync.sync()
+    if start_worker:
+        worker_started()
+    return app
+
+def worker_started():
+    '''
+    Start the background work of a serving process: open a fresh pool of connections to the
+    bucket (connections opened before a fork can't be shared with the parent), and start the
+    background catalog sync if CATALOG_SYNC_INTERVAL > 0, and the periodic snapshots of the
+    metrics if METRICS_DIR is set.  Threads don't survive a fork, so this is called in every
+    worker process
+    '''
+    bucket.reset_connections()
+    if catalog_sync.interval > 0:
+        catalog_sync.start()
+    if METRICS_DIR is not None:
+        os.makedirs(METRICS_DIR, exist_ok = True)
+        metrics.start_snapshots(METRICS_DIR)
 
 
 if __name__ == '__main__':
+    create_app()
     app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file
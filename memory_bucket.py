@@ -0,0 +1,170 @@
+'''
+An in-memory stand-in for SDMLStorageBucket, for running the wiki's bucket-facing code
+(table loading, catalog sync, uploads) locally, without Google Cloud credentials.
+Blobs are held in a dictionary as JSON strings (or bytes), and each write gives the blob a new
+generation number, as Cloud Storage does.
+'''
+import itertools
+import json
+import threading
+
+from sdtp import InvalidDataException
+
+
+class MemoryStorageBucket:
+  '''
+  A bucket of SDML blobs held in memory, with the interface of SDMLStorageBucket.
+  Arguments:
+    bucket_name: the name of the bucket
+    blobs: an optional dictionary {blob_name: table dictionary} of the initial contents
+  '''
+  def __init__(self, bucket_name = 'memory', blobs = None):
+    self.bucket_name = bucket_name
+    self.blobs = {}
+    self.generations = {}
+    self._next_generation = itertools.count(1)
+    self.lock = threading.Lock()
+    for (blob_name, table_dictionary) in (blobs or {}).items():
+      self.put_blob(blob_name, json.dumps(table_dictionary))
+
+  def put_blob(self, blob_name, contents):
+    '''
+    Write contents (a string or bytes) to blob_name, giving it a new generation, which is returned
+    '''
+    with self.lock:
+      self.blobs[blob_name] = contents
+      self.generations[blob_name] = next(self._next_generation)
+      return self.generations[blob_name]
+
+  def delete_blob(self, blob_name):
+    '''
+    Delete blob_name, if it exists
+    '''
+    with self.lock:
+      self.blobs.pop(blob_name, None)
+      self.generations.pop(blob_name, None)
+
+  def reset_connections(self):
+    '''
+    As SDMLStorageBucket.reset_connections; there are no connections to reset
+    '''
+    pass
+
+  def get_all_table_names(self, prefix = None):
+    '''
+    Get the names of all tables stored in the bucket.  Returns a list of blob names
+    '''
+    return list(self.get_table_generations(prefix).keys())
+
+  def get_table_generations(self, prefix = None, page_size = None):
+    '''
+    Get the names and generations of the .sdml blobs whose names start with prefix, as
+    a dictionary {blob_name: generation}
+    '''
+    with self.lock:
+      return {
+        blob_name: generation for (blob_name, generation) in sorted(self.generations.items())
+        if blob_name.endswith('.sdml') and (prefix is None or blob_name.startswith(prefix))
+      }
+
+  def get_table_as_dictionary(self, table_name):
+    '''
+    Get table table_name as the dictionary form
+    '''
+    with self.lock:
+      contents = self.blobs.get(table_name)
+    if contents is None:
+      raise InvalidDataException(f'Error blob not found reading  {table_name}')
+    try:
+      return json.loads(contents)
+    except json.JSONDecodeError as e:
+      raise InvalidDataException(f'Error {repr(e)} reading  {table_name}')
+
+  def get_tables_as_dictionaries(self, table_names, max_workers = None):
+    '''
+    Get the tables table_names as dictionaries.  Returns a list of (table_name, dictionary, error),
+    as SDMLStorageBucket.get_tables_as_dictionaries
+    '''
+    results = []
+    for table_name in table_names:
+      try:
+        results.append((table_name, self.get_table_as_dictionary(table_name), None))
+      except InvalidDataException as e:
+        results.append((table_name, None, e))
+    return results
+
+  def upload_tables(self, uploads, max_workers = None):
+    '''
+    Upload several tables, each a dictionary {"prefix", "name", "table"} or {"prefix", "name", "stream"}
+    (or with "blob" in place of "prefix" and "name"), as SDMLStorageBucket.upload_tables
+    '''
+    generations = []
+    for spec in uploads:
+      blob_name = spec['blob'] if 'blob' in spec else f'{spec["prefix"]}/{spec["name"]}.sdml'
+      if 'stream' in spec:
+        spec['stream'].seek(0)
+        generations.append(self.put_blob(blob_name, spec['stream'].read()))
+      else:
+        generations.append(self.put_blob(blob_name, json.dumps(spec['table'])))
+    return generations
+
+  def download_ranges(self, blob_name, ranges, generation):
+    '''
+    Get the byte ranges (start, end inclusive) of generation generation of blob_name, as
+    SDMLStorageBucket.download_ranges; None if the blob has a different generation
+    '''
+    with self.lock:
+      (contents, current) = (self.blobs.get(blob_name), self.generations.get(blob_name))
+    if contents is None:
+      raise InvalidDataException(f'Error blob not found reading  {blob_name}')
+    if current != generation:
+      return None
+    data = contents.encode('utf-8') if isinstance(contents, str) else contents
+    return [data[start:end + 1] for (start, end) in ranges]
+
+  def upload_table(self, prefix, table_dictionary):
+    '''
+    Upload a table to the bucket, to blob name {prefix}/{table_name}.sdml
+    '''
+    return self.put_blob(f'{prefix}/{table_dictionary["name"]}.sdml', json.dumps(table_dictionary['table']))
+
+  def upload_table_stream(self, prefix, table_name, stream):
+    '''
+    Upload an SDML file to the bucket, to blob name {prefix}/{table_name}.sdml, from a file-like object
+    '''
+    stream.seek(0)
+    contents = stream.read()
+    return self.put_blob(f'{prefix}/{table_name}.sdml', contents.decode('utf-8') if isinstance(contents, bytes) else contents)
+
+  def get_table_stats(self, table_name):
+    '''
+    Get the statistics of table table_name, stored in tablestats/{table_name}.json
+    '''
+    return self.get_table_as_dictionary(f'tablestats/{table_name}.json')
+
+  def upload_table_stats(self, table_name, stats):
+    '''
+    Store the statistics of table table_name in tablestats/{table_name}.json
+    '''
+    self.put_blob(f'tablestats/{table_name}.json', json.dumps(stats))
+
+  def get_table_sample(self, table_name):
+    '''
+    Get the row sample of table table_name, stored in tablesamples/{table_name}.json
+    '''
+    return self.get_table_as_dictionary(f'tablesamples/{table_name}.json')
+
+  def upload_table_sample(self, table_name, sample):
+    '''
+    Store the row sample of table table_name in tablesamples/{table_name}.json
+    '''
+    self.put_blob(f'tablesamples/{table_name}.json', json.dumps(sample))
+
+  def get_sdql_samples(self):
+    '''
+    Get the sample SDQL queries, which are stored in 'gcstables/samples/table_sample_queries.json'
+    '''
+    try:
+      return self.get_table_as_dictionary('gcstables/samples/table_sample_queries.json')
+    except InvalidDataException:
+      return {}
@@ -0,0 +1,353 @@
+'''
+Instrumentation of the wiki: counters and histograms, served in the Prometheus text
+format by /metrics.  Observing a value takes a lock and a bisect, so the hooks can stay on
+in production.  The metrics are:
+  wiki_request_duration_seconds{endpoint}: the time to handle each request, up to the start
+    of the response (a streamed export goes on after this)
+  wiki_responses_total{endpoint,status}: the responses sent, by status code
+  wiki_stage_duration_seconds{stage}: the time spent in each stage of the work:
+    validate (checking an SDQL filter), filter (finding a page of rows), render (rendering
+    a template), materialize (building a table), statistics (computing table statistics),
+    bucket_list, bucket_read, and bucket_write (requests to the bucket)
+  wiki_rows_scanned, wiki_rows_returned: the rows examined and the rows returned by each page query
+  wiki_bucket_bytes{operation}: the bytes of each read from, or write to, the bucket
+Each process has its own metrics.  When several workers serve the app (see gunicorn.conf.py),
+METRICS_DIR should name a directory shared by them: each process then writes a snapshot of
+its metrics there every SNAPSHOT_INTERVAL seconds, and /metrics serves the sum of the
+snapshots of the live processes.
+With PROFILE_REQUESTS=1, ProfilingMiddleware profiles any request with a profile argument
+with cProfile, and returns the profile instead of the response: profile=pstats returns a
+pstats dump (for pstats, snakeviz, or flameprof, which draws it as a flame graph), and
+profile=text the functions with the highest cumulative time.
+'''
+import bisect
+import copy
+import cProfile
+import io
+import json
+import logging
+import marshal
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qs
+
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+BYTE_BUCKETS = (1024, 16 * 1024, 256 * 1024, 1024 ** 2, 16 * 1024 ** 2, 256 * 1024 ** 2, 1024 ** 3)
+# Seconds between the snapshots a process writes to METRICS_DIR
+SNAPSHOT_INTERVAL = 10
+PROFILE_FORMATS = {'1': 'pstats', 'pstats': 'pstats', 'text': 'text'}
+# The number of functions listed in a profile=text profile
+PROFILE_TEXT_LINES = 60
+
+# {name: metric} of every metric
+REGISTRY = {}
+
+
+class Metric:
+  '''
+  A metric with a name, a help string, and label names; its value for each combination of
+  label values is kept separately.  Registers itself in REGISTRY.
+  Arguments:
+    name: the name of the metric
+    help: a description of the metric
+    labelnames: the names of the labels of the metric
+  '''
+  metric_type = None
+
+  def __init__(self, name, help, labelnames = ()):
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self.values = {}
+    self.lock = threading.Lock()
+    REGISTRY[name] = self
+
+  def _key(self, labels):
+    # The label values of labels, in the order of labelnames
+    return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+  def reset(self):
+    '''
+    Drop every value of the metric
+    '''
+    with self.lock:
+      self.values = {}
+
+  def snapshot(self):
+    '''
+    The metric as a JSONifiable dictionary
+    '''
+    with self.lock:
+      values = [[list(key), copy.deepcopy(value)] for (key, value) in self.values.items()]
+    return {"type": self.metric_type, "help": self.help, "labelnames": list(self.labelnames), "values": values}
+
+
+class Counter(Metric):
+  '''
+  A count which only goes up
+  '''
+  metric_type = 'counter'
+
+  def inc(self, amount = 1, **labels):
+    '''
+    Add amount to the count for labels
+    '''
+    key = self._key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+  '''
+  The distribution of a value, as counts of observations in buckets, with their sum and count
+  Arguments:
+    name, help, labelnames: as Metric
+    buckets: the upper bounds of the buckets, in increasing order
+  '''
+  metric_type = 'histogram'
+
+  def __init__(self, name, help, labelnames = (), buckets = LATENCY_BUCKETS):
+    super(Histogram, self).__init__(name, help, labelnames)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value, **labels):
+    '''
+    Record an observation of value for labels
+    '''
+    key = self._key(labels)
+    index = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      state = self.values.get(key)
+      if state is None:
+        state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+      state[0][index] += 1
+      state[1] += value
+      state[2] += 1
+
+  @contextmanager
+  def time(self, **labels):
+    '''
+    A context manager which observes the seconds spent in its body
+    '''
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - start, **labels)
+
+  def snapshot(self):
+    result = super(Histogram, self).snapshot()
+    result["buckets"] = list(self.buckets)
+    return result
+
+
+REQUEST_SECONDS = Histogram('wiki_request_duration_seconds', 'Time to handle a request, to the start of the response', ['endpoint'])
+RESPONSES = Counter('wiki_responses_total', 'Responses sent, by status code', ['endpoint', 'status'])
+STAGE_SECONDS = Histogram('wiki_stage_duration_seconds', 'Time spent in each stage of the work', ['stage'])
+ROWS_SCANNED = Histogram('wiki_rows_scanned', 'Rows examined by a page query', buckets = ROW_BUCKETS)
+ROWS_RETURNED = Histogram('wiki_rows_returned', 'Rows returned by a page query', buckets = ROW_BUCKETS)
+BUCKET_BYTES = Histogram('wiki_bucket_bytes', 'Bytes of a read from, or a write to, the bucket', ['operation'], buckets = BYTE_BUCKETS)
+
+
+def snapshot():
+  '''
+  The metrics of this process, as a JSONifiable dictionary {name: metric snapshot}
+  '''
+  return {name: metric.snapshot() for (name, metric) in list(REGISTRY.items())}
+
+
+def reset():
+  '''
+  Drop the values of every metric; called in a forked worker, whose parent's values are reported by the parent
+  '''
+  for metric in list(REGISTRY.values()):
+    metric.reset()
+
+
+def merge(snapshots):
+  '''
+  The sum of several snapshots, which must have the same buckets for each histogram
+  '''
+  result = {}
+  for snapshot in snapshots:
+    for (name, metric) in snapshot.items():
+      merged = result.setdefault(name, dict(metric, values = {}))
+      for (key, value) in metric["values"]:
+        key = tuple(key)
+        current = merged["values"].get(key)
+        if current is None:
+          merged["values"][key] = value
+        elif metric["type"] == 'counter':
+          merged["values"][key] = current + value
+        else:
+          merged["values"][key] = [[a + b for (a, b) in zip(current[0], value[0])], current[1] + value[1], current[2] + value[2]]
+  for metric in result.values():
+    metric["values"] = [[list(key), value] for (key, value) in metric["values"].items()]
+  return result
+
+
+def _labels(labelnames, key, extra = None):
+  # The Prometheus label set of key, with the (name, value) pair extra
+  pairs = list(zip(labelnames, key)) + ([extra] if extra is not None else [])
+  if len(pairs) == 0:
+    return ''
+  escaped = [(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for (name, value) in pairs]
+  return '{' + ','.join(f'{name}="{value}"' for (name, value) in escaped) + '}'
+
+
+def _number(value):
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition(snapshot):
+  '''
+  A snapshot in the Prometheus text exposition format
+  '''
+  lines = []
+  for (name, metric) in sorted(snapshot.items()):
+    lines.append(f'# HELP {name} {metric["help"]}')
+    lines.append(f'# TYPE {name} {metric["type"]}')
+    for (key, value) in metric["values"]:
+      if metric["type"] == 'counter':
+        lines.append(f'{name}{_labels(metric["labelnames"], key)} {_number(value)}')
+        continue
+      (counts, total, count) = value
+      cumulative = 0
+      for (bound, bucket_count) in zip(list(metric["buckets"]) + ['+Inf'], counts):
+        cumulative += bucket_count
+        lines.append(f'{name}_bucket{_labels(metric["labelnames"], key, ("le", str(bound)))} {cumulative}')
+      lines.append(f'{name}_sum{_labels(metric["labelnames"], key)} {_number(total)}')
+      lines.append(f'{name}_count{_labels(metric["labelnames"], key)} {count}')
+  return '\n'.join(lines) + '\n'
+
+
+def _alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+def write_snapshot(directory):
+  '''
+  Write the snapshot of this process to <directory>/<pid>.json, atomically
+  '''
+  path = os.path.join(directory, f'{os.getpid()}.json')
+  with open(f'{path}.tmp', 'w') as snapshot_file:
+    json.dump(snapshot(), snapshot_file)
+  os.replace(f'{path}.tmp', path)
+
+
+def collect(directory = None):
+  '''
+  The metrics to serve: those of this process, or, if directory is given, the sum of the
+  snapshots in directory of the live processes, after writing the snapshot of this one.
+  The snapshots of processes which have exited are removed
+  '''
+  if directory is None:
+    return snapshot()
+  write_snapshot(directory)
+  snapshots = []
+  for entry in os.listdir(directory):
+    if not entry.endswith('.json') or not entry[:-5].isdigit():
+      continue
+    path = os.path.join(directory, entry)
+    if not _alive(int(entry[:-5])):
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      continue
+    try:
+      with open(path) as snapshot_file:
+        snapshots.append(json.load(snapshot_file))
+    except (OSError, ValueError):
+      pass
+  return merge(snapshots)
+
+
+def start_snapshots(directory, interval = SNAPSHOT_INTERVAL):
+  '''
+  Write the snapshot of this process to directory every interval seconds, on a daemon thread
+  '''
+  def run():
+    while True:
+      time.sleep(interval)
+      try:
+        write_snapshot(directory)
+      except OSError as e:
+        logger.warning(f'Metrics snapshot not written to {directory}: {e}')
+  threading.Thread(target = run, name = 'metrics-snapshot', daemon = True).start()
+
+
+def init_app(app):
+  '''
+  Time every request to app, and count the responses.  Should be called before other
+  before_request hooks are added, so that requests they answer are timed too
+  '''
+  @app.before_request
+  def start_timer():
+    g.metrics_start = time.perf_counter()
+
+  @app.after_request
+  def record(response):
+    start = g.pop('metrics_start', None)
+    if start is not None:
+      endpoint = request.endpoint or 'unknown'
+      REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint = endpoint)
+      RESPONSES.inc(endpoint = endpoint, status = response.status_code)
+    return response
+
+
+class ProfilingMiddleware:
+  '''
+  WSGI middleware which profiles requests with a profile argument (see PROFILE_FORMATS) with
+  cProfile, and returns the profile in place of the response.  The status of the
+  response that was replaced is in the X-Profiled-Status header
+  Arguments:
+    wsgi_app: the WSGI app to profile
+  '''
+  def __init__(self, wsgi_app):
+    self.wsgi_app = wsgi_app
+
+  def __call__(self, environ, start_response):
+    profile_format = PROFILE_FORMATS.get(parse_qs(environ.get('QUERY_STRING', '')).get('profile', [None])[0])
+    if profile_format is None:
+      return self.wsgi_app(environ, start_response)
+    status = {}
+    def capture(response_status, headers, exc_info = None):
+      status['status'] = response_status
+      return lambda data: None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+      body = self.wsgi_app(environ, capture)
+      try:
+        for _ in body:
+          pass
+      finally:
+        if hasattr(body, 'close'): body.close()
+    finally:
+      profiler.disable()
+    if profile_format == 'text':
+      output = io.StringIO()
+      pstats.Stats(profiler, stream = output).sort_stats('cumulative').print_stats(PROFILE_TEXT_LINES)
+      (data, headers) = (output.getvalue().encode('utf-8'), [('Content-Type', 'text/plain; charset=utf-8')])
+    else:
+      profiler.create_stats()
+      data = marshal.dumps(profiler.stats)
+      headers = [('Content-Type', 'application/octet-stream'), ('Content-Disposition', 'attachment; filename="request.pstats"')]
+    headers += [('Content-Length', str(len(data))), ('X-Profiled-Status', status.get('status', '')), ('Cache-Control', 'no-store')]
+    start_response('200 OK', headers)
+    return [data]
@@ -0,0 +1,134 @@
+'''
+A planner for SDQL filters, which uses the statistics of a table (see table_stats) to find
+the filters that can be answered without scanning the table, and to estimate the number
+of rows that pass the others.  plan_filter returns one of three plans:
+  empty: no row can pass the filter (e.g. IN_RANGE of 1000..5000 on a column whose max is 800)
+  all: every row passes the filter (e.g. a range that covers the column's min and max)
+  scan: the table must be scanned; rows is then an estimate of the number of rows that pass
+Estimates assume values are spread uniformly between min and max, that values not in
+top_k are equally common, and that the arguments of ALL and ANY are independent.  When a
+leaf is answered exactly from the statistics (e.g. an IN_LIST over a column whose top_k
+is complete), the plan is marked exact.
+'''
+from sdtp import SDQLFilter
+from table_query import PLAN_EMPTY, PLAN_ALL
+from table_stats import typed_value
+
+PLAN_SCAN = 'scan'
+# The selectivity assumed when the statistics say nothing about a filter
+DEFAULT_SELECTIVITY = 0.5
+
+
+def _position(value, min_val, max_val):
+  # The fraction of the way from min_val to max_val of value, for numbers, dates, and datetimes, or None
+  try:
+    span = max_val - min_val
+    offset = value - min_val
+    if hasattr(span, 'total_seconds'):
+      (span, offset) = (span.total_seconds(), offset.total_seconds())
+    if span <= 0:
+      return None
+    return min(1.0, max(0.0, offset / span))
+  except TypeError:
+    return None
+
+
+def _top_counts(column_stats):
+  # The top_k of column_stats as a dictionary {typed value: count}
+  return {typed_value(column_stats, value): count for (value, count) in column_stats.get("top_k", [])}
+
+
+def _leaf(sdql_filter, column_stats, num_rows):
+  # The (selectivity, exact) of an IN_LIST, IN_RANGE, or REGEX_MATCH filter
+  if num_rows == 0:
+    return (0.0, True)
+  present = column_stats["count"] - column_stats["null_count"]
+  if present == 0:
+    return (0.0, True)
+  present_fraction = present / num_rows
+  (min_val, max_val) = (typed_value(column_stats, column_stats["min"]), typed_value(column_stats, column_stats["max"]))
+  complete = column_stats.get("top_k_complete", False)
+  operator = sdql_filter.operator
+
+  if operator == 'IN_RANGE':
+    (low, high) = (sdql_filter.min_val, sdql_filter.max_val)
+    if high < low or high < min_val or low > max_val:
+      return (0.0, True)
+    if low <= min_val and max_val <= high:
+      return (present_fraction, True)
+    if complete:
+      return (sum(count for (value, count) in _top_counts(column_stats).items() if low <= value <= high) / num_rows, True)
+    (start, end) = (_position(max(low, min_val), min_val, max_val), _position(min(high, max_val), min_val, max_val))
+    if start is None or end is None:
+      return (present_fraction * DEFAULT_SELECTIVITY, False)
+    return (present_fraction * (end - start), False)
+
+  if operator == 'IN_LIST':
+    values = {value for value in sdql_filter.value_list if min_val <= value <= max_val}
+    if len(values) == 0:
+      return (0.0, True)
+    top = _top_counts(column_stats)
+    known = sum(top.get(value, 0) for value in values)
+    if complete:
+      return (known / num_rows, True)
+    unknown_values = len([value for value in values if value not in top])
+    other_distinct = max(1, column_stats["distinct"] - len(top))
+    other_rows = max(0, present - sum(top.values()))
+    return (min(present_fraction, (known + unknown_values * other_rows / other_distinct) / num_rows), False)
+
+  if operator == 'REGEX_MATCH' and complete:
+    matched = sum(count for (value, count) in _top_counts(column_stats).items() if sdql_filter.regex.fullmatch(value) is not None)
+    return (matched / num_rows, True)
+  return (present_fraction * DEFAULT_SELECTIVITY, False)
+
+
+def _selectivity(sdql_filter, stats):
+  # The (selectivity, exact) of sdql_filter over the table with statistics stats
+  operator = sdql_filter.operator
+  if operator in {'ALL', 'ANY', 'NONE'}:
+    parts = [_selectivity(argument, stats) for argument in sdql_filter.arguments]
+    if operator == 'ALL':
+      if any(part == (0.0, True) for part in parts):
+        return (0.0, True)
+      selectivity = 1.0
+      for (part, _) in parts:
+        selectivity *= part
+      # Exact only if at most one argument doesn't pass every row
+      return (selectivity, all(exact for (_, exact) in parts) and len([part for (part, _) in parts if part < 1.0]) <= 1)
+    miss = 1.0
+    for (part, _) in parts:
+      miss *= 1.0 - part
+    exact = all(exact for (_, exact) in parts) and len([part for (part, _) in parts if part > 0.0]) <= 1
+    if any(part == (1.0, True) for part in parts):
+      (miss, exact) = (0.0, True)
+    return (1.0 - miss, exact) if operator == 'ANY' else (miss, exact)
+  return _leaf(sdql_filter, stats["columns"][sdql_filter.column_name], stats["num_rows"])
+
+
+def plan_filter(filter_spec, schema, stats):
+  '''
+  Plan filter_spec over a table with schema and statistics stats.  Raises an InvalidDataException
+  if filter_spec isn't a valid filter for the table.
+  Arguments:
+    filter_spec: an SDQL filter specification
+    schema: the schema of the table
+    stats: the statistics of the table, from table_stats
+  Returns:
+    A dictionary {"plan", "rows", "selectivity", "exact"}: plan is PLAN_EMPTY, PLAN_ALL, or PLAN_SCAN,
+    rows the (estimated, unless exact) number of rows which pass the filter, and selectivity
+    the fraction of the table's rows
+  '''
+  sdql_filter = SDQLFilter(filter_spec, schema)
+  num_rows = stats["num_rows"]
+  try:
+    (selectivity, exact) = _selectivity(sdql_filter, stats)
+  except (TypeError, KeyError):
+    (selectivity, exact) = (DEFAULT_SELECTIVITY, False)
+  rows = round(selectivity * num_rows)
+  if exact and rows == 0:
+    plan = PLAN_EMPTY
+  elif exact and rows == num_rows:
+    plan = PLAN_ALL
+  else:
+    plan = PLAN_SCAN
+  return {"plan": plan, "rows": rows, "selectivity": selectivity, "exact": exact}
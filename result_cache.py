@@ -0,0 +1,170 @@
+'''
+A cache of filtered table pages.  Users of /filter_table tend to run the same sample
+queries over the same tables again and again, so the pages computed by
+table_query.get_page are cached, keyed by the table name, a canonical form of the
+SDQL filter, and the page offset and limit.  The cache is bounded by the (estimated)
+size of the cached rows, evicting the least-recently used pages first, and entries
+expire after a fixed time to live.  All entries for a table are dropped when the
+table is replaced.  A page computed from the old table may be put after that; to keep
+it out, the caller reads the table's epoch before reading the table, and passes it to put,
+which drops the page if the table has been invalidated since.
+'''
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_CACHE_TTL = 300
+
+
+def _sort_key(value):
+  # Sort key for values of any JSON type, so mixed-type lists can be ordered
+  return json.dumps(value, sort_keys=True, default=str)
+
+
+def _canonical_form(spec):
+  # The canonical form of a (decoded) SDQL filter: the values of IN_LIST and the arguments
+  # of ALL, ANY, and NONE are sorted, since their order doesn't change the result
+  if isinstance(spec, list):
+    return [_canonical_form(element) for element in spec]
+  if not isinstance(spec, dict):
+    return spec
+  form = {key: _canonical_form(value) for (key, value) in spec.items()}
+  operator = form.get('operator')
+  if operator == 'IN_LIST' and isinstance(form.get('values'), list):
+    form['values'] = sorted(form['values'], key=_sort_key)
+  elif operator in {'ALL', 'ANY', 'NONE'} and isinstance(form.get('arguments'), list):
+    form['arguments'] = sorted(form['arguments'], key=_sort_key)
+  return form
+
+
+def canonical_filter(filter_spec):
+  '''
+  Return a canonical string form of filter_spec, which is the same for specifications
+  which differ only in key order, whitespace, or the order of the values of an IN_LIST
+  (or of the arguments of ALL, ANY, and NONE).
+  Arguments:
+    filter_spec: an SDQL filter, as a dictionary, or None
+  '''
+  return json.dumps(_canonical_form(filter_spec), sort_keys=True, separators=(',', ':'), default=str)
+
+
+def estimate_page_size(page):
+  '''
+  Estimate the memory held by the rows of a page, in bytes
+  Arguments:
+    page: a page returned by table_query.get_page
+  '''
+  rows = page["rows"]
+  return sys.getsizeof(rows) + sum(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) for row in rows)
+
+
+class FilteredResultCache:
+  '''
+  An LRU cache of filtered pages, bounded by max_bytes, whose entries expire after ttl seconds.
+  The cache is thread-safe.  The hit, miss, and eviction counters are returned by stats().
+  Arguments:
+    max_bytes: the maximum estimated size of the cached rows
+    ttl: the time to live of an entry, in seconds
+  '''
+  def __init__(self, max_bytes = DEFAULT_CACHE_BYTES, ttl = DEFAULT_CACHE_TTL):
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.table_keys = {}
+    self.epochs = {}
+    self.current_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.lock = threading.Lock()
+
+  def _key(self, table_name, filter_spec, offset, limit):
+    return (table_name, canonical_filter(filter_spec), offset, limit)
+
+  def get(self, table_name, filter_spec, offset, limit):
+    '''
+    Return the cached page for (table_name, filter_spec, offset, limit), or None if it isn't
+    cached or has expired
+    '''
+    key = self._key(table_name, filter_spec, offset, limit)
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and entry["expires"] < time.monotonic():
+        self._remove(key)
+        entry = None
+      if entry is None:
+        self.misses += 1
+        return None
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry["page"]
+
+  def epoch(self, table_name):
+    '''
+    Return the number of times table_name has been invalidated.  Read it before reading the
+    table a page is computed from, and pass it to put
+    '''
+    with self.lock:
+      return self.epochs.get(table_name, 0)
+
+  def put(self, table_name, filter_spec, offset, limit, page, epoch = None):
+    '''
+    Cache page as the result for (table_name, filter_spec, offset, limit), evicting the least
+    recently used entries as needed to stay within max_bytes.  Pages larger than max_bytes
+    are not cached, nor are pages whose epoch is older than the table's, since they may have
+    been computed from a table which has since been replaced.
+    Arguments:
+      epoch: the value of self.epoch(table_name) before the table was read, or None to skip the check
+    '''
+    key = self._key(table_name, filter_spec, offset, limit)
+    size = estimate_page_size(page)
+    if size > self.max_bytes:
+      return
+    with self.lock:
+      if epoch is not None and epoch != self.epochs.get(table_name, 0):
+        return
+      if key in self.entries:
+        self._remove(key)
+      while self.current_bytes + size > self.max_bytes and len(self.entries) > 0:
+        self._remove(next(iter(self.entries)))
+        self.evictions += 1
+      self.entries[key] = {"page": page, "size": size, "expires": time.monotonic() + self.ttl}
+      self.table_keys.setdefault(table_name, set()).add(key)
+      self.current_bytes += size
+
+  def invalidate(self, table_name):
+    '''
+    Drop every cached page for table_name, and start a new epoch for it, so pages computed
+    before now aren't cached; called when the table is replaced
+    '''
+    with self.lock:
+      self.epochs[table_name] = self.epochs.get(table_name, 0) + 1
+      for key in list(self.table_keys.get(table_name, [])):
+        self._remove(key)
+
+  def _remove(self, key):
+    # Remove key from the cache.  The caller must hold self.lock
+    entry = self.entries.pop(key)
+    self.current_bytes -= entry["size"]
+    table_keys = self.table_keys[key[0]]
+    table_keys.discard(key)
+    if len(table_keys) == 0:
+      del self.table_keys[key[0]]
+
+  def stats(self):
+    '''
+    Return the cache counters as a dictionary
+    '''
+    with self.lock:
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "entries": len(self.entries),
+        "bytes": self.current_bytes,
+        "max_bytes": self.max_bytes,
+        "ttl": self.ttl
+      }
@@ -0,0 +1,439 @@
+'''
+A chunked layout for the RowTables behind uploaded tables, so that a filter reads only
+the parts of a table it can match.  The rows are split into row groups of row_group_size rows,
+and stored in two blobs:
+  rowgroups/<name>.rows: the row groups, one after another, each a JSON list of rows on one line
+  rowgroups/<name>.json: the manifest, with the schema, the generation of the .rows blob,
+    and for each row group its byte offset and length in the .rows blob, its number of
+    rows, and its zone map: the [min, max, null_count] of each column in the row group
+The table served from this layout is a ChunkedGCSTable, whose specification is
+{"schema", "type": "ChunkedGCSTable", "bucket", "manifest"}.  When an IN_RANGE or IN_LIST
+filter (alone, or inside ALL or ANY) can't match any value between a row group's min and max,
+the row group is skipped; the others are fetched with ranged reads, adjacent row groups
+in a single request.  Tables in the old single-blob layout are GCSTables, and are unaffected.
+'''
+import json
+import tempfile
+import threading
+from collections import OrderedDict
+
+import ijson
+
+from sdtp import SDMLTable, SDMLTableFactory, InvalidDataException
+from sdtp import jsonifiable_value, jsonifiable_rows, jsonifiable_column, convert_to_type, convert_rows_to_type_list
+from sdtp.sdtp_table import ReloadableTable
+
+ROW_GROUP_PREFIX = 'rowgroups'
+DEFAULT_ROW_GROUP_SIZE = 10000
+MANIFEST_FORMAT_VERSION = 1
+# The most bytes fetched in one ranged request, when adjacent row groups are coalesced
+MAX_RANGE_BYTES = 16 * 1024 * 1024
+# The number of row groups read at a time when iterating over the rows of a table
+READ_AHEAD_GROUPS = 4
+# The number of decoded row groups each table keeps, so that paging through a table doesn't refetch them
+GROUP_CACHE_SIZE = 8
+
+
+def data_blob_name(table_name):
+  '''
+  The name of the blob holding the row groups of table_name
+  '''
+  return f'{ROW_GROUP_PREFIX}/{table_name}.rows'
+
+
+def manifest_blob_name(table_name):
+  '''
+  The name of the blob holding the manifest of table_name
+  '''
+  return f'{ROW_GROUP_PREFIX}/{table_name}.json'
+
+
+def sdml_rows(stream):
+  '''
+  Generate the rows of the SDML RowTable in stream (a binary file) one at a time, without
+  reading the whole file into memory
+  '''
+  stream.seek(0)
+  try:
+    yield from ijson.items(stream, 'rows.item', use_float = True)
+  except ijson.JSONError as e:
+    raise InvalidDataException(f'JSON Decode Error {str(e)} when reading the rows')
+
+
+def _is_missing(value):
+  return value is None or (isinstance(value, float) and value != value)
+
+
+def typed_rows(types, rows):
+  '''
+  Convert rows in JSON form to the SDML types in types, as convert_rows_to_type_list, except
+  that missing values (null, which convert.write_sdml writes for empty cells) are kept:
+  as NaN in number columns and None in the others
+  '''
+  if not any(value is None for row in rows for value in row):
+    return convert_rows_to_type_list(types, rows)
+  for row in rows:
+    if len(row) != len(types):
+      raise InvalidDataException(f'Length mismatch: required number of columns {len(types)}, length {row} = {len(row)}')
+  missing = [float('nan') if sdml_type == 'number' else None for sdml_type in types]
+  return [
+    [convert_to_type(types[i], value) if value is not None else missing[i] for (i, value) in enumerate(row)]
+    for row in rows
+  ]
+
+
+def json_rows(rows, types):
+  '''
+  The JSON form of rows, as jsonifiable_rows, except that missing values are null
+  '''
+  if not any(_is_missing(value) for row in rows for value in row):
+    return jsonifiable_rows(rows, types)
+  return [
+    [jsonifiable_value(value, types[i]) if not _is_missing(value) else None for (i, value) in enumerate(row)]
+    for row in rows
+  ]
+
+
+def _zone(values, sdml_type):
+  # The [min, max, null_count] of a column of a row group, with min and max in JSON form
+  present = [value for value in values if not _is_missing(value)]
+  if len(present) == 0:
+    return [None, None, len(values)]
+  return [jsonifiable_value(min(present), sdml_type), jsonifiable_value(max(present), sdml_type), len(values) - len(present)]
+
+
+def write_row_groups(schema, rows, output, row_group_size = DEFAULT_ROW_GROUP_SIZE):
+  '''
+  Write rows to output in the row-group layout.  The rows are converted to the types of
+  the schema, raising an InvalidDataException if a value can't be, and only one row group is
+  held in memory at a time.
+  Arguments:
+    schema: the schema of the table
+    rows: an iterable of rows, in JSON form
+    output: a binary file the row groups are written to
+    row_group_size: the number of rows in each row group
+  Returns:
+    The list of row group entries of the manifest, {"offset", "length", "num_rows", "zones"}
+  '''
+  types = [column["type"] for column in schema]
+  groups = []
+  offset = 0
+
+  def flush(group):
+    nonlocal offset
+    try:
+      typed = typed_rows(types, group)
+    except Exception as e:
+      raise InvalidDataException(f'Error {e} converting rows {sum(entry["num_rows"] for entry in groups)}.. to {types}')
+    data = (json.dumps(json_rows(typed, types)) + '\n').encode('utf-8')
+    output.write(data)
+    zones = [_zone([row[i] for row in typed], sdml_type) for (i, sdml_type) in enumerate(types)]
+    groups.append({"offset": offset, "length": len(data), "num_rows": len(typed), "zones": zones})
+    offset += len(data)
+
+  group = []
+  for row in rows:
+    if len(row) != len(types):
+      raise InvalidDataException(f'Row {row} has {len(row)} values, but the schema has {len(types)} columns')
+    group.append(row)
+    if len(group) == row_group_size:
+      flush(group)
+      group = []
+  if len(group) > 0:
+    flush(group)
+  return groups
+
+
+def upload_row_groups(bucket, table_name, schema, sdml_stream, row_group_size = DEFAULT_ROW_GROUP_SIZE, uploads = ()):
+  '''
+  Store the SDML RowTable in sdml_stream in the bucket in the row-group layout.  The row
+  groups are written to a temporary file and uploaded first; the manifest, which pins
+  the generation of the row groups, is then uploaded together with uploads.
+  Arguments:
+    bucket: the SDMLStorageBucket (or MemoryStorageBucket)
+    table_name: the name of the table
+    schema: the schema of the table
+    sdml_stream: a binary file holding the SDML RowTable
+    row_group_size: the number of rows in each row group
+    uploads: further uploads, as for bucket.upload_tables, made with the manifest
+  Returns:
+    The generations of the blobs of uploads
+  '''
+  with tempfile.TemporaryFile() as output:
+    groups = write_row_groups(schema, sdml_rows(sdml_stream), output, row_group_size)
+    [generation] = bucket.upload_tables([{"blob": data_blob_name(table_name), "stream": output}])
+  manifest = {
+    "format": MANIFEST_FORMAT_VERSION,
+    "schema": schema,
+    "blob": data_blob_name(table_name),
+    "generation": generation,
+    "num_rows": sum(group["num_rows"] for group in groups),
+    "row_group_size": row_group_size,
+    "row_groups": groups
+  }
+  generations = bucket.upload_tables([{"blob": manifest_blob_name(table_name), "table": manifest}] + list(uploads))
+  return generations[1:]
+
+
+def may_match(sdql_filter, zones):
+  '''
+  Return False if no row of a row group with zone map zones can pass sdql_filter, and True otherwise
+  Arguments:
+    sdql_filter: an SDQLFilter
+    zones: the zone map of the row group, a list of [min, max, null_count] per column, with typed values
+  '''
+  operator = sdql_filter.operator
+  if operator == 'ALL':
+    return all(may_match(argument, zones) for argument in sdql_filter.arguments)
+  if operator == 'ANY':
+    return any(may_match(argument, zones) for argument in sdql_filter.arguments)
+  if operator == 'NONE':
+    return True
+  (min_val, max_val, _) = zones[sdql_filter.column_index]
+  if min_val is None:
+    return False
+  try:
+    if operator == 'IN_RANGE':
+      return sdql_filter.min_val <= sdql_filter.max_val and sdql_filter.min_val <= max_val and min_val <= sdql_filter.max_val
+    if operator == 'IN_LIST':
+      return any(min_val <= value <= max_val for value in sdql_filter.value_list)
+  except TypeError:
+    return True
+  return True
+
+
+def chunked_table(table):
+  '''
+  Return the ChunkedGCSTable that holds the data of table, or None if table isn't chunked
+  Arguments:
+    table: an SDMLTable
+  '''
+  if isinstance(table, ChunkedGCSTable):
+    return table
+  if isinstance(table, ReloadableTable):
+    if table.inner_table is None: table.load()
+    return chunked_table(table.inner_table)
+  return None
+
+
+class ChunkedRows:
+  '''
+  A read-only sequence of the rows of some of the row groups of a ChunkedGCSTable.  Indexing
+  and slicing fetch only the row groups holding the rows asked for, and iteration fetches
+  READ_AHEAD_GROUPS row groups at a time, so that a scan which stops early doesn't read the whole table.
+  Arguments:
+    table: the ChunkedGCSTable
+    groups: the indices of the row groups, in order
+  '''
+  def __init__(self, table, groups):
+    self.table = table
+    self.groups = groups
+    self.starts = [0]
+    for group in groups:
+      self.starts.append(self.starts[-1] + table.manifest["row_groups"][group]["num_rows"])
+
+  def __len__(self):
+    return self.starts[-1]
+
+  def _rows(self, start, stop):
+    # The rows start..stop - 1, fetching only the row groups that hold them
+    if stop <= start:
+      return []
+    first = next(i for i in range(len(self.groups)) if self.starts[i + 1] > start)
+    last = next(i for i in range(first, len(self.groups)) if self.starts[i + 1] >= stop)
+    rows = [row for group in self.table.read_groups(self.groups[first:last + 1]) for row in group]
+    return rows[start - self.starts[first]:stop - self.starts[first]]
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      (start, stop, step) = key.indices(len(self))
+      return self._rows(start, stop)[::step] if step > 0 else list(self)[key]
+    if key < 0: key += len(self)
+    if key < 0 or key >= len(self):
+      raise IndexError('row index out of range')
+    return self._rows(key, key + 1)[0]
+
+  def __iter__(self):
+    for start in range(0, len(self.groups), READ_AHEAD_GROUPS):
+      for group in self.table.read_groups(self.groups[start:start + READ_AHEAD_GROUPS]):
+        yield from group
+
+
+class ChunkedGCSTable(SDMLTable):
+  '''
+  A table stored in the row-group layout.  The manifest is read the first time the table
+  is used; row groups are read with ranged requests, pinned to the generation recorded
+  in the manifest, and the most recently used GROUP_CACHE_SIZE are kept decoded.  If the
+  row groups have been replaced since the manifest was read, the read fails with an
+  InvalidDataException and the manifest is read again on the next request.
+  Arguments:
+    schema: the schema, as usual
+    bucket_name: the name of the GCS bucket
+    manifest: the name of the blob holding the manifest
+    bucket: the SDMLStorageBucket the blobs are read from
+  '''
+  def __init__(self, schema, bucket_name, manifest, bucket):
+    super(ChunkedGCSTable, self).__init__(schema)
+    self.bucket_name = bucket_name
+    self.manifest_name = manifest
+    self.bucket = bucket
+    self.loaded = None
+    self.group_cache = OrderedDict()
+    self.lock = threading.Lock()
+
+  def _load(self):
+    # The (manifest, zone maps) of the table, reading the manifest from the bucket if it hasn't been
+    # read.  The zone maps are those of the manifest, with the values converted to the column types
+    loaded = self.loaded
+    if loaded is None:
+      manifest = self.bucket.get_table_as_dictionary(self.manifest_name)
+      if manifest.get("format") != MANIFEST_FORMAT_VERSION:
+        raise InvalidDataException(f'{self.manifest_name} has format {manifest.get("format")}, not {MANIFEST_FORMAT_VERSION}')
+      types = self.column_types()
+      typed = lambda sdml_type, value: convert_to_type(sdml_type, value) if value is not None else None
+      zones = [
+        [[typed(types[i], zone[0]), typed(types[i], zone[1]), zone[2]] for (i, zone) in enumerate(group["zones"])]
+        for group in manifest["row_groups"]
+      ]
+      loaded = (manifest, zones)
+      with self.lock:
+        self.loaded = loaded
+        self.group_cache.clear()
+    return loaded
+
+  @property
+  def manifest(self):
+    '''
+    The manifest of the table, read from the bucket if it hasn't been
+    '''
+    return self._load()[0]
+
+  def _reset(self):
+    # Drop the manifest and the cached row groups, which are stale
+    with self.lock:
+      self.loaded = None
+      self.group_cache.clear()
+
+  def matching_groups(self, sdql_filter = None):
+    '''
+    The indices of the row groups which may hold rows passing sdql_filter (all of them, if sdql_filter is None)
+    '''
+    (manifest, zones) = self._load()
+    groups = manifest["row_groups"]
+    if sdql_filter is None:
+      return list(range(len(groups)))
+    return [i for i in range(len(groups)) if may_match(sdql_filter, zones[i])]
+
+  def rows(self, sdql_filter = None):
+    '''
+    The rows of the row groups which may hold rows passing sdql_filter, as a ChunkedRows sequence.
+    The rows are not filtered
+    '''
+    return ChunkedRows(self, self.matching_groups(sdql_filter))
+
+  def read_groups(self, indices):
+    '''
+    Read the row groups indices, returning a list of the rows of each, converted to the
+    types of the schema.  Row groups which aren't cached are fetched concurrently, with
+    adjacent row groups coalesced into a single ranged request.
+    '''
+    manifest = self.manifest
+    groups = manifest["row_groups"]
+    with self.lock:
+      result = {index: self.group_cache[index] for index in indices if index in self.group_cache}
+      for index in result: self.group_cache.move_to_end(index)
+    missing = sorted(set(indices) - set(result.keys()))
+    runs = []
+    for index in missing:
+      group = groups[index]
+      if len(runs) > 0 and runs[-1][-1] == index - 1 and group["offset"] + group["length"] - groups[runs[-1][0]]["offset"] <= MAX_RANGE_BYTES:
+        runs[-1].append(index)
+      else:
+        runs.append([index])
+    ranges = [(groups[run[0]]["offset"], groups[run[-1]]["offset"] + groups[run[-1]]["length"] - 1) for run in runs]
+    parts = self.bucket.download_ranges(manifest["blob"], ranges, manifest["generation"]) if len(ranges) > 0 else []
+    if parts is None:
+      self._reset()
+      raise InvalidDataException(f'{manifest["blob"]} was replaced while it was being read')
+    types = self.column_types()
+    for (run, data) in zip(runs, parts):
+      base = groups[run[0]]["offset"]
+      for index in run:
+        group = groups[index]
+        segment = data[group["offset"] - base:group["offset"] - base + group["length"]]
+        result[index] = typed_rows(types, json.loads(segment))
+    with self.lock:
+      for index in missing:
+        self.group_cache[index] = result[index]
+      while len(self.group_cache) > GROUP_CACHE_SIZE:
+        self.group_cache.popitem(last = False)
+    return [result[index] for index in indices]
+
+  def _column_values(self, column_name):
+    # The values of column_name over the whole table, and its type
+    names = self.column_names()
+    if column_name not in names:
+      raise InvalidDataException(f'{column_name} is not a column of this table')
+    index = names.index(column_name)
+    return ([row[index] for row in self.rows()], self.column_types()[index])
+
+  def all_values(self, column_name, jsonify = False):
+    (values, sdml_type) = self._column_values(column_name)
+    result = sorted(set(value for value in values if not _is_missing(value)))
+    return jsonifiable_column(result, sdml_type) if jsonify else result
+
+  def get_column(self, column_name, jsonify = False):
+    (values, sdml_type) = self._column_values(column_name)
+    return jsonifiable_column(values, sdml_type) if jsonify else values
+
+  def range_spec(self, column_name, jsonify = False):
+    # The min and max of a column are those of its zone maps, so no row group is read
+    names = self.column_names()
+    if column_name not in names:
+      raise InvalidDataException(f'{column_name} is not a column of this table')
+    index = names.index(column_name)
+    zones = [zone[index] for zone in self._load()[1] if zone[index][0] is not None]
+    if len(zones) == 0:
+      raise InvalidDataException(f'{column_name} has no values')
+    result = [min(zone[0] for zone in zones), max(zone[1] for zone in zones)]
+    return jsonifiable_column(result, self.column_types()[index]) if jsonify else result
+
+  def get_filtered_rows_from_filter(self, filter = None, columns = [], jsonify = False):
+    if columns is None: columns = []
+    groups = self.matching_groups(filter)
+    rows = [row for group in self.read_groups(groups) for row in group]
+    if filter is not None:
+      passing = filter.filter_index(rows)
+      rows = [row for (i, row) in enumerate(rows) if i in passing]
+    column_types = self.column_types()
+    if columns != []:
+      names = self.column_names()
+      column_indices = [i for i in range(len(names)) if names[i] in columns]
+      column_types = [column_types[i] for i in column_indices]
+      rows = [[row[i] for i in column_indices] for row in rows]
+    return json_rows(rows, column_types) if jsonify else rows
+
+  def to_dictionary(self):
+    return {
+      "schema": self.schema,
+      "type": 'ChunkedGCSTable',
+      "bucket": self.bucket_name,
+      "manifest": self.manifest_name
+    }
+
+
+class ChunkedGCSTableFactory(SDMLTableFactory):
+  '''
+  A factory which builds ChunkedGCSTables, reading their blobs from bucket
+  Arguments:
+    bucket: the SDMLStorageBucket holding the tables
+  '''
+  def __init__(self, bucket):
+    super(ChunkedGCSTableFactory, self).__init__('ChunkedGCSTable')
+    self.bucket = bucket
+
+  def build_table(self, table_spec):
+    super(ChunkedGCSTableFactory, self).build_table(table_spec)
+    if table_spec.get('bucket') != self.bucket.bucket_name:
+      raise InvalidDataException(f'ChunkedGCSTables must be in bucket {self.bucket.bucket_name}, not {table_spec.get("bucket")}')
+    return ChunkedGCSTable(table_spec['schema'], table_spec['bucket'], table_spec['manifest'], self.bucket)
@@ -0,0 +1,159 @@
+'''
+Streaming export of filtered tables.  The rows which pass an SDQL filter are produced a
+chunk at a time, and each chunk is encoded and sent before the next is computed, so the
+memory used by an export doesn't depend on the size of the result, and the first bytes
+are sent as soon as the first chunk is found:
+  columnar tables are filtered a block of rows at a time, with a vectorized mask over the block
+  other local tables are scanned row by row with table_query.compile_row_predicate (for tables
+    stored as row groups, only the row groups whose zone maps may match are read)
+  remote tables are filtered by the remote server, and the result is then sent in chunks
+The formats are:
+  ndjson: one JSON array per row, preceded by a line with the schema
+  csv: a header row of column names, then the rows
+  arrow: an Arrow IPC stream, one record batch per chunk (requires pyarrow)
+'''
+import csv
+import io
+import json
+
+from sdtp import SDQLFilter, InvalidDataException
+from columnar_cache import columnar_table
+from row_groups import chunked_table, json_rows
+from table_query import local_rows, compile_row_predicate
+from vector_filter import compile_mask
+
+try:
+  import pyarrow
+except ImportError:
+  pyarrow = None
+
+DEFAULT_EXPORT_CHUNK_ROWS = 65536
+EXPORT_FORMATS = {
+  'ndjson': 'application/x-ndjson',
+  'csv': 'text/csv',
+  'arrow': 'application/vnd.apache.arrow.stream'
+}
+
+
+def _columnar_chunks(sdql_filter, table, chunk_rows):
+  # The matching rows of the ColumnarTable table, a block of chunk_rows rows at a time
+  for start in range(0, table.num_rows, chunk_rows):
+    block = table.subset(slice(start, start + chunk_rows))
+    if sdql_filter is None:
+      yield block.decode_rows()
+      continue
+    mask = compile_mask(sdql_filter, block)
+    if mask is None:
+      predicate = compile_row_predicate(sdql_filter)
+      rows = [row for row in block.decode_rows() if predicate(row)]
+    else:
+      rows = block.decode_rows(mask().nonzero()[0])
+    if len(rows) > 0:
+      yield rows
+
+
+def _row_chunks(predicate, rows, chunk_rows):
+  # The rows that pass predicate (or all of the rows, if it is None), chunk_rows at a time
+  chunk = []
+  for row in rows:
+    if predicate is None or predicate(row):
+      chunk.append(row)
+      if len(chunk) == chunk_rows:
+        yield chunk
+        chunk = []
+  if len(chunk) > 0:
+    yield chunk
+
+
+def matching_row_chunks(table, filter_spec = None, chunk_rows = DEFAULT_EXPORT_CHUNK_ROWS):
+  '''
+  Generate the rows of table which pass filter_spec, as lists of at most chunk_rows rows.
+  The filter is checked when this is called, raising an InvalidDataException if it
+  isn't valid for the table; the rows are found as the chunks are consumed.
+  Arguments:
+    table: the SDMLTable to export
+    filter_spec: an SDQL filter specification, or None for all rows
+    chunk_rows: the maximum number of rows in a chunk
+  '''
+  sdql_filter = SDQLFilter(filter_spec, table.schema) if filter_spec is not None else None
+  columnar = columnar_table(table)
+  if columnar is not None:
+    return _columnar_chunks(sdql_filter, columnar, chunk_rows)
+  chunked = chunked_table(table) if sdql_filter is not None else None
+  rows = chunked.rows(sdql_filter) if chunked is not None else local_rows(table)
+  if rows is None:
+    return _row_chunks(None, table.get_filtered_rows_from_filter(sdql_filter), chunk_rows)
+  return _row_chunks(compile_row_predicate(sdql_filter) if sdql_filter is not None else None, rows, chunk_rows)
+
+
+def _ndjson(schema, chunks):
+  types = [column["type"] for column in schema]
+  yield json.dumps(schema) + '\n'
+  for chunk in chunks:
+    yield ''.join(json.dumps(row) + '\n' for row in json_rows(chunk, types))
+
+
+def _csv(schema, chunks):
+  types = [column["type"] for column in schema]
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  writer.writerow([column["name"] for column in schema])
+  yield buffer.getvalue()
+  for chunk in chunks:
+    buffer.seek(0)
+    buffer.truncate()
+    writer.writerows(json_rows(chunk, types))
+    yield buffer.getvalue()
+
+
+# The Arrow type of each SDML type
+_ARROW_TYPES = {
+  'string': lambda: pyarrow.string(),
+  'number': lambda: pyarrow.float64(),
+  'boolean': lambda: pyarrow.bool_(),
+  'date': lambda: pyarrow.date32(),
+  'datetime': lambda: pyarrow.timestamp('us'),
+  'timeofday': lambda: pyarrow.time64('us')
+}
+
+
+def _arrow(schema, chunks):
+  arrow_schema = pyarrow.schema([(column["name"], _ARROW_TYPES[column["type"]]()) for column in schema])
+  # The writer writes to sink, which is emptied after each batch, so only one batch is held at a time
+  sink = io.BytesIO()
+  writer = pyarrow.ipc.new_stream(sink, arrow_schema)
+  for chunk in chunks:
+    # Missing numbers are held as NaN; from_pandas makes them nulls, as in the other formats
+    columns = [pyarrow.array(column, type = field.type, from_pandas = True) for (column, field) in zip(zip(*chunk), arrow_schema)]
+    writer.write_batch(pyarrow.record_batch(columns, schema = arrow_schema))
+    yield _drain(sink)
+  writer.close()
+  yield _drain(sink)
+
+
+def _drain(sink):
+  # Return the bytes written to sink (an io.BytesIO), and empty it
+  data = sink.getvalue()
+  sink.seek(0)
+  sink.truncate()
+  return data
+
+
+def export_stream(table, filter_spec = None, export_format = 'ndjson', chunk_rows = DEFAULT_EXPORT_CHUNK_ROWS):
+  '''
+  Generate the rows of table which pass filter_spec, encoded in export_format, as a sequence
+  of strings (ndjson, csv) or bytes (arrow), one per chunk of rows.  Raises an
+  InvalidDataException if the filter or the format is invalid, before anything is generated.
+  Arguments:
+    table: the SDMLTable to export
+    filter_spec: an SDQL filter specification, or None for all rows
+    export_format: one of EXPORT_FORMATS
+    chunk_rows: the maximum number of rows in a chunk
+  '''
+  if export_format not in EXPORT_FORMATS:
+    raise InvalidDataException(f'Export format must be one of {sorted(EXPORT_FORMATS)}, not {export_format}')
+  if export_format == 'arrow' and pyarrow is None:
+    raise InvalidDataException('Arrow export requires pyarrow, which is not installed')
+  chunks = matching_row_chunks(table, filter_spec, chunk_rows)
+  encoders = {'ndjson': _ndjson, 'csv': _csv, 'arrow': _arrow}
+  return encoders[export_format](table.schema, chunks)
@@ -0,0 +1,104 @@
+'''
+Secondary indexes over the columns of a ColumnarTable.  Indexes are requested per table in
+the table's SDML specification, with an optional "indexes" field mapping column names to
+an index kind, e.g.
+    "indexes": {"Disease": "sorted", "Month": "hash"}
+  sorted: a permutation which sorts the column, answering IN_RANGE (and IN_LIST) with binary searches
+  hash: a dictionary from each distinct value to the (sorted) indices of the rows holding it,
+    answering IN_LIST
+Both return the indices of the matching rows, in row order, touching only those rows.
+vector_filter uses the indexes automatically when the shape of a filter allows.
+'''
+import numpy as np
+
+from sdtp import InvalidDataException
+
+INDEX_KINDS = {'sorted', 'hash'}
+
+_EMPTY = np.empty(0, dtype = np.int64)
+
+
+def check_index_spec(index_spec, schema):
+  '''
+  Check that index_spec is a valid "indexes" field for a table with schema schema:  a
+  dictionary from column names to index kinds.  Raises an InvalidDataException if it isn't.
+  Arguments:
+    index_spec: the "indexes" field of the table specification
+    schema: the schema of the table
+  '''
+  if not isinstance(index_spec, dict):
+    raise InvalidDataException(f'indexes must be a dictionary of column names to index kinds, not {type(index_spec)}')
+  column_names = [column["name"] for column in schema]
+  for (column_name, kind) in index_spec.items():
+    if column_name not in column_names:
+      raise InvalidDataException(f'Cannot index {column_name}: it is not a column of the table')
+    if kind not in INDEX_KINDS:
+      raise InvalidDataException(f'Index kind {kind} for {column_name} must be one of {sorted(INDEX_KINDS)}')
+
+
+def _concatenate(parts):
+  # The sorted union of the arrays of row indices in parts
+  if len(parts) == 0:
+    return _EMPTY
+  return np.sort(np.concatenate(parts))
+
+
+class SortedIndex:
+  '''
+  A sorted index over a column: the stable permutation which sorts the column, and the sorted values.
+  Arguments:
+    column: a NumPy array
+  '''
+  kind = 'sorted'
+
+  def __init__(self, column):
+    self.permutation = np.argsort(column, kind = 'stable')
+    self.sorted_values = column[self.permutation]
+
+  def range(self, min_val, max_val):
+    '''
+    Return the indices of the rows with min_val <= value <= max_val, in row order
+    '''
+    start = np.searchsorted(self.sorted_values, min_val, side = 'left')
+    end = np.searchsorted(self.sorted_values, max_val, side = 'right')
+    return np.sort(self.permutation[start:end])
+
+  def lookup(self, values):
+    '''
+    Return the indices of the rows whose value is in values, in row order
+    '''
+    parts = []
+    for value in set(values):
+      start = np.searchsorted(self.sorted_values, value, side = 'left')
+      end = np.searchsorted(self.sorted_values, value, side = 'right')
+      parts.append(self.permutation[start:end])
+    return _concatenate(parts)
+
+
+class HashIndex:
+  '''
+  A hash index over a column: a dictionary from each distinct value in the column to
+  the indices of the rows holding it.
+  Arguments:
+    column: a NumPy array
+  '''
+  kind = 'hash'
+
+  def __init__(self, column):
+    permutation = np.argsort(column, kind = 'stable')
+    (values, starts) = np.unique(column[permutation], return_index = True)
+    ends = np.append(starts[1:], len(column))
+    self.rows = {value: permutation[start:end] for (value, start, end) in zip(values.tolist(), starts.tolist(), ends.tolist())}
+
+  def lookup(self, values):
+    '''
+    Return the indices of the rows whose value is in values, in row order
+    '''
+    return _concatenate([self.rows[value] for value in set(values) if value in self.rows])
+
+
+def build_index(kind, column):
+  '''
+  Build an index of kind kind ('sorted' or 'hash') over column, a NumPy array
+  '''
+  return SortedIndex(column) if kind == 'sorted' else HashIndex(column)
@@ -0,0 +1,181 @@
+'''
+Startup loading of the tables stored in the SDML bucket.  Loading is done in three phases:
+1. list: get the names of the table blobs from the bucket
+2. download: download the table specifications concurrently, with at most max_workers
+   requests outstanding (see SDMLStorageBucket.get_tables_as_dictionaries)
+3. register: register each table with the table server.  In lazy mode, the table is
+   registered as a LazySDMLTable, which has its schema but is only built by the table's
+   factory on first access; in eager mode, the table is built and its data read immediately
+   (see materialize_table).
+The time taken by each phase is returned to the caller and logged.
+'''
+import logging
+import threading
+import time
+
+from sdtp import InvalidDataException
+from sdtp.sdtp_table import ReloadableTable
+from row_groups import ChunkedGCSTable
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOAD_WORKERS = 16
+LOAD_MODES = {'lazy', 'eager'}
+
+
+class LazySDMLTable(ReloadableTable):
+  '''
+  A table whose specification has been read, but which has not yet been built.  The schema
+  is available immediately; the inner table is built by table_factory the first time
+  that data is requested from the table.  After the first build the downloaded
+  specification is dropped, and if the table is flushed it is reloaded from the bucket.
+  Arguments:
+    table_spec: the SDML specification of the table, a dictionary with (at least) schema and type
+    table_factory: the SDMLTableFactory which builds tables of type table_spec["type"]
+    bucket: the SDMLStorageBucket the specification was read from
+    blob_name: the name of the blob holding the specification
+  '''
+  def __init__(self, table_spec, table_factory, bucket = None, blob_name = None):
+    super(LazySDMLTable, self).__init__(table_spec['schema'], table_factory)
+    self.table_spec = table_spec
+    self.bucket = bucket
+    self.blob_name = blob_name
+    self.load_lock = threading.Lock()
+
+  def load(self):
+    '''
+    Build the inner table.  Concurrent requests for a table which hasn't been built
+    wait for a single build rather than each building their own copy
+    '''
+    with self.load_lock:
+      if self.inner_table is None:
+        with STAGE_SECONDS.time(stage = 'materialize'):
+          super(LazySDMLTable, self).load()
+        self.table_spec = None
+
+  def get_spec(self):
+    '''
+    Return the specification of this table, re-reading it from the bucket if it has been dropped
+    '''
+    if self.table_spec is not None:
+      return self.table_spec
+    if self.bucket is None:
+      raise InvalidDataException(f'No specification available to reload {self.blob_name}')
+    return self.bucket.get_table_as_dictionary(self.blob_name)
+
+  def is_loaded(self):
+    '''
+    True iff the inner table has been built
+    '''
+    return self.inner_table is not None
+
+  def to_dictionary(self):
+    '''
+    Return the dictionary form of the underlying table
+    '''
+    if self.inner_table is None: self.load()
+    return self.inner_table.to_dictionary()
+
+
+def materialize_table(table):
+  '''
+  Read the data of table now, rather than on first use.  Building a table from its
+  specification doesn't always read its data: a GCSTable (or a ColumnarGCSTable) only
+  refers to its blob until its inner table is loaded, and a ChunkedGCSTable reads its
+  manifest on first use.  This loads the inner table of a ReloadableTable, and reads
+  the manifest of a ChunkedGCSTable; the row groups of a chunked table are still read
+  on demand.  Raises an InvalidDataException if the data can't be read
+  '''
+  if isinstance(table, ReloadableTable):
+    if table.inner_table is None:
+      table.load()
+  elif isinstance(table, ChunkedGCSTable):
+    table.manifest
+
+
+def table_key(blob_name, prefix = None):
+  '''
+  The name a table is registered under: the blob name, with the prefix and the .sdml extension stripped
+  Arguments:
+    blob_name: the name of the blob in the bucket
+    prefix: the prefix used to select the tables, or None
+  '''
+  first_index = len(prefix) if prefix is not None else 0
+  return blob_name[first_index:-5]
+
+
+def register_table(table_server, name, table_spec, lazy = True, bucket = None, blob_name = None):
+  '''
+  Register the table specified by table_spec under name.  If lazy is True, the table is
+  registered as a LazySDMLTable and built on first access; otherwise it is built and its
+  data read now (see materialize_table), and only registered if that succeeds.
+  Raises an InvalidDataException if there is no factory for the table type, if
+  the schema is invalid, or if an eager table's data can't be read.
+  Arguments:
+    table_server: the sdtp TableServer to register the table with
+    name: name of the table
+    table_spec: the table specification, a dictionary with fields schema and type
+    lazy: if True, defer building the table until it is used
+    bucket: the bucket table_spec was read from, if any (used to reload a lazy table)
+    blob_name: the blob table_spec was read from, if any
+  '''
+  if not isinstance(table_spec, dict) or 'schema' not in table_spec or 'type' not in table_spec:
+    raise InvalidDataException(f'The specification for {name} must be a dictionary with schema and type')
+  table_type = table_spec['type']
+  if table_type not in table_server.factories:
+    raise InvalidDataException(f'No factory registered for {table_type}')
+  if not lazy:
+    with STAGE_SECONDS.time(stage = 'materialize'):
+      table = table_server.factories[table_type].build_table(table_spec)
+      materialize_table(table)
+    table_server.add_sdtp_table(name, table)
+    return
+  table = LazySDMLTable(table_spec, table_server.factories[table_type], bucket, blob_name)
+  table_server.add_sdtp_table(name, table)
+
+
+def load_tables_from_bucket(bucket, table_server, prefix = None, lazy = True, max_workers = DEFAULT_LOAD_WORKERS):
+  '''
+  Register every table in the bucket whose blob name starts with prefix with table_server.
+  Blobs are downloaded concurrently with at most max_workers requests outstanding.
+  Blobs which can't be read or which aren't valid tables are logged and skipped.
+  Arguments:
+    bucket: an SDMLStorageBucket
+    table_server: the sdtp TableServer to register the tables with
+    prefix: only load blobs whose names start with prefix; if None, load all tables
+    lazy: if True, tables are built on first access rather than at startup
+    max_workers: the maximum number of concurrent downloads
+  Returns:
+    A dictionary of the startup timings, in seconds, for each phase ("list", "download", "register", "total"),
+    with the counts of tables loaded and failed
+  '''
+  start = time.perf_counter()
+  blob_names = bucket.get_all_table_names(prefix)
+  listed = time.perf_counter()
+
+  downloads = bucket.get_tables_as_dictionaries(blob_names, max(1, max_workers))
+  downloaded = time.perf_counter()
+
+  failed = 0
+  for (blob_name, table_spec, error) in downloads:
+    if error is None:
+      try:
+        register_table(table_server, table_key(blob_name, prefix), table_spec, lazy, bucket, blob_name)
+        continue
+      except InvalidDataException as e:
+        error = e
+    failed += 1
+    logger.warning(f'Table {blob_name} not loaded: {error}')
+  registered = time.perf_counter()
+
+  timings = {
+    "list": listed - start,
+    "download": downloaded - listed,
+    "register": registered - downloaded,
+    "total": registered - start,
+    "tables": len(blob_names) - failed,
+    "failed": failed
+  }
+  logger.info(f'Loaded {timings["tables"]} tables ({failed} failed, {"lazy" if lazy else "eager"}) in {timings["total"]:.3f}s: list {timings["list"]:.3f}s, download {timings["download"]:.3f}s, register {timings["register"]:.3f}s')
+  return timings
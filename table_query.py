@@ -0,0 +1,196 @@
+'''
+Paginated queries over the tables served by the wiki.  The table viewer only shows a page
+of rows at a time, so rather than building the entire filtered result with
+table.get_filtered_rows() and slicing it, get_page() evaluates the filter row by row
+and stops as soon as it has the rows for the page.  The total number of matching
+rows is then estimated from the fraction of the table that was scanned.  For columnar
+tables, the filter is instead evaluated over the whole table as a vectorized mask,
+which gives an exact count, and only the rows of the page are decoded.  For tables stored
+as row groups (see row_groups), the scan only reads the row groups whose zone maps say
+they may hold matching rows.
+'''
+import time
+
+from sdtp import SDQLFilter, RowTable, SDMLFixedTable
+from sdtp.sdtp_table import ReloadableTable
+from columnar_cache import columnar_table
+from vector_filter import filter_indices
+from row_groups import ChunkedGCSTable, chunked_table
+from metrics import STAGE_SECONDS, ROWS_SCANNED, ROWS_RETURNED
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 1000
+# The plans of query_planner which skip the filter
+PLAN_EMPTY = 'empty'
+PLAN_ALL = 'all'
+
+
+def compile_row_predicate(sdql_filter):
+  '''
+  Compile an SDQLFilter into a function row -> bool, which is True exactly when the
+  row passes the filter.  The semantics are those of SDQLFilter.filter_index, but
+  each row is tested independently, so evaluation can stop at any point.  A missing value
+  (None) passes IN_LIST only if None is listed, and never passes IN_RANGE or REGEX_MATCH,
+  where filter_index would raise a TypeError.
+  Arguments:
+    sdql_filter: an instance of SDQLFilter
+  Returns:
+    A predicate over rows (lists of values in schema order)
+  '''
+  operator = sdql_filter.operator
+  if operator in {'ALL', 'ANY', 'NONE'}:
+    predicates = [compile_row_predicate(argument) for argument in sdql_filter.arguments]
+    if operator == 'ALL':
+      return lambda row: all(predicate(row) for predicate in predicates)
+    if operator == 'ANY':
+      return lambda row: any(predicate(row) for predicate in predicates)
+    return lambda row: not any(predicate(row) for predicate in predicates)
+  index = sdql_filter.column_index
+  if operator == 'IN_LIST':
+    try:
+      values = set(sdql_filter.value_list)
+    except TypeError:
+      values = sdql_filter.value_list
+    return lambda row: row[index] in values
+  if operator == 'IN_RANGE':
+    (min_val, max_val) = (sdql_filter.min_val, sdql_filter.max_val)
+    return lambda row: row[index] is not None and min_val <= row[index] <= max_val
+  regex = sdql_filter.regex
+  return lambda row: row[index] is not None and regex.fullmatch(row[index]) is not None
+
+
+def local_rows(table):
+  '''
+  Return the rows of table without filtering or copying them, if the rows are held
+  locally, and None otherwise (e.g., for a RemoteSDMLTable, where the filter should be
+  evaluated at the remote server).  The rows of a ColumnarTable are returned as a
+  sequence which decodes rows as they are read, and those of a ChunkedGCSTable as a sequence
+  which fetches row groups as they are read.
+  Arguments:
+    table: an SDMLTable
+  '''
+  columnar = columnar_table(table)
+  if columnar is not None:
+    return columnar.rows()
+  if isinstance(table, ChunkedGCSTable):
+    return table.rows()
+  if isinstance(table, ReloadableTable):
+    if table.inner_table is None: table.load()
+    return local_rows(table.inner_table)
+  if isinstance(table, RowTable):
+    return table.rows
+  if isinstance(table, SDMLFixedTable):
+    return table.get_rows()
+  return None
+
+
+def clamp_page(offset, limit):
+  '''
+  Turn the offset and limit request parameters into valid integers: offset >= 0 and
+  1 <= limit <= MAX_PAGE_SIZE.  Missing or malformed values get the defaults.
+  Arguments:
+    offset: the requested offset, a string, an int, or None
+    limit: the requested page size, a string, an int, or None
+  Returns:
+    (offset, limit) as integers
+  '''
+  try:
+    offset = max(0, int(offset))
+  except (TypeError, ValueError):
+    offset = 0
+  try:
+    limit = min(max(1, int(limit)), MAX_PAGE_SIZE)
+  except (TypeError, ValueError):
+    limit = DEFAULT_PAGE_SIZE
+  return (offset, limit)
+
+
+def get_page(table, filter_spec = None, offset = 0, limit = DEFAULT_PAGE_SIZE, plan = None):
+  '''
+  Get the rows offset..offset + limit - 1 of the rows of table which pass filter_spec.
+  If plan (from query_planner.plan_filter) says that no row, or every row, passes the filter,
+  the table isn't filtered at all.
+  For a columnar table, the filter is evaluated with vector_filter and the count is exact.
+  Otherwise, the scan stops as soon as the page (and one further match, to know whether there is a
+  next page) has been found; the total number of matches is then estimated from
+  the matches in the part of the table that was scanned (or taken from plan, if its count is exact).
+  For a ChunkedGCSTable, only the row groups which may hold matches are scanned.
+  Raises an InvalidDataException if filter_spec isn't valid for this table.
+  Arguments:
+    table: the SDMLTable to query
+    filter_spec: an SDQL filter specification, or None for all rows
+    offset: the index, in the filtered rows, of the first row to return
+    limit: the maximum number of rows to return
+    plan: the plan of filter_spec over table, or None
+  Returns:
+    A dictionary with fields:
+      rows: the rows of the page
+      offset, limit: the offset and limit of the page
+      total: the number of rows which pass the filter (an estimate unless exact is True)
+      exact: True if total is an exact count
+      has_next: True if there are rows after this page
+      scanned: the number of rows examined to find the page
+  '''
+  start = time.perf_counter()
+  page = _get_page(table, filter_spec, offset, limit, plan)
+  STAGE_SECONDS.observe(time.perf_counter() - start, stage = 'filter')
+  ROWS_SCANNED.observe(page["scanned"])
+  ROWS_RETURNED.observe(len(page["rows"]))
+  return page
+
+
+def _get_page(table, filter_spec, offset, limit, plan):
+  # The work of get_page
+  sdql_filter = SDQLFilter(filter_spec, table.schema) if filter_spec is not None else None
+  if sdql_filter is not None and plan is not None:
+    if plan["plan"] == PLAN_EMPTY:
+      return _page([], offset, limit, 0, True, False, 0)
+    if plan["plan"] == PLAN_ALL:
+      sdql_filter = None
+  columnar = columnar_table(table)
+  if columnar is not None and sdql_filter is not None:
+    indices = filter_indices(sdql_filter, columnar)
+    if indices is not None:
+      page = columnar.decode_rows(indices[offset:offset + limit])
+      return _page(page, offset, limit, len(indices), True, offset + limit < len(indices), columnar.num_rows)
+  chunked = chunked_table(table) if sdql_filter is not None else None
+  rows = chunked.rows(sdql_filter) if chunked is not None else local_rows(table)
+  if rows is None:
+    rows = table.get_filtered_rows_from_filter(sdql_filter)
+    sdql_filter = None
+  if sdql_filter is None:
+    page = rows[offset:offset + limit]
+    return _page(page, offset, limit, len(rows), True, offset + limit < len(rows), len(page))
+
+  predicate = compile_row_predicate(sdql_filter)
+  end = offset + limit
+  page = []
+  matched = 0
+  scanned = 0
+  for row in rows:
+    scanned += 1
+    if predicate(row):
+      if matched >= offset and matched < end:
+        page.append(row)
+      matched += 1
+      if matched > end:
+        break
+  if scanned == len(rows):
+    return _page(page, offset, limit, matched, True, matched > end, scanned)
+  if plan is not None and plan["exact"]:
+    return _page(page, offset, limit, plan["rows"], True, True, scanned)
+  estimate = round(matched * len(rows) / scanned)
+  return _page(page, offset, limit, estimate, False, True, scanned)
+
+
+def _page(rows, offset, limit, total, exact, has_next, scanned):
+  # The result of get_page
+  return {
+    "rows": rows,
+    "offset": offset,
+    "limit": limit,
+    "total": total,
+    "exact": exact,
+    "has_next": has_next,
+    "scanned": scanned
+  }
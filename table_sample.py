@@ -0,0 +1,310 @@
+'''
+Row samples of the tables being served, and approximate queries answered from them.
+The sample of a table is a uniform random sample of SAMPLE_SIZE of its rows (all of them,
+for a smaller table), kept in table order.  For a columnar table the sample is drawn by
+row index, decoding only the sampled rows; otherwise it is a reservoir sample (Li's
+Algorithm L) drawn in one pass over the rows.  Like the statistics (see table_stats), a
+sample is stored beside the table in the bucket, tagged with the table's version; it is
+drawn in the background when a table is uploaded, and in the background on first use
+otherwise; until it is ready, the callers serve an exact answer or say it is pending.
+Only the DEFAULT_SAMPLE_CACHE_ENTRIES most recently used samples are kept in memory.
+The approximate queries evaluate an SDQL filter over the sample, and scale the result up
+to the table, with CONFIDENCE (95%) intervals:
+  approximate_count: the number of rows which pass the filter
+  approximate_histogram: the number of passing rows in each of equal-width bins of a number
+    column, or with each of the most common values of any other column
+  approximate_percentiles: percentiles of a column over the passing rows
+and sample_page gives a page of the passing rows of the sample, as a sampled preview.
+All of these take time in proportion to the size of the sample, not the table.  When the
+sample holds the whole table the answers are exact.
+'''
+import math
+import random
+
+from sdtp import SDQLFilter, InvalidDataException, jsonifiable_value
+from columnar_cache import columnar_table
+from row_groups import typed_rows, json_rows
+from table_query import local_rows, compile_row_predicate
+from table_stats import TableStatistics
+
+SAMPLE_SIZE = 10000
+# The number of samples kept in memory
+DEFAULT_SAMPLE_CACHE_ENTRIES = 32
+SAMPLE_FORMAT_VERSION = 1
+CONFIDENCE = 0.95
+# The normal quantile for CONFIDENCE
+Z = 1.959964
+DEFAULT_BINS = 10
+MAX_BINS = 100
+
+
+def _uniform(generator):
+  # A uniform random number in (0, 1), whose logarithm is finite
+  value = generator.random()
+  while value == 0:
+    value = generator.random()
+  return value
+
+
+def reservoir_sample(rows, size, generator):
+  '''
+  A uniform random sample of size of rows (an iterable), in one pass, with Algorithm L: after
+  the reservoir is full, the number of rows to skip before the next replacement is drawn
+  directly, so the work grows with the size of the sample, not of the table.
+  Arguments:
+    rows: the rows to sample
+    size: the number of rows in the sample
+    generator: a random.Random
+  Returns:
+    (indices, sample, count): the indices of the sampled rows and the rows, in the order of rows,
+    and the number of rows
+  '''
+  reservoir = []
+  iterator = iter(enumerate(rows))
+  for entry in iterator:
+    reservoir.append(entry)
+    if len(reservoir) == size:
+      break
+  count = len(reservoir)
+  if count == size and size > 0:
+    w = math.exp(math.log(_uniform(generator)) / size)
+    while True:
+      skip = math.floor(math.log(_uniform(generator)) / math.log(1 - w))
+      entry = None
+      for entry in iterator:
+        count += 1
+        if skip == 0:
+          break
+        skip -= 1
+        entry = None
+      if entry is None:
+        break
+      reservoir[generator.randrange(size)] = entry
+      w *= math.exp(math.log(_uniform(generator)) / size)
+  reservoir.sort(key = lambda entry: entry[0])
+  return ([index for (index, _) in reservoir], [row for (_, row) in reservoir], count)
+
+
+def draw_sample(table, size = SAMPLE_SIZE, version = None, seed = None):
+  '''
+  Draw a sample of size rows from table.  Raises an InvalidDataException if the rows
+  of table aren't held locally (as for a RemoteSDMLTable).
+  Arguments:
+    table: an SDMLTable
+    size: the number of rows in the sample
+    version: the version of the table, recorded in the sample
+    seed: the seed of the random number generator, or None for a random seed
+  Returns:
+    A dictionary {"version", "format", "num_rows", "schema", "rows"}, where rows are the
+    sampled rows (with their Python values) in table order
+  '''
+  generator = random.Random(seed)
+  columnar = columnar_table(table)
+  if columnar is not None:
+    num_rows = columnar.num_rows
+    indices = sorted(generator.sample(range(num_rows), min(size, num_rows)))
+    rows = columnar.decode_rows(indices)
+  else:
+    all_rows = local_rows(table)
+    if all_rows is None:
+      raise InvalidDataException('Only tables whose rows are held by this server can be sampled')
+    (_, rows, num_rows) = reservoir_sample(all_rows, size, generator)
+  return {"version": version, "format": SAMPLE_FORMAT_VERSION, "num_rows": num_rows, "schema": table.schema, "rows": rows}
+
+
+class TableSamples(TableStatistics):
+  '''
+  The samples of the tables being served, by table name, kept as TableStatistics keeps
+  statistics: in memory (the max_entries most recently used), then in the bucket, and drawn
+  from the table, on executor when asked for by request(), only if neither has a sample of
+  the current version.
+  Arguments:
+    bucket: the SDMLStorageBucket the samples are stored in, or None to keep them in memory only
+    versions: the http_cache.TableVersions giving the current version of each table
+    size: the number of rows in each sample
+    executor: the concurrent.futures.Executor which request() draws samples on, or None
+    max_entries: the number of samples kept in memory, or None for no limit
+  '''
+  format_version = SAMPLE_FORMAT_VERSION
+  kind = 'sample'
+
+  def __init__(self, bucket, versions, size = SAMPLE_SIZE, executor = None, max_entries = DEFAULT_SAMPLE_CACHE_ENTRIES):
+    super(TableSamples, self).__init__(bucket, versions, executor, max_entries)
+    self.size = size
+
+  def _build(self, table, version):
+    return draw_sample(table, self.size, version)
+
+  def _read(self, table_name):
+    # Samples are stored with JSON values, and kept in memory with Python values
+    sample = self.bucket.get_table_sample(table_name)
+    if "rows" in sample and "schema" in sample:
+      sample["rows"] = typed_rows([column["type"] for column in sample["schema"]], sample["rows"])
+    return sample
+
+  def _write(self, table_name, sample):
+    types = [column["type"] for column in sample["schema"]]
+    self.bucket.upload_table_sample(table_name, dict(sample, rows = json_rows(sample["rows"], types)))
+
+
+def _matching_rows(sample, filter_spec):
+  # The rows of sample which pass filter_spec (None for all rows)
+  if filter_spec is None:
+    return sample["rows"]
+  predicate = compile_row_predicate(SDQLFilter(filter_spec, sample["schema"]))
+  return [row for row in sample["rows"] if predicate(row)]
+
+
+def _interval(matches, sample_size, num_rows):
+  # The estimate and CONFIDENCE interval of the number of rows of the table like the matches
+  # rows of the sample, as (estimate, low, high).  This is a Wilson score interval, with
+  # the finite population correction, and it is exact when the sample is the whole table
+  if sample_size >= num_rows:
+    return (matches, matches, matches)
+  p = matches / sample_size
+  correction = math.sqrt((num_rows - sample_size) / (num_rows - 1))
+  denominator = 1 + Z * Z / sample_size
+  center = (p + Z * Z / (2 * sample_size)) / denominator
+  half_width = correction * Z * math.sqrt(p * (1 - p) / sample_size + Z * Z / (4 * sample_size * sample_size)) / denominator
+  # The rows seen in the sample are certainly in the table, and so are those seen not to match
+  low = max(matches, math.floor((center - half_width) * num_rows))
+  high = min(num_rows - (sample_size - matches), math.ceil((center + half_width) * num_rows))
+  return (round(p * num_rows), low, high)
+
+
+def _summary(sample, matches):
+  # The fields common to the approximate query results
+  return {
+    "num_rows": sample["num_rows"],
+    "sample_size": len(sample["rows"]),
+    "sample_matches": matches,
+    "exact": len(sample["rows"]) >= sample["num_rows"],
+    "confidence": CONFIDENCE
+  }
+
+
+def _column(sample, column_name):
+  # The index and type of column column_name of sample
+  for (index, column) in enumerate(sample["schema"]):
+    if column["name"] == column_name:
+      return (index, column["type"])
+  raise InvalidDataException(f'There is no column {column_name}')
+
+
+def _present(value):
+  return value is not None and not (isinstance(value, float) and value != value)
+
+
+def approximate_count(sample, filter_spec = None):
+  '''
+  Estimate the number of rows of the table which pass filter_spec from its sample.  Raises an
+  InvalidDataException if filter_spec isn't valid for the table.
+  Arguments:
+    sample: the sample of the table, from TableSamples
+    filter_spec: an SDQL filter specification, or None for all rows
+  Returns:
+    A dictionary {"count", "low", "high", "num_rows", "sample_size", "sample_matches", "exact", "confidence"},
+    where count is the estimate and low..high its confidence interval
+  '''
+  matches = len(_matching_rows(sample, filter_spec))
+  (estimate, low, high) = _interval(matches, len(sample["rows"]), sample["num_rows"])
+  return dict(_summary(sample, matches), count = estimate, low = low, high = high)
+
+
+def approximate_histogram(sample, column_name, filter_spec = None, bins = DEFAULT_BINS):
+  '''
+  Estimate the histogram of column column_name over the rows which pass filter_spec from the
+  sample.  For a number column, the range of the passing values in the sample is split into
+  bins equal-width bins; for other columns, there is a bin for each of the bins most common
+  values in the sample (values which aren't in the sample can't appear).  Raises an
+  InvalidDataException if filter_spec isn't valid for the table, or there is no such column.
+  Arguments:
+    sample: the sample of the table, from TableSamples
+    column_name: the column
+    filter_spec: an SDQL filter specification, or None for all rows
+    bins: the number of bins, at most MAX_BINS
+  Returns:
+    The fields of approximate_count but count, low and high, and "bins", a list of dictionaries
+    {"min", "max", "count", "low", "high"} (for number columns) or {"value", "count", "low", "high"}
+  '''
+  (index, sdml_type) = _column(sample, column_name)
+  bins = min(max(1, bins), MAX_BINS)
+  rows = _matching_rows(sample, filter_spec)
+  values = [row[index] for row in rows if _present(row[index])]
+  (sample_size, num_rows) = (len(sample["rows"]), sample["num_rows"])
+
+  def entry(matches, **bounds):
+    (estimate, low, high) = _interval(matches, sample_size, num_rows)
+    return dict(bounds, count = estimate, low = low, high = high)
+
+  result = []
+  if sdml_type == 'number' and len(values) > 0:
+    (least, greatest) = (min(values), max(values))
+    width = (greatest - least) / bins
+    counts = [0] * bins
+    for value in values:
+      counts[min(bins - 1, int((value - least) / width)) if width > 0 else 0] += 1
+    result = [entry(counts[i], min = least + i * width, max = least + (i + 1) * width if i < bins - 1 else greatest) for i in range(bins)]
+  elif len(values) > 0:
+    counts = {}
+    for value in values:
+      counts[value] = counts.get(value, 0) + 1
+    common = sorted(counts.items(), key = lambda item: -item[1])[:bins]
+    result = [entry(count, value = jsonifiable_value(value, sdml_type)) for (value, count) in common]
+  return dict(_summary(sample, len(rows)), column = column_name, bins = result)
+
+
+def approximate_percentiles(sample, column_name, percentiles, filter_spec = None):
+  '''
+  Estimate percentiles of column column_name over the rows which pass filter_spec from the sample.
+  The confidence interval of each is given by the ranks of the sample which bracket it.  Raises an
+  InvalidDataException if filter_spec isn't valid for the table, there is no such column, or a
+  percentile isn't between 0 and 100.
+  Arguments:
+    sample: the sample of the table, from TableSamples
+    column_name: the column
+    percentiles: a list of percentiles, each from 0 to 100
+    filter_spec: an SDQL filter specification, or None for all rows
+  Returns:
+    The fields of approximate_count but count, low and high, and "percentiles", a list of
+    dictionaries {"percentile", "value", "low", "high"}, whose values are None if no sampled row passes
+  '''
+  (index, sdml_type) = _column(sample, column_name)
+  if any(not 0 <= percentile <= 100 for percentile in percentiles):
+    raise InvalidDataException('Percentiles must be between 0 and 100')
+  rows = _matching_rows(sample, filter_spec)
+  values = sorted(row[index] for row in rows if _present(row[index]))
+  exact = len(sample["rows"]) >= sample["num_rows"]
+  result = []
+  for percentile in percentiles:
+    if len(values) == 0:
+      result.append({"percentile": percentile, "value": None, "low": None, "high": None})
+      continue
+    q = percentile / 100
+    rank = q * (len(values) - 1)
+    spread = 0 if exact else Z * math.sqrt(len(values) * q * (1 - q))
+    (value, low, high) = [
+      jsonifiable_value(values[min(len(values) - 1, max(0, position))], sdml_type)
+      for position in [round(rank), math.floor(rank - spread), math.ceil(rank + spread)]
+    ]
+    result.append({"percentile": percentile, "value": value, "low": low, "high": high})
+  return dict(_summary(sample, len(rows)), column = column_name, percentiles = result)
+
+
+def sample_page(sample, filter_spec = None, offset = 0, limit = 20):
+  '''
+  A page of the rows of the sample which pass filter_spec, in the form of table_query.get_page,
+  with the estimated total number of passing rows in the table and "sampled": True
+  '''
+  rows = _matching_rows(sample, filter_spec)
+  (estimate, _, _) = _interval(len(rows), len(sample["rows"]), sample["num_rows"])
+  return {
+    "rows": rows[offset:offset + limit],
+    "offset": offset,
+    "limit": limit,
+    "total": estimate,
+    "exact": filter_spec is None or len(sample["rows"]) >= sample["num_rows"],
+    "has_next": offset + limit < len(rows),
+    "scanned": len(sample["rows"]),
+    "sampled": True
+  }
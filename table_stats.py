@@ -0,0 +1,314 @@
+'''
+Per-column statistics of the tables being served.  For each column:
+  count, null_count: the number of rows, and of missing values (None, NaN, NaT)
+  min, max: the least and greatest non-missing values
+  distinct: the number of distinct values, from a k-minimum-values sketch: the values are
+    hashed, and if there are more than SKETCH_SIZE distinct hashes, the count is estimated
+    from the k-th smallest, with a relative standard error of about 1 / sqrt(SKETCH_SIZE - 2),
+    or 3% (distinct_exact says whether the count is exact)
+  top_k: for categorical (string, boolean, timeofday) columns, the TOP_K most common values
+    and their counts, most common first (and in value order among equal counts);
+    top_k_complete says whether these are all of the values
+Values are stored in their JSON form.  The statistics are computed from the column arrays
+of a ColumnarTable when the table is columnar, and from the rows otherwise.  A
+TableStatistics keeps the statistics of each table, stored beside the table in the bucket
+(see SDMLStorageBucket.upload_table_stats), and tagged with the table's version so that
+statistics for a replaced table aren't used.  query_planner uses them to answer filters
+without scanning.
+'''
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from sdtp import jsonifiable_value, convert_to_type, InvalidDataException
+from columnar_cache import columnar_table
+from table_query import local_rows
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+SKETCH_SIZE = 1024
+TOP_K = 100
+CATEGORICAL_TYPES = {'string', 'boolean', 'timeofday'}
+STATS_FORMAT_VERSION = 1
+
+
+def _distinct(hashes):
+  # Estimate the number of distinct values from their 64-bit hashes, with a k-minimum-values
+  # sketch.  Returns (count, exact)
+  smallest = np.unique(hashes)
+  if len(smallest) <= SKETCH_SIZE:
+    return (len(smallest), True)
+  kth = float(smallest[SKETCH_SIZE - 1]) / 2.0 ** 64
+  return (int(round((SKETCH_SIZE - 1) / kth)), False)
+
+
+def _top_k(values, counts, sdml_type):
+  # The TOP_K (value, count) pairs with the highest counts, with JSON values, and whether they are all of the values
+  order = np.argsort(-np.asarray(counts), kind = 'stable')[:TOP_K]
+  top = [[jsonifiable_value(values[i], sdml_type), int(counts[i])] for i in order]
+  return (top, len(values) <= TOP_K)
+
+
+def _python(value):
+  # A NumPy scalar as the Python value used by sdtp
+  return value.item() if isinstance(value, np.generic) else value
+
+
+def _finish(sdml_type, count, null_count, min_val, max_val, distinct, top = None):
+  # The statistics of a column, in JSON form
+  stats = {
+    "type": sdml_type,
+    "count": int(count),
+    "null_count": int(null_count),
+    "min": jsonifiable_value(_python(min_val), sdml_type) if min_val is not None else None,
+    "max": jsonifiable_value(_python(max_val), sdml_type) if max_val is not None else None,
+    "distinct": distinct[0],
+    "distinct_exact": distinct[1]
+  }
+  if top is not None:
+    (stats["top_k"], stats["top_k_complete"]) = top
+  return stats
+
+
+def _columnar_column_stats(table, index):
+  # The statistics of column index of a ColumnarTable, from its array
+  sdml_type = table.schema[index]["type"]
+  column = np.asarray(table.columns[index])
+  dictionary = table.dictionaries[index]
+  if dictionary is not None:
+    counts = np.bincount(column, minlength = len(dictionary))
+    present = np.flatnonzero(counts)
+    values = [dictionary[i] for i in present]
+    if len(values) == 0:
+      return _finish(sdml_type, len(column), 0, None, None, (0, True), ([], True))
+    return _finish(sdml_type, len(column), 0, values[0], values[-1], (len(values), True), _top_k(values, counts[present], sdml_type))
+  if column.dtype.kind == 'f':
+    missing = np.isnan(column)
+  elif column.dtype.kind == 'M':
+    missing = np.isnat(column)
+  else:
+    missing = np.zeros(len(column), dtype = np.bool_)
+  present = column[~missing] if missing.any() else column
+  if len(present) == 0:
+    return _finish(sdml_type, len(column), len(column), None, None, (0, True))
+  distinct = _distinct(pd.util.hash_array(present))
+  top = None
+  if sdml_type in CATEGORICAL_TYPES:
+    (values, counts) = np.unique(present, return_counts = True)
+    top = _top_k([_python(value) for value in values], counts, sdml_type)
+  return _finish(sdml_type, len(column), len(column) - len(present), present.min(), present.max(), distinct, top)
+
+
+def _is_missing(value):
+  return value is None or (isinstance(value, float) and value != value)
+
+
+def column_stats(sdml_type, values):
+  '''
+  Compute the statistics of a column of sdml_type from its values, a list of Python values
+  Arguments:
+    sdml_type: the SDML type of the column
+    values: the values of the column
+  '''
+  present = [value for value in values if not _is_missing(value)]
+  if len(present) == 0:
+    return _finish(sdml_type, len(values), len(values), None, None, (0, True), ([], True) if sdml_type in CATEGORICAL_TYPES else None)
+  series = pd.Series(present, dtype = object)
+  distinct = _distinct(pd.util.hash_pandas_object(series.astype(str), index = False).to_numpy())
+  top = None
+  if sdml_type in CATEGORICAL_TYPES:
+    # In value order, as from a ColumnarTable, so values with equal counts are ordered alike
+    counts = series.value_counts(sort = False).sort_index()
+    top = _top_k(list(counts.index), counts.to_numpy(), sdml_type)
+  return _finish(sdml_type, len(values), len(values) - len(present), min(present), max(present), distinct, top)
+
+
+def compute_table_stats(table, version = None):
+  '''
+  Compute the statistics of every column of table.
+  Arguments:
+    table: an SDMLTable
+    version: the version of the table, recorded in the statistics
+  Returns:
+    A dictionary {"version", "format", "num_rows", "columns"}, where columns is a dictionary
+    from column name to the statistics of the column
+  '''
+  columnar = columnar_table(table)
+  if columnar is not None:
+    columns = [_columnar_column_stats(columnar, index) for index in range(len(columnar.schema))]
+    num_rows = columnar.num_rows
+  else:
+    rows = local_rows(table)
+    if rows is not None:
+      values = [list(column) for column in zip(*rows)] if len(rows) > 0 else [[] for _ in table.schema]
+    else:
+      values = [table.get_column(column["name"]) for column in table.schema]
+    columns = [column_stats(column["type"], values[i]) for (i, column) in enumerate(table.schema)]
+    num_rows = len(values[0]) if len(values) > 0 else 0
+  return {
+    "version": version,
+    "format": STATS_FORMAT_VERSION,
+    "num_rows": num_rows,
+    "columns": {column["name"]: columns[i] for (i, column) in enumerate(table.schema)}
+  }
+
+
+def typed_value(column_stats, value):
+  '''
+  Convert a value (such as min or max) from the statistics of a column back to the column's type
+  '''
+  return convert_to_type(column_stats["type"], value) if value is not None else None
+
+
+class TableStatistics:
+  '''
+  The statistics of the tables being served, by table name.  The statistics of a table are
+  looked for in memory, then in the bucket, and computed from the table (and saved to the
+  bucket) only if neither has statistics for the current version of the table.  Computing
+  statistics scans the whole table, so request handlers use request(), which schedules the
+  computation on executor rather than waiting for it.  At most max_entries tables' statistics
+  are kept in memory, the least recently used being dropped (they are read from the bucket
+  again when next needed).
+  Arguments:
+    bucket: the SDMLStorageBucket the statistics are stored in, or None to keep them in memory only
+    versions: the http_cache.TableVersions giving the current version of each table
+    executor: the concurrent.futures.Executor which request() computes statistics on, or None
+      to compute them in the calling thread
+    max_entries: the number of tables whose statistics are kept in memory, or None for no limit
+  '''
+  # The format version of stored statistics, and the name of their metrics stage and log messages
+  format_version = STATS_FORMAT_VERSION
+  kind = 'statistics'
+
+  def __init__(self, bucket, versions, executor = None, max_entries = None):
+    self.bucket = bucket
+    self.versions = versions
+    self.executor = executor
+    self.max_entries = max_entries
+    # The tables whose statistics are scheduled on executor
+    self.pending = set()
+    # {table_name: statistics}, least recently used first
+    self.stats = OrderedDict()
+    # {table_name: version} of the tables with no statistics in the bucket, so the bucket is only asked once per version
+    self.not_stored = {}
+    # {table_name: lock} held while the statistics of table_name are computed
+    self.compute_locks = {}
+    self.lock = threading.Lock()
+
+  def peek(self, table_name):
+    '''
+    Return the statistics of table_name if they are already known (in memory or in the bucket),
+    without computing them, or None
+    '''
+    version = self.versions.get(table_name)
+    stats = self.stats.get(table_name)
+    if stats is not None and stats["version"] == version:
+      with self.lock:
+        if table_name in self.stats:
+          self.stats.move_to_end(table_name)
+      return stats
+    if self.bucket is None or version is None or self.not_stored.get(table_name) == version:
+      return None
+    try:
+      stats = self._read(table_name)
+    except InvalidDataException:
+      stats = {}
+    if stats.get("version") != version or stats.get("format") != self.format_version:
+      with self.lock:
+        self.not_stored[table_name] = version
+      return None
+    self._remember(table_name, stats)
+    return stats
+
+  def get(self, table_name, table):
+    '''
+    Return the statistics of table_name, computing them from table if they aren't known.
+    Concurrent requests for the same statistics wait for a single computation
+    '''
+    stats = self.peek(table_name)
+    if stats is not None:
+      return stats
+    with self.lock:
+      compute_lock = self.compute_locks.setdefault(table_name, threading.Lock())
+    with compute_lock:
+      stats = self.peek(table_name)
+      return stats if stats is not None else self.compute(table_name, table)
+
+  def request(self, table_name, table):
+    '''
+    Return the statistics of table_name if they are already known, and otherwise schedule
+    their computation from table on executor (once, however often they are requested) and
+    return None.  Without an executor, this is get()
+    '''
+    stats = self.peek(table_name)
+    if stats is not None or self.executor is None:
+      return stats if stats is not None else self.get(table_name, table)
+    with self.lock:
+      if table_name in self.pending:
+        return None
+      self.pending.add(table_name)
+    self.executor.submit(self._compute_pending, table_name, table)
+    return None
+
+  def _compute_pending(self, table_name, table):
+    # The scheduled work of request(); errors are logged, since there is no caller to raise them to
+    try:
+      self.get(table_name, table)
+    except Exception as e:
+      logger.warning(f'The {self.kind} of {table_name} could not be computed: {e}')
+    finally:
+      with self.lock:
+        self.pending.discard(table_name)
+
+  def compute(self, table_name, table):
+    '''
+    Compute the statistics of table_name from table, and save them in memory and in the bucket
+    '''
+    version = self.versions.get(table_name)
+    start = time.perf_counter()
+    stats = self._build(table, version)
+    elapsed = time.perf_counter() - start
+    STAGE_SECONDS.observe(elapsed, stage = self.kind)
+    logger.info(f'Computed {self.kind} of {table_name} ({stats["num_rows"]} rows) in {elapsed:.3f}s')
+    self._remember(table_name, stats)
+    if self.bucket is not None and version is not None:
+      try:
+        self._write(table_name, stats)
+        with self.lock:
+          self.not_stored.pop(table_name, None)
+      except Exception as e:
+        logger.warning(f'The {self.kind} of {table_name} were not saved: {e}')
+    return stats
+
+  def _remember(self, table_name, stats):
+    # Keep stats in memory as the most recently used, dropping the least recently used beyond max_entries
+    with self.lock:
+      self.stats[table_name] = stats
+      self.stats.move_to_end(table_name)
+      while self.max_entries is not None and len(self.stats) > self.max_entries:
+        self.stats.popitem(last = False)
+
+  def _build(self, table, version):
+    # Compute the statistics of table
+    return compute_table_stats(table, version)
+
+  def _read(self, table_name):
+    # Read the stored statistics of table_name from the bucket
+    return self.bucket.get_table_stats(table_name)
+
+  def _write(self, table_name, stats):
+    # Store the statistics of table_name in the bucket
+    self.bucket.upload_table_stats(table_name, stats)
+
+  def invalidate(self, table_name):
+    '''
+    Drop the statistics of table_name from memory; called when the table is replaced
+    '''
+    with self.lock:
+      self.stats.pop(table_name, None)
+      self.not_stored.pop(table_name, None)
@@ -0,0 +1,94 @@
+'''
+The modules under test are at the top level of the repository.  The wiki app (main) is
+configured from the environment when it is imported, so the app fixture imports it once,
+serving tables from a MemoryStorageBucket in place of Cloud Storage.
+'''
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TABLE_PREFIX = 'gcstables/'
+
+
+def row_table(rows, schema = None):
+  '''
+  The dictionary form of an SDML RowTable with the given rows; the default schema is (name string, value number)
+  '''
+  schema = schema or [{"name": "name", "type": "string"}, {"name": "value", "type": "number"}]
+  return {"type": "RowTable", "schema": schema, "rows": rows}
+
+
+class FakeBlob:
+  # A blob of a FakeStorageClient
+  def __init__(self, client, name):
+    (self.client, self.name) = (client, name)
+    (self.generation, self.contents) = client.blobs[name]
+
+  def download_as_bytes(self, if_generation_match = None):
+    assert if_generation_match == self.generation
+    self.client.downloads += 1
+    return self.contents
+
+
+class FakeStorageClient:
+  '''
+  Just enough of a google.cloud.storage Client for a ColumnarCache, holding blobs in memory.
+  put writes a table dictionary as a new generation of a blob; with reachable False, every request fails
+  '''
+  def __init__(self):
+    self.blobs = {}
+    self.downloads = 0
+    self.reachable = True
+
+  def put(self, name, table_dictionary):
+    generation = self.blobs[name][0] + 1 if name in self.blobs else 1
+    self.blobs[name] = (generation, json.dumps(table_dictionary).encode('utf-8'))
+
+  def bucket(self, bucket_name):
+    if not self.reachable:
+      raise ConnectionError('bucket unreachable')
+    return self
+
+  def get_blob(self, name):
+    return FakeBlob(self, name) if name in self.blobs else None
+
+  def blob(self, name):
+    return FakeBlob(self, name)
+
+
+@pytest.fixture(scope = 'session')
+def wiki():
+  '''
+  The main module, with its bucket a MemoryStorageBucket holding the table samples/small,
+  and create_app called without starting the background work
+  '''
+  os.environ.update({
+    "APP_SECRET": "test", "ROOT_URL": "http://localhost", "CLIENT_ID": "test", "CLIENT_SECRET": "test",
+    "BUCKET_NAME": "test", "TABLE_PREFIX": TABLE_PREFIX, "CATALOG_SYNC_INTERVAL": "0"
+  })
+  import gcs_interface
+  from memory_bucket import MemoryStorageBucket
+  blobs = {f'{TABLE_PREFIX}samples/small.sdml': row_table([["a", 1], ["b", 2], ["c", 3]])}
+  gcs_interface.SDMLStorageBucket = lambda bucket_name: MemoryStorageBucket(bucket_name, blobs)
+  import main
+  main.create_app(start_worker = False)
+  return main
+
+
+@pytest.fixture
+def client(wiki):
+  '''
+  A test client of the wiki app
+  '''
+  return wiki.app.test_client()
+
+
+def put_table(bucket, table_name, table_dictionary):
+  '''
+  Write table_dictionary to the blob of table_name in bucket, and return its generation
+  '''
+  return bucket.put_blob(f'{TABLE_PREFIX}{table_name}.sdml', json.dumps(table_dictionary))
@@ -0,0 +1,62 @@
+'''
+Tests of the functional filter language (build_filter)
+'''
+import pytest
+
+from sdtp import InvalidDataException
+from build_filter import parse_filter, check_filter_depth, FilterSyntaxError, MAX_FILTER_DEPTH
+
+
+def test_parse():
+  assert parse_filter("ALL([IN_LIST('state', ['CA', 'NV']), IN_RANGE('year', 2000, 2010)])") == {
+    "operator": "ALL",
+    "arguments": [
+      {"operator": "IN_LIST", "column": "state", "values": ["CA", "NV"]},
+      {"operator": "IN_RANGE", "column": "year", "min_val": 2000, "max_val": 2010}
+    ]
+  }
+
+
+def test_syntax_error_position():
+  with pytest.raises(FilterSyntaxError) as error:
+    parse_filter("IN_RANGE('year', 2000 2010)")
+  assert error.value.position == 22
+
+
+def test_nested_filters():
+  depth = MAX_FILTER_DEPTH // 2 - 1
+  text = "ALL([" * depth + "IN_LIST('a', [1])" + "])" * depth
+  assert parse_filter(text)["operator"] == "ALL"
+
+
+@pytest.mark.parametrize('text', [
+  "ALL([" * 3000 + "IN_LIST('a', [1])" + "])" * 3000,
+  "IN_LIST('a', " + "[" * 3000 + "]" * 3000 + ")",
+  "ALL(" * 3000 + ")" * 3000
+])
+def test_nested_too_deeply(text):
+  with pytest.raises(FilterSyntaxError, match = 'Filter nested too deeply'):
+    parse_filter(text)
+
+
+def _nested_spec(depth):
+  spec = {"operator": "IN_LIST", "column": "a", "values": [1]}
+  for _ in range(depth):
+    spec = {"operator": "ALL", "arguments": [spec]}
+  return spec
+
+
+def test_json_nesting():
+  # Each ALL nests a list and a filter, as in the functional language
+  check_filter_depth(_nested_spec(MAX_FILTER_DEPTH // 2 - 1))
+  with pytest.raises(InvalidDataException, match = 'Filter nested too deeply'):
+    check_filter_depth(_nested_spec(MAX_FILTER_DEPTH // 2 + 1))
+
+
+def test_string_escapes():
+  # As in a Python string literal: the known escapes are replaced, and any other backslash is kept
+  assert parse_filter(r"REGEX_MATCH('name', '\d+\.csv')")["expression"] == r'\d+\.csv'
+  assert parse_filter(r"REGEX_MATCH('name', '^\s*\w+$')")["expression"] == r'^\s*\w+$'
+  assert parse_filter(r"IN_LIST('name', ['it\'s', 'a\\b', 'tab\there', 'say \"hi\"'])")["values"] == ["it's", 'a\\b', 'tab\there', 'say "hi"']
+  for (text, expected) in [(r"'a\nb'", 'a\nb'), (r"'\\d'", '\\d'), (r"'\q\'\"'", '\\q\'"'), (r"'\bword\b'", '\bword\b')]:
+    assert parse_filter(f"REGEX_MATCH('name', {text})")["expression"] == expected
@@ -0,0 +1,115 @@
+'''
+Tests of the catalog index (catalog_index): multi-word and prefix search, pagination in name
+order, and keeping the index in step with the tables as CatalogSync adds and removes them
+'''
+from sdtp import TableServer
+from memory_bucket import MemoryStorageBucket
+from catalog_index import CatalogIndex, words
+from catalog_sync import CatalogSync
+from conftest import row_table, put_table, TABLE_PREFIX
+
+
+def _schema(*names):
+  return [{"name": name, "type": "number"} for name in names]
+
+
+def _index():
+  index = CatalogIndex()
+  index.add('alice/weather_2020', _schema('Temperature', 'Rainfall'))
+  index.add('alice/census', _schema('population', 'median_income'))
+  index.add('bob/weather', _schema('temp_max', 'temp_min', 'wind'))
+  index.add('bob/traffic', _schema('vehicles', 'Rainfall'))
+  return index
+
+
+def test_words():
+  assert words('alice/Weather_2020 (final)') == ['alice', 'weather', '2020', 'final']
+
+
+def test_every_term_must_match():
+  index = _index()
+  assert index.search('weather') == (['alice/weather_2020', 'bob/weather'], 2)
+  assert index.search('rainfall') == (['alice/weather_2020', 'bob/traffic'], 2)
+  assert index.search('weather rainfall') == (['alice/weather_2020'], 1)
+  assert index.search('Rainfall, BOB') == (['bob/traffic'], 1)
+  assert index.search('weather census') == ([], 0)
+  assert index.search('snow') == ([], 0)
+
+
+def test_terms_match_word_prefixes():
+  index = _index()
+  assert index.search('temp') == (['alice/weather_2020', 'bob/weather'], 2)
+  assert index.search('temper') == (['alice/weather_2020'], 1)
+  assert index.search('med inc') == (['alice/census'], 1)
+  # A term matches from the start of a word only
+  assert index.search('ather') == ([], 0)
+
+
+def test_name_prefixes():
+  index = _index()
+  assert index.search(prefix = 'bob/') == (['bob/traffic', 'bob/weather'], 2)
+  assert index.search('weather', prefix = 'alice/') == (['alice/weather_2020'], 1)
+  assert index.search(prefix = 'alice/w') == (['alice/weather_2020'], 1)
+  assert index.search(prefix = 'carol/') == ([], 0)
+
+
+def test_pages_are_in_name_order():
+  index = CatalogIndex()
+  names = [f'owner{i % 3}/table{i:03d}' for i in range(250)]
+  for name in reversed(names):
+    index.add(name, _schema('value'))
+  ordered = sorted(names)
+  assert len(index) == 250
+  for (offset, limit) in [(0, 100), (100, 100), (200, 100), (249, 10), (250, 10), (300, 10), (0, 0)]:
+    assert index.search(offset = offset, limit = limit) == (ordered[offset:offset + limit], 250)
+  owned = [name for name in ordered if name.startswith('owner1/')]
+  for offset in [0, 40, 83, 84]:
+    assert index.search(prefix = 'owner1/', offset = offset, limit = 40) == (owned[offset:offset + 40], len(owned))
+    assert index.search('table', prefix = 'owner1/', offset = offset, limit = 40) == (owned[offset:offset + 40], len(owned))
+  assert index.search('value', offset = 240, limit = 100) == (ordered[240:], 250)
+
+
+def test_replacing_and_removing_a_table():
+  index = _index()
+  index.add('bob/weather', _schema('humidity'))
+  assert index.search('temp') == (['alice/weather_2020'], 1)
+  assert index.search('humidity') == (['bob/weather'], 1)
+  assert index.entry('bob/weather')["columns"] == [{"name": "humidity", "type": "number"}]
+  index.remove('bob/weather')
+  index.remove('bob/missing')
+  assert 'bob/weather' not in index and len(index) == 3
+  assert index.search('humidity') == ([], 0) and 'humidity' not in index.words
+  assert index.search(prefix = 'bob/') == (['bob/traffic'], 1)
+
+
+def test_index_follows_catalog_sync():
+  bucket = MemoryStorageBucket('test', {})
+  server = TableServer()
+  index = CatalogIndex()
+  def changed(table_name, generation):
+    # As main._table_changed does
+    if generation is not None:
+      index.add(table_name, server.servers[table_name].schema)
+    else:
+      index.remove(table_name)
+  sync = CatalogSync(bucket, server, TABLE_PREFIX, on_change = changed)
+  put_table(bucket, 'alice/rain', row_table([['a', 1]]))
+  sync.sync()
+  assert index.search('rain') == (['alice/rain'], 1)
+  put_table(bucket, 'bob/rain_gauge', row_table([['b', 2]], [{"name": "station", "type": "string"}, {"name": "mm", "type": "number"}]))
+  sync.sync()
+  assert index.search('rain') == (['alice/rain', 'bob/rain_gauge'], 2)
+  assert index.search('station') == (['bob/rain_gauge'], 1)
+  bucket.delete_blob(f'{TABLE_PREFIX}alice/rain.sdml')
+  sync.sync()
+  assert index.search('rain') == (['bob/rain_gauge'], 1) and 'alice/rain' not in index
+
+
+def test_catalog_route_follows_the_bucket(wiki, client):
+  put_table(wiki.bucket, 'indexed/rainfall', row_table([['a', 1]]))
+  wiki.catalog_sync.sync()
+  found = client.get('/catalog?q=rainfall').get_json()
+  assert [table["name"] for table in found["tables"]] == ['indexed/rainfall'] and found["total"] == 1
+  wiki.bucket.delete_blob(f'{TABLE_PREFIX}indexed/rainfall.sdml')
+  wiki.catalog_sync.sync()
+  assert client.get('/catalog?q=rainfall').get_json()["total"] == 0
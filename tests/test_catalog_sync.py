@@ -0,0 +1,111 @@
+'''
+Tests of catalog synchronization (catalog_sync): added, replaced and removed blobs, and generations
+'''
+import time
+
+from sdtp import TableServer
+from memory_bucket import MemoryStorageBucket
+from catalog_sync import CatalogSync
+from conftest import row_table, put_table, TABLE_PREFIX
+
+
+def _sync(blobs = None, **kwargs):
+  bucket = MemoryStorageBucket('test', blobs or {})
+  changes = []
+  sync = CatalogSync(bucket, TableServer(), TABLE_PREFIX, on_change = lambda name, generation: changes.append((name, generation)), **kwargs)
+  return (bucket, sync, changes)
+
+
+def _rows(sync, name):
+  return sync.table_server.get_table(name).get_filtered_rows()
+
+
+def test_first_sync_registers_every_table():
+  (bucket, sync, changes) = _sync({f'{TABLE_PREFIX}t{i}.sdml': row_table([[f'r{i}', i]]) for i in range(3)})
+  timings = sync.sync()
+  assert (timings["added"], timings["tables"]) == (3, 3)
+  assert sorted(sync.table_server.servers.keys()) == ['t0', 't1', 't2']
+  assert sorted(changes) == [(f't{i}', bucket.generations[f'{TABLE_PREFIX}t{i}.sdml']) for i in range(3)]
+
+
+def test_added_replaced_removed():
+  (bucket, sync, changes) = _sync({f'{TABLE_PREFIX}t0.sdml': row_table([["a", 1]]), f'{TABLE_PREFIX}t1.sdml': row_table([["b", 2]])})
+  sync.sync()
+  changes.clear()
+  added = put_table(bucket, 't2', row_table([["c", 3]]))
+  replaced = put_table(bucket, 't0', row_table([["a", 10]]))
+  bucket.delete_blob(f'{TABLE_PREFIX}t1.sdml')
+  timings = sync.sync()
+  assert (timings["added"], timings["replaced"], timings["removed"], timings["tables"]) == (1, 1, 1, 2)
+  assert sorted(changes) == [('t0', replaced), ('t1', None), ('t2', added)]
+  assert _rows(sync, 't0') == [["a", 10]]
+  assert _rows(sync, 't2') == [["c", 3]]
+  assert 't1' not in sync.table_server.servers
+
+
+def test_unchanged_blobs_are_not_downloaded():
+  (bucket, sync, changes) = _sync({f'{TABLE_PREFIX}t{i}.sdml': row_table([]) for i in range(5)})
+  sync.sync()
+  downloaded = []
+  get_tables = bucket.get_tables_as_dictionaries
+  bucket.get_tables_as_dictionaries = lambda names, max_workers = None: downloaded.extend(names) or get_tables(names, max_workers)
+  timings = sync.sync()
+  assert (timings["added"], timings["replaced"], timings["removed"]) == (0, 0, 0)
+  assert downloaded == []
+  put_table(bucket, 't3', row_table([["d", 4]]))
+  sync.sync()
+  assert downloaded == [f'{TABLE_PREFIX}t3.sdml']
+
+
+def test_rewrite_with_same_contents_is_a_new_generation():
+  (bucket, sync, changes) = _sync({f'{TABLE_PREFIX}t0.sdml': row_table([["a", 1]])})
+  sync.sync()
+  first = sync.generations[f'{TABLE_PREFIX}t0.sdml']
+  second = put_table(bucket, 't0', row_table([["a", 1]]))
+  assert second != first
+  assert sync.sync()["replaced"] == 1
+  assert sync.generations[f'{TABLE_PREFIX}t0.sdml'] == second
+
+
+def test_broken_replacement_keeps_the_last_good_table():
+  (bucket, sync, changes) = _sync({f'{TABLE_PREFIX}t0.sdml': row_table([["a", 1]])})
+  sync.sync()
+  bucket.put_blob(f'{TABLE_PREFIX}t0.sdml', '{not json')
+  assert sync.sync()["failed"] == 1
+  assert _rows(sync, 't0') == [["a", 1]]
+  # A failed blob is only retried when it is rewritten
+  assert sync.sync()["failed"] == 0
+  put_table(bucket, 't0', row_table([["a", 2]]))
+  assert sync.sync()["replaced"] == 1
+  assert _rows(sync, 't0') == [["a", 2]]
+
+
+def test_background_sync():
+  (bucket, sync, changes) = _sync(interval = 0.01)
+  sync.start()
+  try:
+    put_table(bucket, 't0', row_table([["a", 1]]))
+    deadline = time.time() + 5
+    while 't0' not in sync.table_server.servers and time.time() < deadline:
+      time.sleep(0.01)
+  finally:
+    sync.stop()
+  assert _rows(sync, 't0') == [["a", 1]]
+
+
+def test_app_follows_the_bucket(wiki, client):
+  generation = put_table(wiki.bucket, 'sync/t', row_table([["before", 1]]))
+  wiki.catalog_sync.sync()
+  assert wiki.table_versions.get('sync/t') == str(generation)
+  page = client.get('/view_table?table=sync/t')
+  assert page.status_code == 200 and 'before' in page.get_data(as_text = True)
+  assert 'sync/t' in client.get('/view_tables?q=sync').get_data(as_text = True)
+  # The table's version, which its ETags and cached responses are keyed by, is its blob generation
+  generation = put_table(wiki.bucket, 'sync/t', row_table([["after", 2]]))
+  wiki.catalog_sync.sync()
+  assert wiki.table_versions.get('sync/t') == str(generation)
+  assert 'after' in client.get('/view_table?table=sync/t').get_data(as_text = True)
+  wiki.bucket.delete_blob(f'{TABLE_PREFIX}sync/t.sdml')
+  wiki.catalog_sync.sync()
+  assert 'sync/t' not in wiki.sdtp_server_blueprint.table_server.servers
+  assert 'sync/t' not in client.get('/view_tables?q=sync').get_data(as_text = True)
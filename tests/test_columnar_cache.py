@@ -0,0 +1,84 @@
+'''
+Tests of the columnar cache (columnar_cache): serving the cached generation when the bucket
+can't be reached, and serving blobs whose columns can't be encoded as RowTables
+'''
+import pytest
+
+from sdtp import RowTable, InvalidDataException
+from columnar_cache import ColumnarCache, ColumnarGCSTable, ColumnarTable, columnar_table
+from row_groups import typed_rows
+from table_query import local_rows, get_page
+from conftest import row_table, FakeStorageClient
+
+
+def _table(tmp_path, client, revalidate_interval = 0):
+  return ColumnarGCSTable(row_table([])["schema"], 'test', 'rows.sdml', ColumnarCache(str(tmp_path), client), revalidate_interval)
+
+
+def test_new_generation_is_loaded(tmp_path):
+  client = FakeStorageClient()
+  client.put('rows.sdml', row_table([["a", 1]]))
+  table = _table(tmp_path, client)
+  assert table.get_filtered_rows() == [["a", 1]]
+  client.put('rows.sdml', row_table([["b", 2]]))
+  assert table.get_filtered_rows() == [["b", 2]]
+  assert (table.generation, client.downloads) == (2, 2)
+
+
+def test_unreachable_bucket_serves_the_loaded_generation(tmp_path):
+  client = FakeStorageClient()
+  client.put('rows.sdml', row_table([["a", 1]]))
+  table = _table(tmp_path, client)
+  assert table.get_filtered_rows() == [["a", 1]]
+  client.reachable = False
+  assert table.get_filtered_rows() == [["a", 1]]
+  assert isinstance(columnar_table(table), ColumnarTable)
+
+
+def test_unreachable_bucket_serves_the_cached_generation(tmp_path):
+  client = FakeStorageClient()
+  client.put('rows.sdml', row_table([["a", 1]]))
+  _table(tmp_path, client).load()
+  client.reachable = False
+  # A new table (as in a new worker) opens the entry in the cache, without the bucket
+  assert _table(tmp_path, client).get_filtered_rows() == [["a", 1]]
+  # With nothing cached, the error is raised
+  with pytest.raises(InvalidDataException):
+    ColumnarGCSTable(row_table([])["schema"], 'test', 'other.sdml', ColumnarCache(str(tmp_path), client)).load()
+
+
+def test_unencodable_columns_are_served_as_a_row_table(tmp_path):
+  client = FakeStorageClient()
+  client.put('rows.sdml', row_table([["a", 1], [None, 2]]))
+  table = _table(tmp_path, client)
+  assert local_rows(table) == [["a", 1], [None, 2]]
+  assert isinstance(table.inner_table, RowTable) and columnar_table(table) is None
+  # No partial entry is left in the cache
+  assert table.cache.cached_generation('test', 'rows.sdml') is None
+
+
+def test_null_booleans_and_integers_keep_their_values(tmp_path):
+  schema = [{"name": "flag", "type": "boolean"}, {"name": "count", "type": "number"}, {"name": "ratio", "type": "number"}]
+  rows = [[True, 1, 0.5], [None, None, None], [False, 3, 1.5]]
+  client = FakeStorageClient()
+  client.put('rows.sdml', {"type": "RowTable", "schema": schema, "rows": rows})
+  table = ColumnarGCSTable(schema, 'test', 'rows.sdml', ColumnarCache(str(tmp_path), client))
+  served = local_rows(table)
+  expected = typed_rows([column["type"] for column in schema], rows)
+  assert isinstance(table.inner_table, RowTable)
+  assert [[type(value) for value in row] for row in served] == [[type(value) for value in row] for row in expected]
+  assert (served[0], served[2]) == ([True, 1, 0.5], [False, 3, 1.5])
+  assert served[1][0] is None and all(value != value for value in served[1][1:])
+  # A null boolean doesn't pass IN_LIST(flag, [False])
+  page = get_page(table, {"operator": "IN_LIST", "column": "flag", "values": [False]})
+  assert page["rows"] == [[False, 3, 1.5]]
+
+
+def test_floats_with_nulls_are_columnar(tmp_path):
+  schema = [{"name": "ratio", "type": "number"}]
+  client = FakeStorageClient()
+  client.put('rows.sdml', {"type": "RowTable", "schema": schema, "rows": [[0.5], [None]]})
+  table = ColumnarGCSTable(schema, 'test', 'rows.sdml', ColumnarCache(str(tmp_path), client))
+  served = local_rows(table)
+  assert isinstance(columnar_table(table), ColumnarTable)
+  assert served[0] == [0.5] and served[1][0] != served[1][0]
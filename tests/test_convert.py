@@ -0,0 +1,58 @@
+'''
+Tests of the conversion of CSV files to SDML (convert)
+'''
+import io
+import json
+
+import ijson
+import pytest
+
+from sdtp import InvalidDataException
+from convert import convert_csv, write_sdml
+from row_groups import typed_rows
+
+
+def _csv(text):
+  return io.BytesIO(text.encode('utf-8'))
+
+
+def _sdml(table):
+  output = io.StringIO()
+  write_sdml(table, output)
+  return output.getvalue()
+
+
+def test_empty_number_is_null():
+  table = convert_csv(_csv('a,b\nnumber,string\n1,x\n,y\n3.5,z\n'))
+  sdml = _sdml(table)
+  rows = list(ijson.items(io.BytesIO(sdml.encode('utf-8')), 'rows.item', use_float = True))
+  assert rows == [[1.0, 'x'], [None, 'y'], [3.5, 'z']]
+  assert json.loads(sdml)["rows"][1][0] is None
+
+
+def test_empty_date_is_null():
+  table = convert_csv(_csv('d,n\ndate,number\n2020-01-31,1\n,2\n'))
+  sdml = json.loads(_sdml(table))
+  assert sdml["rows"] == [['2020-01-31', 1], [None, 2]]
+  typed = typed_rows(['date', 'number'], sdml["rows"])
+  assert typed[1][0] is None and typed[0][0].isoformat() == '2020-01-31'
+
+
+def test_missing_type_row():
+  with pytest.raises(InvalidDataException):
+    convert_csv(_csv('a,b\n'))
+
+
+def test_short_type_row():
+  with pytest.raises(InvalidDataException):
+    convert_csv(_csv('a,b\nnumber\n'))
+
+
+def test_booleans():
+  table = convert_csv(_csv('flag,n\nboolean,number\ntrue,1\nf,2\n1,3\n,4\n'))
+  assert [row[0] for row in json.loads(_sdml(table))["rows"]] == [True, False, True, False]
+
+
+def test_bad_boolean():
+  with pytest.raises(InvalidDataException, match = 'maybe'):
+    convert_csv(_csv('flag\nboolean\ntrue\nmaybe\n'))
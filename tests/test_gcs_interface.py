@@ -0,0 +1,158 @@
+'''
+Tests of SDMLStorageBucket (gcs_interface) against a local Cloud Storage emulator: single,
+ranged and parallel downloads, and resetting the connection pool
+'''
+import os
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+gcp_storage_emulator = pytest.importorskip('gcp_storage_emulator.server')
+
+import gcs_interface
+from gcs_interface import SDMLStorageBucket
+from conftest import row_table
+
+
+@pytest.fixture(scope = 'module')
+def emulator():
+  '''
+  A Cloud Storage emulator, holding the empty bucket test, with STORAGE_EMULATOR_HOST set to it
+  '''
+  with socket.socket() as probe:
+    probe.bind(('localhost', 0))
+    port = probe.getsockname()[1]
+  server = gcp_storage_emulator.create_server('localhost', port, in_memory = True, default_bucket = 'test')
+  server.start()
+  previous = os.environ.get('STORAGE_EMULATOR_HOST')
+  os.environ['STORAGE_EMULATOR_HOST'] = f'http://localhost:{port}'
+  yield server
+  server.stop()
+  if previous is None:
+    del os.environ['STORAGE_EMULATOR_HOST']
+  else:
+    os.environ['STORAGE_EMULATOR_HOST'] = previous
+
+
+class RecordingSession:
+  # Wraps the request method of a bucket's session, recording (method, blob name, Range header, query) of each request
+  def __init__(self, bucket, respond = None):
+    self.calls = []
+    self.request = bucket.session.request
+    self.respond = respond
+    bucket.session.request = self
+
+  def __call__(self, method, url, *args, **kwargs):
+    headers = kwargs.get('headers') or {}
+    blob_name = requests.utils.unquote(url.split('/o/')[-1].split('?')[0]) if '/o/' in url else None
+    call = (method, blob_name, headers.get('range') or headers.get('Range'), url.split('?')[-1] if '?' in url else '')
+    self.calls.append(call)
+    if self.respond is not None:
+      response = self.respond(call)
+      if response is not None:
+        return response
+    return self.request(method, url, *args, **kwargs)
+
+
+def _bucket(emulator, **kwargs):
+  bucket = SDMLStorageBucket('test', **kwargs)
+  bucket.upload_tables([
+    {"prefix": "tables", "name": "small", "table": row_table([["a", 1]])},
+    {"prefix": "tables", "name": "large", "table": row_table([[f'row {i}', i] for i in range(200)])}
+  ])
+  return bucket
+
+
+def test_listing_records_sizes(emulator):
+  bucket = _bucket(emulator)
+  generations = bucket.get_table_generations('tables/')
+  assert sorted(generations.keys()) == ['tables/large.sdml', 'tables/small.sdml']
+  for (blob_name, generation) in generations.items():
+    assert bucket.listed[blob_name][0] == generation
+  assert bucket.listed['tables/large.sdml'][1] > bucket.listed['tables/small.sdml'][1] > 0
+
+
+def test_single_request_download(emulator):
+  bucket = _bucket(emulator, ranged_download_threshold = 1000)
+  bucket.get_table_generations('tables/')
+  session = RecordingSession(bucket)
+  assert bucket.get_table_as_dictionary('tables/small.sdml')["rows"] == [["a", 1]]
+  # The download alone, with no request for the blob's metadata
+  assert [(method, blob_name, byte_range) for (method, blob_name, byte_range, _) in session.calls] == [('GET', 'tables/small.sdml', None)]
+
+
+def test_ranged_download(emulator, monkeypatch):
+  monkeypatch.setattr(gcs_interface, 'RANGE_CHUNK_SIZE', 1000)
+  bucket = _bucket(emulator, ranged_download_threshold = 1000)
+  bucket.get_table_generations('tables/')
+  (generation, size) = bucket.listed['tables/large.sdml']
+  session = RecordingSession(bucket)
+  table = bucket.get_table_as_dictionary('tables/large.sdml')
+  assert table["rows"] == [[f'row {i}', i] for i in range(200)]
+  ranges = sorted(byte_range for (_, _, byte_range, _) in session.calls)
+  expected = [f'bytes={start}-{min(start + 1000, size) - 1}' for start in range(0, size, 1000)]
+  assert ranges == sorted(expected)
+  assert all(f'ifGenerationMatch={generation}' in query for (_, _, _, query) in session.calls)
+
+
+def test_ranged_download_is_parallel(emulator, monkeypatch):
+  monkeypatch.setattr(gcs_interface, 'RANGE_CHUNK_SIZE', 500)
+  bucket = _bucket(emulator, ranged_download_threshold = 500, max_workers = 4)
+  bucket.get_table_generations('tables/')
+  active = [0, 0]
+  lock = threading.Lock()
+
+  def slow(call):
+    with lock:
+      active[0] += 1
+      active[1] = max(active[1], active[0])
+    time.sleep(0.05)
+    with lock:
+      active[0] -= 1
+
+  RecordingSession(bucket, slow)
+  assert len(bucket.get_table_as_dictionary('tables/large.sdml')["rows"]) == 200
+  assert active[1] == 4
+
+
+def test_rewritten_blob_is_downloaded_whole(emulator, monkeypatch):
+  monkeypatch.setattr(gcs_interface, 'RANGE_CHUNK_SIZE', 1000)
+  bucket = _bucket(emulator, ranged_download_threshold = 1000)
+  bucket.get_table_generations('tables/')
+
+  def precondition_failed(call):
+    # The emulator doesn't check generations, so answer a ranged request as Cloud Storage would for a rewritten blob
+    if call[2] is not None:
+      response = requests.Response()
+      (response.status_code, response._content) = (412, b'{"error": {"code": 412, "message": "conditionNotMet"}}')
+      response.headers['Content-Type'] = 'application/json'
+      response.request = requests.Request('GET', 'http://localhost/').prepare()
+      return response
+    return None
+
+  session = RecordingSession(bucket, precondition_failed)
+  assert len(bucket.get_table_as_dictionary('tables/large.sdml')["rows"]) == 200
+  assert session.calls[-1][2] is None
+
+
+def test_reset_connections(emulator):
+  bucket = _bucket(emulator, max_workers = 7)
+  assert bucket.client._http is bucket.session
+  adapter = bucket.session.adapters['http://']
+  assert adapter._pool_maxsize == 7
+  bucket.get_table_as_dictionary('tables/small.sdml')
+  bucket.reset_connections()
+  assert bucket.session.adapters['http://'] is not adapter
+  assert bucket.get_table_as_dictionary('tables/small.sdml')["rows"] == [["a", 1]]
+
+
+def test_passed_client_is_left_alone(emulator):
+  client = SDMLStorageBucket('test').client
+  adapters = dict(client._http.adapters)
+  bucket = SDMLStorageBucket('test', client = client)
+  assert bucket.session is None
+  bucket.reset_connections()
+  assert dict(client._http.adapters) == adapters
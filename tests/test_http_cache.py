@@ -0,0 +1,61 @@
+'''
+Tests of the HTTP caching of the table pages (http_cache): ETags, 304s for a matching
+If-None-Match, new ETags when a table changes, and no ETag for pages showing a flashed
+message or an error
+'''
+import time
+
+from conftest import row_table, put_table
+
+
+def _sync(wiki, table_name, rows):
+  # Store and register the table, and compute its statistics: a table page isn't tagged
+  # until they have been (see main._render_table)
+  put_table(wiki.bucket, table_name, row_table(rows))
+  wiki.catalog_sync.sync()
+  wiki.table_stats.request(table_name, wiki.sdtp_server_blueprint.table_server.get_table(table_name))
+  deadline = time.time() + 5
+  while wiki.table_stats.peek(table_name) is None and time.time() < deadline:
+    time.sleep(0.01)
+
+
+def test_etag_and_not_modified(wiki, client):
+  _sync(wiki, 'etag/view', [['a', 1], ['b', 2]])
+  response = client.get('/view_table?table=etag/view')
+  assert response.status_code == 200
+  etag = response.headers["ETag"]
+  assert 'no-cache' in response.headers["Cache-Control"]
+  response = client.get('/view_table?table=etag/view', headers = {"If-None-Match": etag})
+  assert response.status_code == 304 and response.get_data() == b''
+  # Other arguments are another response
+  response = client.get('/view_table?table=etag/view&limit=1', headers = {"If-None-Match": etag})
+  assert response.status_code == 200 and response.headers["ETag"] != etag
+
+
+def test_etag_changes_with_the_table(wiki, client):
+  _sync(wiki, 'etag/replaced', [['old_a', 1]])
+  etag = client.get('/view_table?table=etag/replaced').headers["ETag"]
+  _sync(wiki, 'etag/replaced', [['new_a', 1]])
+  response = client.get('/view_table?table=etag/replaced', headers = {"If-None-Match": etag})
+  assert response.status_code == 200 and response.headers["ETag"] != etag
+  assert '> new_a <' in response.get_data(as_text = True)
+
+
+def test_flashed_pages_are_not_tagged(wiki, client):
+  _sync(wiki, 'etag/flashed', [['a', 1]])
+  url = '/filter_table?table=etag/flashed&filter={"operator": "IN_LIST"'
+  entries = wiki.response_cache.stats()["entries"]
+  for _ in range(2):
+    response = client.get(url)
+    assert response.status_code == 200 and 'is not a valid filter specification' in response.get_data(as_text = True)
+    assert 'ETag' not in response.headers
+  assert wiki.response_cache.stats()["entries"] == entries
+  # Once the message has been shown, the page is tagged again
+  assert 'ETag' in client.get('/view_table?table=etag/flashed').headers
+
+
+def test_error_pages_are_not_tagged(wiki, client):
+  for url in ['/view_table?table=etag/missing', '/get_range_spec?table_name=etag/missing&column_name=name', '/get_range_spec?table_name=samples/small&column_name=missing']:
+    response = client.get(url)
+    assert response.status_code >= 400
+    assert 'ETag' not in response.headers, url
@@ -0,0 +1,96 @@
+'''
+Tests of the instrumentation (metrics): the Prometheus text exposition of counters and
+histograms, the merge of the snapshots of several processes, collecting the snapshots in a
+shared directory, and /metrics
+'''
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import metrics
+from metrics import Counter, Histogram, exposition, merge, collect
+
+
+@pytest.fixture
+def local_metrics():
+  # A counter and a histogram which aren't left in the REGISTRY of the app's metrics
+  counter = Counter('test_events_total', 'Events seen', ['kind'])
+  histogram = Histogram('test_duration_seconds', 'Time taken', buckets = (0.1, 1.0))
+  yield (counter, histogram)
+  for name in [counter.name, histogram.name]:
+    metrics.REGISTRY.pop(name, None)
+
+
+def _snapshot(*local):
+  return {metric.name: metric.snapshot() for metric in local}
+
+
+def test_exposition_format(local_metrics):
+  (counter, histogram) = local_metrics
+  counter.inc(kind = 'plain')
+  counter.inc(2, kind = 'quote " back\\slash\nline')
+  for value in [0.05, 0.1, 0.5, 3.0]:
+    histogram.observe(value)
+  assert exposition(_snapshot(counter, histogram)).splitlines() == [
+    '# HELP test_duration_seconds Time taken',
+    '# TYPE test_duration_seconds histogram',
+    # The buckets are cumulative, and a value on a bound is counted in that bound's bucket
+    'test_duration_seconds_bucket{le="0.1"} 2',
+    'test_duration_seconds_bucket{le="1.0"} 3',
+    'test_duration_seconds_bucket{le="+Inf"} 4',
+    'test_duration_seconds_sum 3.65',
+    'test_duration_seconds_count 4',
+    '# HELP test_events_total Events seen',
+    '# TYPE test_events_total counter',
+    'test_events_total{kind="plain"} 1',
+    'test_events_total{kind="quote \\" back\\\\slash\\nline"} 2'
+  ]
+
+
+def test_merge_sums_two_snapshots(local_metrics):
+  (counter, histogram) = local_metrics
+  counter.inc(kind = 'a')
+  counter.inc(3, kind = 'b')
+  histogram.observe(0.05)
+  first = json.loads(json.dumps(_snapshot(counter, histogram)))
+  counter.reset()
+  histogram.reset()
+  counter.inc(10, kind = 'b')
+  counter.inc(kind = 'c')
+  histogram.observe(0.5)
+  histogram.observe(5.0)
+  second = json.loads(json.dumps(_snapshot(counter, histogram)))
+  unmerged = json.dumps([first, second])
+  merged = merge([first, second])
+  assert sorted(merged["test_events_total"]["values"]) == [[['a'], 1], [['b'], 13], [['c'], 1]]
+  assert merged["test_duration_seconds"]["values"] == [[[], [[1, 1, 1], 5.55, 3]]]
+  assert merged["test_duration_seconds"]["buckets"] == [0.1, 1.0]
+  assert json.dumps([first, second]) == unmerged
+  assert 'test_duration_seconds_count 3' in exposition(merged)
+
+
+def test_collect_sums_the_live_processes(tmp_path, local_metrics):
+  (counter, _) = local_metrics
+  counter.inc(kind = 'a')
+  other = {counter.name: dict(counter.snapshot(), values = [[['a'], 5]])}
+  # The snapshot of a process which has exited is dropped and removed
+  exited = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], capture_output = True, text = True)
+  dead = tmp_path / f'{exited.stdout.strip()}.json'
+  dead.write_text(json.dumps(other))
+  # The parent of this process is alive
+  (tmp_path / f'{os.getppid()}.json').write_text(json.dumps(other))
+  collected = collect(str(tmp_path))
+  assert collected[counter.name]["values"] == [[['a'], 6]]
+  assert not dead.exists() and (tmp_path / f'{os.getpid()}.json').exists()
+
+
+def test_metrics_route(wiki, client):
+  client.get('/view_table?table=samples/small')
+  response = client.get('/metrics')
+  assert response.status_code == 200 and response.mimetype == 'text/plain'
+  text = response.get_data(as_text = True)
+  assert '# TYPE wiki_request_duration_seconds histogram' in text
+  assert 'wiki_responses_total{endpoint="view_table",status="200"}' in text
@@ -0,0 +1,177 @@
+'''
+Tests of the query planner (query_planner) and the table statistics it plans from
+(table_stats): filters the statistics answer are planned as empty or all, and give the rows
+a scan gives; exact row counts are those of a scan; distinct counts are estimated within
+the sketch's error bound; and top_k is ordered by count
+'''
+import math
+import random
+
+import pytest
+
+from sdtp import RowTable
+from columnar_cache import ColumnarCache, ColumnarGCSTable, columnar_table
+from query_planner import plan_filter, PLAN_SCAN
+from row_groups import typed_rows
+from table_query import get_page, PLAN_EMPTY, PLAN_ALL
+from table_stats import compute_table_stats, column_stats, SKETCH_SIZE, TOP_K
+from conftest import FakeStorageClient
+
+SCHEMA = [
+  {"name": "count", "type": "number"},
+  {"name": "ratio", "type": "number"},
+  {"name": "name", "type": "string"},
+  {"name": "day", "type": "date"}
+]
+NUM_ROWS = 500
+
+
+def _rows():
+  # JSON rows: count is 0..99, ratio has missing values, name is one of four, day is in January 2020
+  generator = random.Random(1)
+  return [[
+    generator.randrange(100),
+    None if generator.random() < 0.1 else generator.random() * 10,
+    generator.choice(['alpha', 'beta', 'gamma', 'delta']),
+    f'2020-01-{generator.randrange(1, 32):02d}'
+  ] for _ in range(NUM_ROWS)]
+
+
+@pytest.fixture(params = ['rows', 'columnar'])
+def table(request, tmp_path):
+  if request.param == 'rows':
+    table = RowTable(SCHEMA, [])
+    table.rows = typed_rows([column["type"] for column in SCHEMA], _rows())
+    return table
+  client = FakeStorageClient()
+  client.put('rows.sdml', {"type": "RowTable", "schema": SCHEMA, "rows": _rows()})
+  table = ColumnarGCSTable(SCHEMA, 'test', 'rows.sdml', ColumnarCache(str(tmp_path), client))
+  assert columnar_table(table) is not None
+  return table
+
+
+def _comparable(rows):
+  # rows, with NaN (which isn't equal to itself) replaced by the string 'NaN'
+  return [['NaN' if value != value else value for value in row] for row in rows]
+
+
+def _scan(table, filter_spec):
+  # The number of rows which pass filter_spec, by filtering the whole table
+  page = get_page(table, filter_spec, 0, NUM_ROWS)
+  assert page["exact"]
+  return page["total"]
+
+
+EMPTY = [
+  {"operator": "IN_RANGE", "column": "count", "min_val": 1000, "max_val": 5000},
+  {"operator": "IN_RANGE", "column": "count", "min_val": -10, "max_val": -1},
+  {"operator": "IN_RANGE", "column": "day", "min_val": "2021-01-01", "max_val": "2021-12-31"},
+  {"operator": "IN_LIST", "column": "count", "values": [-5, 200]},
+  {"operator": "IN_LIST", "column": "name", "values": ["omega"]},
+  {"operator": "REGEX_MATCH", "column": "name", "expression": "z.*"},
+  {"operator": "ALL", "arguments": [
+    {"operator": "IN_RANGE", "column": "count", "min_val": 0, "max_val": 50},
+    {"operator": "IN_RANGE", "column": "ratio", "min_val": 20, "max_val": 30}
+  ]}
+]
+ALL = [
+  {"operator": "IN_RANGE", "column": "count", "min_val": 0, "max_val": 99},
+  {"operator": "IN_RANGE", "column": "count", "min_val": -1000, "max_val": 1000},
+  {"operator": "IN_RANGE", "column": "day", "min_val": "2019-01-01", "max_val": "2021-01-01"},
+  {"operator": "IN_LIST", "column": "name", "values": ["alpha", "beta", "gamma", "delta"]},
+  {"operator": "REGEX_MATCH", "column": "name", "expression": ".*a"},
+  {"operator": "ANY", "arguments": [
+    {"operator": "IN_RANGE", "column": "count", "min_val": 0, "max_val": 99},
+    {"operator": "IN_LIST", "column": "name", "values": ["omega"]}
+  ]}
+]
+EXACT = [
+  # Every row with a value passes, but not the rows where it is missing
+  {"operator": "IN_RANGE", "column": "ratio", "min_val": -1, "max_val": 11},
+  # Answered from a complete top_k
+  {"operator": "IN_LIST", "column": "name", "values": ["beta", "omega"]},
+  {"operator": "IN_RANGE", "column": "name", "min_val": "b", "max_val": "delta"},
+  {"operator": "REGEX_MATCH", "column": "name", "expression": "[ab].*"},
+  {"operator": "NONE", "arguments": [{"operator": "IN_LIST", "column": "name", "values": ["alpha"]}]}
+]
+
+
+def test_out_of_range_filters_are_planned_empty(table):
+  stats = compute_table_stats(table)
+  for spec in EMPTY:
+    plan = plan_filter(spec, SCHEMA, stats)
+    assert (plan["plan"], plan["rows"], plan["exact"]) == (PLAN_EMPTY, 0, True), spec
+    assert _scan(table, spec) == 0, spec
+    assert get_page(table, spec, 0, 10, plan)["rows"] == []
+
+
+def test_full_range_filters_are_planned_all(table):
+  stats = compute_table_stats(table)
+  for spec in ALL:
+    plan = plan_filter(spec, SCHEMA, stats)
+    assert (plan["plan"], plan["rows"], plan["exact"]) == (PLAN_ALL, NUM_ROWS, True), spec
+    assert _scan(table, spec) == NUM_ROWS, spec
+    planned = get_page(table, spec, 10, 20, plan)
+    assert _comparable(planned["rows"]) == _comparable(get_page(table, spec, 10, 20)["rows"])
+    assert planned["total"] == NUM_ROWS
+
+
+def test_exact_counts_match_a_scan(table):
+  stats = compute_table_stats(table)
+  for spec in EXACT:
+    plan = plan_filter(spec, SCHEMA, stats)
+    assert plan["plan"] == PLAN_SCAN and plan["exact"], spec
+    assert plan["rows"] == _scan(table, spec), spec
+
+
+def test_estimates_are_not_exact(table):
+  stats = compute_table_stats(table)
+  spec = {"operator": "IN_RANGE", "column": "count", "min_val": 10, "max_val": 29}
+  plan = plan_filter(spec, SCHEMA, stats)
+  assert (plan["plan"], plan["exact"]) == (PLAN_SCAN, False)
+  # Counts are spread uniformly over 0..99, so the estimate is close to the count
+  assert abs(plan["rows"] - _scan(table, spec)) < 0.1 * NUM_ROWS
+
+
+# The relative standard error of a k-minimum-values estimate is about 1 / sqrt(k - 2); the
+# tests allow three times that
+TOLERANCE = 3 / math.sqrt(SKETCH_SIZE - 2)
+
+
+@pytest.mark.parametrize('distinct', [SKETCH_SIZE, 5000, 50000])
+def test_distinct_estimates_are_within_the_error_bound(tmp_path, distinct):
+  generator = random.Random(distinct)
+  values = list(range(distinct)) + [generator.randrange(distinct) for _ in range(distinct)]
+  generator.shuffle(values)
+  estimates = [column_stats('number', values), column_stats('string', [f'v{value}' for value in values])]
+  client = FakeStorageClient()
+  client.put('rows.sdml', {"type": "RowTable", "schema": [{"name": "value", "type": "number"}], "rows": [[value] for value in values]})
+  columnar = ColumnarGCSTable([{"name": "value", "type": "number"}], 'test', 'rows.sdml', ColumnarCache(str(tmp_path), client))
+  estimates.append(compute_table_stats(columnar)["columns"]["value"])
+  for stats in estimates:
+    assert stats["distinct_exact"] == (distinct <= SKETCH_SIZE)
+    assert abs(stats["distinct"] - distinct) <= TOLERANCE * distinct, (stats["distinct"], distinct)
+
+
+def test_top_k_is_ordered_by_count(table):
+  top = compute_table_stats(table)["columns"]["name"]["top_k"]
+  counts = {}
+  for row in _rows():
+    counts[row[2]] = counts.get(row[2], 0) + 1
+  assert top == sorted([[name, count] for (name, count) in counts.items()], key = lambda pair: (-pair[1], pair[0]))
+
+
+@pytest.mark.parametrize('seed', [2, 3])
+def test_top_k_keeps_the_most_common_values(tmp_path, seed):
+  # TOP_K + 50 values, value i appearing i + 1 times, and two more values tied for the most
+  # common; ties are broken by value, whichever comes first, from the rows or the columns
+  values = [f'v{i:04d}' for i in range(TOP_K + 50) for _ in range(i + 1)] + ['tie_b', 'tie_a'] * (TOP_K + 50)
+  random.Random(seed).shuffle(values)
+  schema = [{"name": "value", "type": "string"}]
+  client = FakeStorageClient()
+  client.put('rows.sdml', {"type": "RowTable", "schema": schema, "rows": [[value] for value in values]})
+  columnar = ColumnarGCSTable(schema, 'test', 'rows.sdml', ColumnarCache(str(tmp_path), client))
+  expected = [['tie_a', TOP_K + 50], ['tie_b', TOP_K + 50]] + [[f'v{i:04d}', i + 1] for i in reversed(range(52, TOP_K + 50))]
+  for stats in [column_stats('string', values), compute_table_stats(columnar)["columns"]["value"]]:
+    assert not stats["top_k_complete"] and len(stats["top_k"]) == TOP_K
+    assert stats["top_k"] == expected
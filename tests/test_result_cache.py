@@ -0,0 +1,94 @@
+'''
+Tests of the filtered-page cache (result_cache): canonical filter keys, LRU eviction, expiry,
+invalidation when a table is replaced, and pages put after an invalidation
+'''
+import json
+
+import result_cache
+from result_cache import FilteredResultCache, canonical_filter, estimate_page_size
+from conftest import row_table, put_table
+
+IN_LIST = {"operator": "IN_LIST", "column": "name", "values": ["b", "a", "c"]}
+IN_RANGE = {"operator": "IN_RANGE", "column": "value", "min_val": 1, "max_val": 5}
+
+
+def _page(count):
+  return {"rows": [[f'r{i}', i] for i in range(count)], "total": count}
+
+
+def test_equivalent_filters_have_the_same_key():
+  reordered = json.loads('{"values": ["c", "a", "b"], "column": "name", "operator": "IN_LIST"}')
+  assert canonical_filter(IN_LIST) == canonical_filter(reordered)
+  spaced = json.loads(json.dumps({"operator": "ALL", "arguments": [IN_LIST, IN_RANGE]}, indent = 2))
+  assert canonical_filter(spaced) == canonical_filter({"operator": "ALL", "arguments": [IN_RANGE, reordered]})
+  assert canonical_filter(IN_LIST) != canonical_filter(dict(IN_LIST, values = ["a", "b"]))
+  cache = FilteredResultCache()
+  page = _page(3)
+  cache.put('t', IN_LIST, 0, 10, page)
+  assert cache.get('t', reordered, 0, 10) is page
+  assert cache.get('t', reordered, 10, 10) is None
+  assert cache.get('u', reordered, 0, 10) is None
+
+
+def test_least_recently_used_pages_are_evicted():
+  size = estimate_page_size(_page(10))
+  cache = FilteredResultCache(max_bytes = 2 * size)
+  cache.put('t', None, 0, 10, _page(10))
+  cache.put('t', None, 10, 10, _page(10))
+  # A hit makes the page the most recently used, so the other is evicted
+  assert cache.get('t', None, 0, 10) is not None
+  cache.put('t', None, 20, 10, _page(10))
+  assert cache.get('t', None, 10, 10) is None
+  assert cache.get('t', None, 0, 10) is not None and cache.get('t', None, 20, 10) is not None
+  stats = cache.stats()
+  assert (stats["evictions"], stats["entries"], stats["bytes"]) == (1, 2, 2 * size)
+  # A page larger than the cache isn't cached, and evicts nothing
+  cache.put('t', None, 30, 100, _page(100))
+  assert cache.get('t', None, 30, 100) is None and cache.stats()["entries"] == 2
+
+
+def test_pages_expire(monkeypatch):
+  now = [1000.0]
+  monkeypatch.setattr(result_cache.time, 'monotonic', lambda: now[0])
+  cache = FilteredResultCache(ttl = 10)
+  cache.put('t', IN_RANGE, 0, 10, _page(2))
+  now[0] += 9
+  assert cache.get('t', IN_RANGE, 0, 10) is not None
+  now[0] += 2
+  assert cache.get('t', IN_RANGE, 0, 10) is None
+  assert cache.stats()["entries"] == 0 and cache.stats()["bytes"] == 0
+
+
+def test_invalidate_drops_the_pages_of_a_table():
+  cache = FilteredResultCache()
+  cache.put('t', IN_LIST, 0, 10, _page(2))
+  cache.put('t', IN_RANGE, 0, 10, _page(2))
+  cache.put('u', IN_LIST, 0, 10, _page(2))
+  cache.invalidate('t')
+  assert cache.get('t', IN_LIST, 0, 10) is None and cache.get('t', IN_RANGE, 0, 10) is None
+  assert cache.get('u', IN_LIST, 0, 10) is not None
+  assert cache.stats()["bytes"] == estimate_page_size(_page(2))
+
+
+def test_a_page_put_after_invalidate_is_dropped():
+  # A request reads the epoch and the old table, the table is replaced, and then the request
+  # puts the page it computed from the old table
+  cache = FilteredResultCache()
+  epoch = cache.epoch('t')
+  cache.invalidate('t')
+  cache.put('t', IN_LIST, 0, 10, _page(2), epoch)
+  assert cache.get('t', IN_LIST, 0, 10) is None
+  # A page computed after the invalidation is cached
+  cache.put('t', IN_LIST, 0, 10, _page(2), cache.epoch('t'))
+  assert cache.get('t', IN_LIST, 0, 10) is not None
+
+
+def test_filter_table_does_not_serve_a_replaced_table(wiki, client):
+  put_table(wiki.bucket, 'cached/replaced', row_table([['old_a', 1], ['old_b', 2]]))
+  wiki.catalog_sync.sync()
+  url = '/filter_table?table=cached/replaced&filter=IN_RANGE(\'value\', 0, 10)'
+  assert '> old_b <' in client.get(url).get_data(as_text = True)
+  put_table(wiki.bucket, 'cached/replaced', row_table([['new_c', 3]]))
+  wiki.catalog_sync.sync()
+  text = client.get(url).get_data(as_text = True)
+  assert '> new_c <' in text and 'old_b' not in text
@@ -0,0 +1,107 @@
+'''
+Tests of the streaming export (table_export): the NDJSON, CSV and Arrow exports of a table
+read back as its rows, with strings which need quoting, missing values, and filters, from
+row tables and columnar tables alike; and /export_table streams its body
+'''
+import csv
+import datetime
+import io
+import json
+import types
+
+import pytest
+
+from sdtp import RowTable
+from columnar_cache import ColumnarCache, ColumnarGCSTable, columnar_table
+from table_export import export_stream
+from conftest import FakeStorageClient, row_table, put_table
+
+SCHEMA = [
+  {"name": "name", "type": "string"},
+  {"name": "value", "type": "number"},
+  {"name": "day", "type": "date"},
+  {"name": "flag", "type": "boolean"}
+]
+# The rows in JSON form: strings with the CSV delimiter, quotes, and line breaks, and a missing value
+ROWS = [
+  ['plain', 1.5, '2020-01-01', True],
+  ['with, comma', 2.5, '2020-01-02', False],
+  ['with "quotes"', None, '2020-01-03', True],
+  ['two\nlines', 4.5, '2020-01-04', False],
+  ["back\\slash 'single'", 5.5, '2020-01-05', True]
+]
+IN_RANGE = {"operator": "IN_RANGE", "column": "value", "min_val": 2, "max_val": 5}
+
+
+def _row_table():
+  # A RowTable holding ROWS with their SDML types
+  table = RowTable(SCHEMA, [])
+  table.rows = [[name, float('nan') if value is None else value, datetime.date.fromisoformat(day), flag] for (name, value, day, flag) in ROWS]
+  return table
+
+
+def _columnar_table(tmp_path):
+  client = FakeStorageClient()
+  client.put('rows.sdml', {"type": "RowTable", "schema": SCHEMA, "rows": ROWS})
+  table = ColumnarGCSTable(SCHEMA, 'test', 'rows.sdml', ColumnarCache(str(tmp_path), client))
+  assert columnar_table(table) is not None
+  return table
+
+
+@pytest.fixture(params = ['rows', 'columnar'])
+def table(request, tmp_path):
+  return _row_table() if request.param == 'rows' else _columnar_table(tmp_path)
+
+
+def _expected(filter_spec):
+  if filter_spec is None:
+    return ROWS
+  return [row for row in ROWS if row[1] is not None and 2 <= row[1] <= 5]
+
+
+@pytest.mark.parametrize('filter_spec', [None, IN_RANGE])
+def test_ndjson_round_trip(table, filter_spec):
+  lines = ''.join(export_stream(table, filter_spec, 'ndjson', chunk_rows = 2)).splitlines()
+  assert json.loads(lines[0]) == SCHEMA
+  assert [json.loads(line) for line in lines[1:]] == _expected(filter_spec)
+
+
+@pytest.mark.parametrize('filter_spec', [None, IN_RANGE])
+def test_csv_round_trip(table, filter_spec):
+  text = ''.join(export_stream(table, filter_spec, 'csv', chunk_rows = 2))
+  rows = list(csv.reader(io.StringIO(text)))
+  assert rows[0] == [column["name"] for column in SCHEMA]
+  # CSV has no types: numbers and booleans are read back as their text, and a missing value as ''
+  assert rows[1:] == [[name, '' if value is None else str(value), day, str(flag)] for (name, value, day, flag) in _expected(filter_spec)]
+
+
+@pytest.mark.parametrize('filter_spec', [None, IN_RANGE])
+def test_arrow_round_trip(table, filter_spec):
+  pyarrow = pytest.importorskip('pyarrow')
+  data = b''.join(export_stream(table, filter_spec, 'arrow', chunk_rows = 2))
+  result = pyarrow.ipc.open_stream(data).read_all()
+  assert result.schema.names == [column["name"] for column in SCHEMA]
+  expected = _expected(filter_spec)
+  assert result.num_rows == len(expected)
+  assert result.column('value').to_pylist() == [row[1] for row in expected]
+  assert result.column('name').to_pylist() == [row[0] for row in expected]
+  assert result.column('day').to_pylist() == [datetime.date.fromisoformat(row[2]) for row in expected]
+  assert result.column('flag').to_pylist() == [row[3] for row in expected]
+
+
+def test_export_is_generated_a_chunk_at_a_time():
+  table = RowTable([{"name": "value", "type": "number"}], [[i] for i in range(10)])
+  stream = export_stream(table, None, 'ndjson', chunk_rows = 4)
+  assert isinstance(stream, types.GeneratorType)
+  assert [piece.count('\n') for piece in stream] == [1, 4, 4, 2]
+
+
+def test_export_table_streams_the_response(wiki, client):
+  put_table(wiki.bucket, 'export/streamed', row_table([[f'r{i}', i] for i in range(20)]))
+  wiki.catalog_sync.sync()
+  response = client.get('/export_table?table=export/streamed&format=csv&filter=IN_RANGE(\'value\', 5, 9)')
+  assert response.status_code == 200 and response.is_streamed
+  assert response.headers["Content-Disposition"] == 'attachment; filename="streamed.csv"'
+  assert list(csv.reader(io.StringIO(response.get_data(as_text = True))))[1:] == [[f'r{i}', str(i)] for i in range(5, 10)]
+  assert client.get('/export_table?table=export/streamed&format=xml').status_code == 400
+  assert client.get('/export_table?table=export/missing').status_code == 404
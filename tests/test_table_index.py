@@ -0,0 +1,139 @@
+'''
+Tests of the secondary indexes (table_index): the rows a SortedIndex or HashIndex finds for a
+range or a list of values are those a full scan finds, at and between the bounds, for values
+which aren't in the column, and over columns with missing values; and a ColumnarGCSTable
+builds its indexes again for each generation of its blob
+'''
+import random
+
+import numpy as np
+import pytest
+
+from sdtp import SDQLFilter, InvalidDataException
+from columnar_cache import ColumnarCache, ColumnarGCSTable, ColumnarTable, columnar_table
+from row_groups import typed_rows
+from table_index import SortedIndex, HashIndex, check_index_spec
+from table_query import get_page
+from vector_filter import filter_indices, _indexed_rows
+from conftest import FakeStorageClient
+
+SCHEMA = [
+  {"name": "count", "type": "number"},
+  {"name": "ratio", "type": "number"},
+  {"name": "name", "type": "string"},
+  {"name": "day", "type": "date"}
+]
+
+
+def _scan(column, test):
+  return [i for (i, value) in enumerate(column.tolist()) if test(value)]
+
+
+def test_sorted_index_ranges_include_both_bounds():
+  column = np.array(random.Random(1).choices(range(0, 40, 2), k = 200), dtype = np.int64)
+  index = SortedIndex(column)
+  # Bounds on values in the column, between them, equal, reversed, and outside the column
+  for (low, high) in [(10, 20), (11, 19), (10, 10), (11, 11), (20, 10), (-5, 0), (38, 100), (-100, 100), (50, 60)]:
+    assert index.range(low, high).tolist() == _scan(column, lambda value: low <= value <= high), (low, high)
+
+
+@pytest.mark.parametrize('kind', [SortedIndex, HashIndex])
+def test_lookups_match_a_scan(kind):
+  column = np.array(random.Random(2).choices(range(0, 40, 2), k = 200), dtype = np.int64)
+  index = kind(column)
+  for values in [[4], [4, 4, 6], [5, 7], [0, 38, 39], [], [100]]:
+    assert index.lookup(values).tolist() == _scan(column, lambda value: value in values), values
+
+
+@pytest.mark.parametrize('kind', [SortedIndex, HashIndex])
+def test_lookups_skip_missing_values(kind):
+  column = np.array([1.5, np.nan, 2.5, 1.5, np.nan, 0.5])
+  assert kind(column).lookup([1.5, 0.5]).tolist() == [0, 3, 5]
+  assert kind(column).lookup([3.5]).tolist() == []
+  if kind == SortedIndex:
+    assert kind(column).range(0, 2).tolist() == [0, 3, 5]
+    assert kind(column).range(-np.inf, np.inf).tolist() == [0, 2, 3, 5]
+
+
+def _rows(generator, count):
+  # JSON rows; ratio has missing values, which a ColumnarTable holds as NaN
+  return [[
+    generator.randrange(20),
+    None if generator.random() < 0.2 else generator.randrange(8) / 2,
+    generator.choice(['alpha', 'beta', 'gamma', 'delta']),
+    f'2020-01-{generator.randrange(1, 29):02d}'
+  ] for _ in range(count)]
+
+
+FILTERS = [
+  {"operator": "IN_RANGE", "column": "count", "min_val": 5, "max_val": 9},
+  {"operator": "IN_RANGE", "column": "count", "min_val": 5.5, "max_val": 9.5},
+  {"operator": "IN_RANGE", "column": "count", "min_val": 9, "max_val": 5},
+  {"operator": "IN_RANGE", "column": "count", "min_val": 19, "max_val": 100},
+  {"operator": "IN_LIST", "column": "count", "values": [0, 3, 19, 20]},
+  {"operator": "IN_RANGE", "column": "ratio", "min_val": 1, "max_val": 2.5},
+  {"operator": "IN_RANGE", "column": "ratio", "min_val": -10, "max_val": 10},
+  {"operator": "IN_LIST", "column": "ratio", "values": [0, 1.5, 9]},
+  {"operator": "IN_RANGE", "column": "name", "min_val": "b", "max_val": "delta"},
+  {"operator": "IN_RANGE", "column": "name", "min_val": "beta", "max_val": "beta"},
+  {"operator": "IN_LIST", "column": "name", "values": ["alpha", "omega"]},
+  {"operator": "IN_RANGE", "column": "day", "min_val": "2020-01-10", "max_val": "2020-01-12"},
+  {"operator": "IN_LIST", "column": "day", "values": ["2020-01-01", "2020-01-02", "2019-12-31"]},
+  {"operator": "ALL", "arguments": [
+    {"operator": "IN_RANGE", "column": "count", "min_val": 0, "max_val": 10},
+    {"operator": "IN_LIST", "column": "name", "values": ["beta", "gamma"]}
+  ]},
+  {"operator": "ANY", "arguments": [
+    {"operator": "IN_LIST", "column": "count", "values": [1, 2]},
+    {"operator": "IN_RANGE", "column": "ratio", "min_val": 3, "max_val": 3.5}
+  ]}
+]
+
+
+def _columnar(tmp_path, rows):
+  client = FakeStorageClient()
+  client.put('rows.sdml', {"type": "RowTable", "schema": SCHEMA, "rows": rows})
+  (table, _) = ColumnarCache(str(tmp_path), client).get_table('test', 'rows.sdml')
+  assert isinstance(table, ColumnarTable)
+  return table
+
+
+@pytest.mark.parametrize('kind', ['sorted', 'hash'])
+def test_indexed_filters_match_a_scan(tmp_path, kind):
+  rows = _rows(random.Random(3), 300)
+  table = _columnar(tmp_path, rows)
+  table.build_indexes({column["name"]: kind for column in SCHEMA})
+  typed = typed_rows([column["type"] for column in SCHEMA], rows)
+  for spec in FILTERS:
+    sdql_filter = SDQLFilter(spec, SCHEMA)
+    if kind == 'sorted':
+      # Every filter is answered by the indexes, not a full scan
+      assert _indexed_rows(sdql_filter, table) is not None, spec
+    assert filter_indices(sdql_filter, table).tolist() == sorted(sdql_filter.filter_index(typed)), spec
+
+
+def test_index_specs_are_checked():
+  check_index_spec({"count": "sorted", "name": "hash"}, SCHEMA)
+  for spec in [["count"], {"missing": "sorted"}, {"count": "btree"}]:
+    with pytest.raises(InvalidDataException):
+      check_index_spec(spec, SCHEMA)
+
+
+def test_indexes_are_built_for_each_generation(tmp_path):
+  client = FakeStorageClient()
+  client.put('rows.sdml', {"type": "RowTable", "schema": SCHEMA, "rows": [[1, 0.5, 'alpha', '2020-01-01'], [2, 1.0, 'beta', '2020-01-02']]})
+  table = ColumnarGCSTable(SCHEMA, 'test', 'rows.sdml', ColumnarCache(str(tmp_path), client), revalidate_interval = 0, indexes = {"count": "sorted"})
+  in_range = {"operator": "IN_RANGE", "column": "count", "min_val": 2, "max_val": 3}
+  assert [row[2] for row in get_page(table, in_range, 0, 10)["rows"]] == ['beta']
+  first = columnar_table(table)
+  # A new generation is served with an index over its own rows
+  client.put('rows.sdml', {"type": "RowTable", "schema": SCHEMA, "rows": [[3, 0.5, 'gamma', '2020-01-03'], [4, 1.0, 'delta', '2020-01-04']]})
+  assert [row[2] for row in get_page(table, in_range, 0, 10)["rows"]] == ['gamma']
+  second = columnar_table(table)
+  assert second is not first
+  assert second.indexes[0].sorted_values.tolist() == [3, 4]
+  assert first.indexes[0].sorted_values.tolist() == [1, 2]
+  # A generation which can't be encoded is served as rows, with no index
+  client.put('rows.sdml', {"type": "RowTable", "schema": SCHEMA, "rows": [[None, 0.5, 'zeta', '2020-01-05'], [2, 1.0, 'eta', '2020-01-06']]})
+  assert [row[2] for row in get_page(table, in_range, 0, 10)["rows"]] == ['eta']
+  assert columnar_table(table) is None
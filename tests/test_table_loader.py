@@ -0,0 +1,128 @@
+'''
+Tests of startup loading (table_loader): lazy and eager registration, and concurrent loading
+'''
+import threading
+import time
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+
+from sdtp import TableServer, RowTableFactory
+from gcs_interface import SDMLStorageBucket
+from memory_bucket import MemoryStorageBucket
+from table_loader import LazySDMLTable, load_tables_from_bucket
+from conftest import row_table
+
+
+class CountingFactory(RowTableFactory):
+  # A RowTableFactory which counts its builds, and takes delay seconds over each
+  def __init__(self, delay = 0):
+    super(CountingFactory, self).__init__()
+    self.builds = 0
+    self.delay = delay
+
+  def build_table(self, table_spec):
+    self.builds += 1
+    time.sleep(self.delay)
+    return super(CountingFactory, self).build_table(table_spec)
+
+
+def _server(factory = None):
+  server = TableServer()
+  if factory is not None:
+    server.factories['RowTable'] = factory
+  return server
+
+
+def _bucket(count):
+  return MemoryStorageBucket('test', {f'tables/t{i}.sdml': row_table([[f'r{i}', i]]) for i in range(count)})
+
+
+def test_lazy_load():
+  factory = CountingFactory()
+  server = _server(factory)
+  timings = load_tables_from_bucket(_bucket(5), server, 'tables/')
+  assert timings["tables"] == 5 and timings["failed"] == 0
+  assert sorted(server.servers.keys()) == [f't{i}' for i in range(5)]
+  table = server.get_table('t3')
+  assert isinstance(table, LazySDMLTable) and not table.is_loaded()
+  assert factory.builds == 0
+  # The schema is known without building the table
+  assert table.column_names() == ['name', 'value']
+  assert factory.builds == 0
+  assert table.get_filtered_rows() == [['r3', 3]]
+  assert table.is_loaded() and factory.builds == 1
+
+
+def test_eager_load():
+  server = _server()
+  load_tables_from_bucket(_bucket(3), server, 'tables/', lazy = False)
+  assert not any(isinstance(table, LazySDMLTable) for table in server.servers.values())
+  assert server.get_table('t1').get_filtered_rows() == [['r1', 1]]
+
+
+def test_bad_tables_are_skipped():
+  bucket = _bucket(2)
+  bucket.put_blob('tables/broken.sdml', '{not json')
+  bucket.put_blob('tables/no_schema.sdml', '{"type": "RowTable"}')
+  server = _server()
+  timings = load_tables_from_bucket(bucket, server, 'tables/')
+  assert (timings["tables"], timings["failed"]) == (2, 2)
+  assert sorted(server.servers.keys()) == ['t0', 't1']
+
+
+def test_concurrent_first_access_builds_once():
+  factory = CountingFactory(delay = 0.05)
+  server = _server(factory)
+  load_tables_from_bucket(_bucket(1), server, 'tables/')
+  table = server.get_table('t0')
+  results = []
+  threads = [threading.Thread(target = lambda: results.append(table.get_filtered_rows())) for _ in range(8)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert results == [[['r0', 0]]] * 8
+  assert factory.builds == 1
+
+
+def test_concurrent_downloads():
+  # The specifications are downloaded with up to max_workers requests outstanding
+  class SlowBucket(SDMLStorageBucket):
+    def __init__(self, blobs):
+      super(SlowBucket, self).__init__('test', client = storage.Client(project = 'test', credentials = AnonymousCredentials()))
+      self.blobs = blobs
+      self.active = 0
+      self.most_active = 0
+      self.count_lock = threading.Lock()
+
+    def get_all_table_names(self, prefix = None):
+      return list(self.blobs.keys())
+
+    def _get_json_blob(self, blob_name):
+      with self.count_lock:
+        self.active += 1
+        self.most_active = max(self.most_active, self.active)
+      time.sleep(0.05)
+      with self.count_lock:
+        self.active -= 1
+      return self.blobs[blob_name]
+
+  bucket = SlowBucket({f'tables/t{i}.sdml': row_table([[f'r{i}', i]]) for i in range(12)})
+  server = _server()
+  start = time.perf_counter()
+  timings = load_tables_from_bucket(bucket, server, 'tables/', max_workers = 4)
+  assert timings["tables"] == 12
+  assert bucket.most_active == 4
+  # Three rounds of four downloads, rather than twelve one after another
+  assert time.perf_counter() - start < 12 * 0.05
+  assert server.get_table('t11').get_filtered_rows() == [['r11', 11]]
+
+
+def test_app_registers_lazily(wiki, client):
+  table = wiki.sdtp_server_blueprint.table_server.get_table('samples/small')
+  assert isinstance(table, LazySDMLTable)
+  response = client.get('/view_table?table=samples/small')
+  assert response.status_code == 200
+  assert table.is_loaded()
+  assert wiki.startup_timings["tables"] >= 1
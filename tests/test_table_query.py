@@ -0,0 +1,70 @@
+'''
+Tests of paginated queries (table_query): pages, the early stop and estimated totals of a
+row-by-row scan, plans which skip the filter, and missing values
+'''
+from sdtp import RowTable, SDQLFilter
+from table_query import get_page, compile_row_predicate, clamp_page, MAX_PAGE_SIZE
+
+SCHEMA = [{"name": "name", "type": "string"}, {"name": "value", "type": "number"}]
+EVEN = {"operator": "IN_LIST", "column": "value", "values": list(range(0, 100, 2))}
+
+
+def _table(count = 100):
+  return RowTable(SCHEMA, [[f'r{i}', i] for i in range(count)])
+
+
+def test_unfiltered_pages():
+  page = get_page(_table(), None, 40, 20)
+  assert page["rows"] == [[f'r{i}', i] for i in range(40, 60)]
+  assert (page["total"], page["exact"], page["has_next"]) == (100, True, True)
+  last = get_page(_table(), None, 90, 20)
+  assert (len(last["rows"]), last["has_next"]) == (10, False)
+
+
+def test_filtered_scan_stops_after_the_page():
+  page = get_page(_table(), EVEN, 0, 10)
+  assert page["rows"] == [[f'r{i}', i] for i in range(0, 20, 2)]
+  # The page and one more match: 11 matches, in the first 21 rows
+  assert page["scanned"] == 21 and page["has_next"]
+  assert not page["exact"] and page["total"] == round(11 * 100 / 21)
+
+
+def test_filtered_scan_to_the_end_is_exact():
+  page = get_page(_table(), EVEN, 40, 20)
+  assert page["rows"] == [[f'r{i}', i] for i in range(80, 100, 2)]
+  assert (page["total"], page["exact"], page["has_next"], page["scanned"]) == (50, True, False, 100)
+
+
+def test_plans_skip_the_filter():
+  empty = get_page(_table(), EVEN, 0, 10, {"plan": "empty", "exact": True, "rows": 0})
+  assert (empty["rows"], empty["total"], empty["scanned"]) == ([], 0, 0)
+  every = get_page(_table(), EVEN, 0, 10, {"plan": "all", "exact": True, "rows": 100})
+  assert every["rows"] == [[f'r{i}', i] for i in range(10)]
+
+
+def test_the_predicate_agrees_with_filter_index():
+  rows = _table().rows
+  for spec in [
+    EVEN,
+    {"operator": "IN_RANGE", "column": "value", "min_val": 10, "max_val": 19},
+    {"operator": "REGEX_MATCH", "column": "name", "expression": "r[0-9]5"},
+    {"operator": "NONE", "arguments": [EVEN, {"operator": "IN_RANGE", "column": "value", "min_val": 0, "max_val": 50}]},
+    {"operator": "ANY", "arguments": [{"operator": "IN_LIST", "column": "name", "values": ["r3"]}, {"operator": "IN_RANGE", "column": "value", "min_val": 98, "max_val": 200}]}
+  ]:
+    sdql_filter = SDQLFilter(spec, SCHEMA)
+    predicate = compile_row_predicate(sdql_filter)
+    assert {i for (i, row) in enumerate(rows) if predicate(row)} == sdql_filter.filter_index(rows)
+
+
+def test_missing_values_never_match_ranges_or_expressions():
+  table = RowTable(SCHEMA, [['a', 1]])
+  table.rows = [['a', 1], [None, 2], ['c', 3]]
+  assert get_page(table, {"operator": "IN_RANGE", "column": "name", "min_val": "a", "max_val": "z"})["rows"] == [['a', 1], ['c', 3]]
+  assert get_page(table, {"operator": "REGEX_MATCH", "column": "name", "expression": ".*"})["rows"] == [['a', 1], ['c', 3]]
+  assert get_page(table, {"operator": "NONE", "arguments": [{"operator": "IN_LIST", "column": "name", "values": ["a"]}]})["rows"] == [[None, 2], ['c', 3]]
+
+
+def test_clamp_page():
+  assert clamp_page(None, None) == (0, 20)
+  assert clamp_page('-5', str(MAX_PAGE_SIZE * 2)) == (0, MAX_PAGE_SIZE)
+  assert clamp_page('x', 'y') == (0, 20)
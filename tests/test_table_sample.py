@@ -0,0 +1,88 @@
+'''
+Tests of the table samples (table_sample): drawing them in the background, the bound on the
+samples kept in memory, and the answers given while a sample is being drawn
+'''
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sdtp import RowTable
+from http_cache import TableVersions
+from memory_bucket import MemoryStorageBucket
+from table_sample import TableSamples
+from conftest import row_table, put_table
+
+SCHEMA = [{"name": "name", "type": "string"}, {"name": "value", "type": "number"}]
+
+
+def _table(count):
+  return RowTable(SCHEMA, [[f'r{i}', i] for i in range(count)])
+
+
+def _samples(names, **kwargs):
+  versions = TableVersions()
+  for name in names:
+    versions.set(name, '1')
+  return TableSamples(MemoryStorageBucket('test'), versions, size = 10, **kwargs)
+
+
+def test_request_draws_in_the_background():
+  release = threading.Event()
+  executor = ThreadPoolExecutor(max_workers = 1)
+  # Hold the executor, so the sample can't be drawn until release is set
+  executor.submit(release.wait)
+  samples = _samples(['t'], executor = executor)
+  table = _table(100)
+  assert samples.request('t', table) is None
+  assert samples.request('t', table) is None
+  release.set()
+  executor.shutdown(wait = True)
+  sample = samples.request('t', table)
+  assert (sample["num_rows"], len(sample["rows"])) == (100, 10)
+  assert samples.pending == set()
+
+
+def test_samples_in_memory_are_bounded():
+  names = [f't{i}' for i in range(4)]
+  samples = _samples(names, max_entries = 2)
+  for name in names:
+    samples.get(name, _table(20))
+  assert list(samples.stats.keys()) == ['t2', 't3']
+  # A use makes a sample the most recently used, and a dropped sample is read back from the bucket
+  samples.peek('t2')
+  assert samples.peek('t0')["num_rows"] == 20
+  assert list(samples.stats.keys()) == ['t2', 't0']
+
+
+def _wait_for_sample(wiki, table_name):
+  deadline = time.time() + 5
+  while wiki.table_samples.peek(table_name) is None and time.time() < deadline:
+    time.sleep(0.01)
+
+
+def test_approximate_query_while_drawing(wiki, client):
+  put_table(wiki.bucket, 'sampled/count', row_table([[f'r{i}', i] for i in range(50)]))
+  wiki.catalog_sync.sync()
+  response = client.get('/approximate_query?table=sampled/count')
+  if response.status_code == 503:
+    assert response.headers["Retry-After"] == "1"
+    _wait_for_sample(wiki, 'sampled/count')
+    response = client.get('/approximate_query?table=sampled/count')
+  assert response.status_code == 200
+  assert response.get_json()["count"] == 50
+
+
+def test_sampled_preview_while_drawing(wiki, client):
+  put_table(wiki.bucket, 'sampled/preview', row_table([[f'r{i}', i] for i in range(50)]))
+  wiki.catalog_sync.sync()
+  release = threading.Event()
+  wiki.stats_executor.submit(release.wait)
+  try:
+    page = client.get('/view_table?table=sampled/preview&sample=1')
+    assert page.status_code == 200 and 'ETag' not in page.headers
+    assert 'is being drawn' in page.get_data(as_text = True)
+  finally:
+    release.set()
+  _wait_for_sample(wiki, 'sampled/preview')
+  page = client.get('/view_table?table=sampled/preview&sample=1')
+  assert 'is being drawn' not in page.get_data(as_text = True)
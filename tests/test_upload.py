@@ -0,0 +1,66 @@
+'''
+Tests of /upload: the layout an uploaded table is stored in, and cleaning up after a failed upload
+'''
+import io
+import json
+
+import pytest
+
+from sdtp import SDMLTableFactory, RowTable
+from conftest import row_table, TABLE_PREFIX
+
+
+class BucketTableFactory(SDMLTableFactory):
+  # Builds GCSTables as empty RowTables, since sdtp's GCSTable needs Cloud Storage credentials
+  def __init__(self):
+    super(BucketTableFactory, self).__init__('GCSTable')
+
+  def build_table(self, table_spec):
+    super(BucketTableFactory, self).build_table(table_spec)
+    return RowTable(table_spec['schema'], [])
+
+
+@pytest.fixture
+def uploader(wiki, client, monkeypatch):
+  '''
+  A test client logged in as the user test, who may upload
+  '''
+  monkeypatch.setitem(wiki.sdtp_server_blueprint.table_server.factories, 'GCSTable', BucketTableFactory())
+  with client.session_transaction() as session:
+    (session['email'], session['user']) = ('test@berkeley.edu', 'test')
+  return client
+
+
+def _upload(client, filename, table_dictionary):
+  data = {'file': (io.BytesIO(json.dumps(table_dictionary).encode('utf-8')), filename)}
+  return client.post('/upload', data = data, content_type = 'multipart/form-data')
+
+
+def _stored_spec(wiki, table_name):
+  return wiki.bucket.get_table_as_dictionary(f'{TABLE_PREFIX}{table_name}.sdml')
+
+
+def test_tables_are_one_blob_by_default(wiki, uploader):
+  response = _upload(uploader, 'plain.sdml', row_table([[f'r{i}', i] for i in range(5)]))
+  assert response.status_code == 302 and 'test/plain' in response.headers['Location']
+  assert _stored_spec(wiki, 'test/plain')["type"] == 'GCSTable'
+  assert wiki.bucket.get_table_as_dictionary('rowtables/test/plain.sdml')["rows"] == [[f'r{i}', i] for i in range(5)]
+
+
+def test_large_tables_are_chunked(wiki, uploader, monkeypatch):
+  monkeypatch.setattr(wiki, 'CHUNK_MIN_ROWS', 5)
+  monkeypatch.setattr(wiki, 'ROW_GROUP_SIZE', 2)
+  _upload(uploader, 'small.sdml', row_table([[f'r{i}', i] for i in range(4)]))
+  _upload(uploader, 'large.sdml', row_table([[f'r{i}', i] for i in range(5)]))
+  assert _stored_spec(wiki, 'test/small')["type"] == 'GCSTable'
+  assert _stored_spec(wiki, 'test/large')["type"] == 'ChunkedGCSTable'
+  assert wiki.sdtp_server_blueprint.table_server.get_table('test/large').get_filtered_rows() == [[f'r{i}', i] for i in range(5)]
+
+
+def test_failed_upload_unregisters_the_table(wiki, uploader, monkeypatch):
+  def fail(uploads, max_workers = None):
+    raise ConnectionError('bucket unreachable')
+  monkeypatch.setattr(wiki.bucket, 'upload_tables', fail)
+  response = _upload(uploader, 'lost.sdml', row_table([["a", 1]]))
+  assert response.status_code == 302 and 'test/lost' not in response.headers['Location']
+  assert 'test/lost' not in wiki.sdtp_server_blueprint.table_server.servers
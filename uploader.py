@@ -1,6 +1,17 @@
 from sdtp import  InvalidDataException
 from pathlib import Path
+import io
 import json
+import tempfile
+import ijson
+from ijson.common import ObjectBuilder
+
+# The fields that must be in the header of an uploaded SDML file
+SDML_HEADER_KEYS = {'schema', 'type'}
+# Header fields that may be in an uploaded SDML file, and are kept if they are
+SDML_OPTIONAL_HEADER_KEYS = {'indexes'}
+# The extensions of the spreadsheet files that can be converted to SDML on upload
+SPREADSHEET_EXTENSIONS = {'.csv', '.xlsx'}
 
 
 def make_SDMLTable_from_upload(uploaded_file, valid_table_types):
@@ -18,8 +29,7 @@ def make_SDMLTable_from_upload(uploaded_file, valid_table_types):
   '''
   # Error check -- is the file extension .sdml?
   filename = uploaded_file.filename
-  if Path(filename).suffix.lower() != '.sdml':
-    raise InvalidDataException(f'{filename} must be an SDML file, with a .sdml extension')
+  _check_sdml_extension(filename)
 
   # is the uploaded file's contents a JSON dictionary?
   contents = uploaded_file.read()
@@ -40,3 +50,95 @@ def make_SDMLTable_from_upload(uploaded_file, valid_table_types):
   
   # Make the UploadedSDMLTable with name and dictionary
   return {"name": Path(filename).stem, "table": sdml_form}
+
+
+def _check_sdml_extension(filename):
+  # Raise an InvalidDataException if filename doesn't have a .sdml extension
+  if Path(filename).suffix.lower() != '.sdml':
+    raise InvalidDataException(f'{filename} must be an SDML file, with a .sdml extension')
+
+
+def read_SDML_header(uploaded_file, valid_table_types):
+  '''
+  Validate an uploaded SDML file without reading it into memory, and return its name and header.
+  The file is parsed with an incremental JSON parser; only the schema and type fields
+  (and the indexes field, if present) are built, and the rest of the file (typically the rows) is checked for valid JSON and
+  discarded as it is read.  On return, the file's stream is rewound, so it can be streamed
+  to the bucket with SDMLStorageBucket.upload_table_stream.
+  Returns a dictionary {"name", "table", "num_rows"}, where name is the name of the file, table is
+  the dictionary {"schema", "type"}, with "indexes" if the file has it, and num_rows is the
+  number of rows counted as the file was read.  Throws an InvalidDataException if this isn't a valid SDML Table.
+  Arguments:
+    uploaded_file: an instance of werkzeug.FileStorage
+    valid_table_types: a set of table types that can be realized
+  '''
+  filename = uploaded_file.filename
+  _check_sdml_extension(filename)
+  stream = uploaded_file.stream
+  stream.seek(0)
+  builders = {}
+  num_rows = 0
+  try:
+    events = ijson.parse(stream)
+    (_, first_event, _) = next(events, (None, None, None))
+    if first_event != 'start_map':
+      raise InvalidDataException(f'{filename} is not a dictionary')
+    for (prefix, event, value) in events:
+      if prefix == 'rows.item' and event == 'start_array':
+        num_rows += 1
+      key = prefix.split('.', 1)[0]
+      if key not in SDML_HEADER_KEYS and key not in SDML_OPTIONAL_HEADER_KEYS:
+        continue
+      if key not in builders:
+        builders[key] = ObjectBuilder()
+      builders[key].event(event, value)
+  except ijson.JSONError as e:
+    raise InvalidDataException(f'JSON Decode Error {str(e)} when reading {filename}')
+  finally:
+    stream.seek(0)
+  header = {key: builder.value for (key, builder) in builders.items()}
+
+  missing_keys = SDML_HEADER_KEYS - set(header.keys())
+  if len(missing_keys) > 0:
+    raise InvalidDataException(f'{filename} is missing {missing_keys}')
+  if not (header["type"] in valid_table_types):
+    raise InvalidDataException(f'The table type of {filename} is {header["type"]}.  Valid types are {valid_table_types}')
+  return {"name": Path(filename).stem, "table": header, "num_rows": num_rows}
+
+
+def is_spreadsheet_upload(uploaded_file):
+  '''
+  Return True if uploaded_file is a CSV or Excel file, which convert_spreadsheet_upload can convert
+  '''
+  return Path(uploaded_file.filename).suffix.lower() in SPREADSHEET_EXTENSIONS
+
+
+def convert_spreadsheet_upload(uploaded_file):
+  '''
+  Convert an uploaded CSV or Excel (.xlsx) file to an SDML RowTable.  The first row of the
+  file must hold the column names and the second row the SDML types of the columns.  The
+  file is converted in chunks by convert.convert_csv or convert.convert_excel, and the SDML form is
+  written to a temporary file rather than held in memory.
+  Returns a dictionary {"name", "table", "stream", "num_rows"}, where name is the name of the
+  file, table is the dictionary {"schema", "type"}, stream is a binary file, positioned at the
+  start, holding the SDML table (the caller should close it when done), and num_rows is the
+  number of rows.  Throws an InvalidDataException
+  if the file can't be converted.
+  Arguments:
+    uploaded_file: an instance of werkzeug.FileStorage
+  '''
+  # Imported here so that pandas and openpyxl are only loaded when a spreadsheet is uploaded
+  from convert import convert_csv, convert_excel, write_sdml
+  filename = uploaded_file.filename
+  suffix = Path(filename).suffix.lower()
+  if suffix not in SPREADSHEET_EXTENSIONS:
+    raise InvalidDataException(f'{filename} must be a CSV or Excel file, with a .csv or .xlsx extension')
+  uploaded_file.stream.seek(0)
+  table = convert_csv(uploaded_file.stream) if suffix == '.csv' else convert_excel(uploaded_file.stream)
+  stream = tempfile.TemporaryFile()
+  output = io.TextIOWrapper(stream, encoding = 'utf-8')
+  write_sdml(table, output)
+  output.flush()
+  output.detach()
+  stream.seek(0)
+  return {"name": Path(filename).stem, "table": {"schema": table.schema, "type": "RowTable"}, "stream": stream, "num_rows": table.num_rows}
@@ -0,0 +1,148 @@
+'''
+Vectorized evaluation of SDQL filters over a ColumnarTable.  An SDQLFilter is compiled once
+into a function which computes a boolean mask over the table's column arrays with NumPy:
+  IN_LIST: np.isin over the column (for a dictionary-encoded column, over the codes of the listed values)
+  IN_RANGE: a pair of comparisons (for a dictionary-encoded column, over the range of codes,
+    since the dictionary is sorted)
+  REGEX_MATCH: the regular expression is matched against the (small) dictionary, and the
+    mask is np.isin over the codes that match
+  ALL, ANY, NONE: &, |, and ~| of the masks of the arguments
+When the table has secondary indexes (see table_index) that can answer the filter, or
+one argument of an ALL, the indexes are used instead of a full-column mask.
+The results are identical to SDQLFilter.filter_index.  Filters that can't be compiled
+(an unknown operator, or values that don't compare with the column) return None, and the
+caller falls back to evaluating the filter row by row.
+'''
+from bisect import bisect_left, bisect_right
+from functools import reduce
+
+import numpy as np
+
+
+def _array_values(table, index, values):
+  # Convert a list of Python values to an array comparable with column index
+  encoding = table.encodings[index]
+  if encoding.startswith('datetime64'):
+    return np.array(values, dtype = encoding)
+  return np.array(values)
+
+
+def _compile(sdql_filter, table):
+  # Compile sdql_filter into a function of no arguments returning a boolean mask over the rows
+  # of table.  Raises TypeError or ValueError if the filter can't be compiled
+  operator = sdql_filter.operator
+  num_rows = table.num_rows
+  if operator in {'ALL', 'ANY', 'NONE'}:
+    arguments = [_compile(argument, table) for argument in sdql_filter.arguments]
+    if operator == 'ALL':
+      return lambda: reduce(np.logical_and, [argument() for argument in arguments], np.ones(num_rows, dtype = np.bool_))
+    union = lambda: reduce(np.logical_or, [argument() for argument in arguments], np.zeros(num_rows, dtype = np.bool_))
+    return union if operator == 'ANY' else lambda: ~union()
+
+  index = sdql_filter.column_index
+  column = table.columns[index]
+  dictionary = table.dictionaries[index]
+  if operator == 'IN_LIST':
+    if dictionary is not None:
+      codes = {value: code for (code, value) in enumerate(dictionary)}
+      selected = np.array(sorted({codes[value] for value in sdql_filter.value_list if value in codes}), dtype = column.dtype)
+    else:
+      selected = _array_values(table, index, sdql_filter.value_list)
+    return lambda: np.isin(column, selected)
+  if operator == 'IN_RANGE':
+    if dictionary is not None:
+      (low, high) = (bisect_left(dictionary, sdql_filter.min_val), bisect_right(dictionary, sdql_filter.max_val))
+      return lambda: (column >= low) & (column < high)
+    (min_val, max_val) = _array_values(table, index, [sdql_filter.min_val, sdql_filter.max_val])
+    return lambda: (column >= min_val) & (column <= max_val)
+  if operator == 'REGEX_MATCH' and dictionary is not None:
+    regex = sdql_filter.regex
+    selected = np.array([code for (code, value) in enumerate(dictionary) if regex.fullmatch(value) is not None], dtype = column.dtype)
+    return lambda: np.isin(column, selected)
+  raise ValueError(f'Operator {operator} cannot be vectorized for column {sdql_filter.column_name}')
+
+
+def _indexed_rows(sdql_filter, table):
+  # The indices of the rows of table which pass sdql_filter, found with the table's
+  # indexes, or None if the indexes can't answer the filter.  An ALL is answered when
+  # any of its arguments can be: the remaining arguments are evaluated only over the
+  # rows the indexes found
+  operator = sdql_filter.operator
+  if operator == 'ALL':
+    found = [(argument, _indexed_rows(argument, table)) for argument in sdql_filter.arguments]
+    indexed = [rows for (_, rows) in found if rows is not None]
+    if len(indexed) == 0:
+      return None
+    candidates = reduce(np.intersect1d, indexed)
+    rest = [argument for (argument, rows) in found if rows is None]
+    if len(rest) > 0 and len(candidates) > 0:
+      subset = table.subset(candidates)
+      candidates = candidates[reduce(np.logical_and, [_compile(argument, subset)() for argument in rest])]
+    return candidates
+  if operator == 'ANY':
+    found = [_indexed_rows(argument, table) for argument in sdql_filter.arguments]
+    if len(found) == 0 or any(rows is None for rows in found):
+      return None
+    return reduce(np.union1d, found)
+  if operator not in {'IN_LIST', 'IN_RANGE'}:
+    return None
+  index = sdql_filter.column_index
+  table_index = table.indexes.get(index)
+  if table_index is None:
+    return None
+  dictionary = table.dictionaries[index]
+  if operator == 'IN_LIST':
+    if dictionary is not None:
+      codes = {value: code for (code, value) in enumerate(dictionary)}
+      keys = [codes[value] for value in sdql_filter.value_list if value in codes]
+    elif table_index.kind == 'sorted':
+      keys = _array_values(table, index, sdql_filter.value_list)
+    else:
+      keys = sdql_filter.value_list
+    return table_index.lookup(keys)
+  if table_index.kind != 'sorted':
+    return None
+  if dictionary is not None:
+    (low, high) = (bisect_left(dictionary, sdql_filter.min_val), bisect_right(dictionary, sdql_filter.max_val))
+    return table_index.range(low, high - 1)
+  (min_val, max_val) = _array_values(table, index, [sdql_filter.min_val, sdql_filter.max_val])
+  return table_index.range(min_val, max_val)
+
+
+def compile_mask(sdql_filter, table):
+  '''
+  Compile sdql_filter into a function which returns the boolean mask of the rows of
+  table which pass the filter, or return None if the filter can't be vectorized.
+  Arguments:
+    sdql_filter: an SDQLFilter
+    table: a ColumnarTable
+  '''
+  try:
+    return _compile(sdql_filter, table)
+  except (TypeError, ValueError):
+    return None
+
+
+def filter_indices(sdql_filter, table):
+  '''
+  Return the indices of the rows of table which pass sdql_filter, in order, as a NumPy
+  array, or None if the filter can't be vectorized.  If the table's indexes can answer
+  the filter, only the rows they select are touched.
+  Arguments:
+    sdql_filter: an SDQLFilter
+    table: a ColumnarTable
+  '''
+  if len(table.indexes) > 0:
+    try:
+      rows = _indexed_rows(sdql_filter, table)
+      if rows is not None:
+        return rows
+    except (TypeError, ValueError):
+      pass
+  mask = compile_mask(sdql_filter, table)
+  if mask is None:
+    return None
+  try:
+    return np.flatnonzero(mask())
+  except (TypeError, ValueError):
+    return None
@@ -0,0 +1,12 @@
+'''
+The WSGI entry point of the wiki.  gunicorn serves wsgi:app (see gunicorn.conf.py), and
+the development server can serve it with FLASK_APP=wsgi.  The tables are loaded when this
+module is imported.  When gunicorn preloads the app, this happens once, in the master
+process, and the background work of each worker is started by the post_fork hook in
+gunicorn.conf.py rather than here.
+'''
+import os
+
+from main import create_app
+
+app = create_app(start_worker = os.environ.get('WIKI_PRELOAD') != '1')